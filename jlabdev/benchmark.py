@@ -0,0 +1,415 @@
+# AUTOGENERATED FROM: jlabdev/benchmark.ipynb
+
+
+#%% Cell: 0
+"""doc
+> **The MIT License (MIT)**
+> 
+> Copyright (c) 2020 Michael Fuerst
+> 
+> Permission is hereby granted, free of charge, to any person obtaining a copy
+> of this software and associated documentation files (the "Software"), to deal
+> in the Software without restriction, including without limitation the rights
+> to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+> copies of the Software, and to permit persons to whom the Software is
+> furnished to do so, subject to the following conditions:
+> 
+> The above copyright notice and this permission notice shall be included in all
+> copies or substantial portions of the Software.
+> 
+> THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+> IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+> FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+> AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+> LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+> OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+> SOFTWARE.
+"""
+
+
+#%% Cell: 1
+"""doc
+# jlabdev.benchmark - Measure how jlabdev scales
+
+> A benchmark suite for jlabdev that runs on a generated project.
+
+It times the building blocks and the commands of jlabdev on a synthetic project and records their peak memory, so that regressions show up before they slow down real projects.
+The results are saved as json and can be compared across commits.
+"""
+
+
+#%% Cell: 2
+from typing import List, Dict, Optional
+import argparse
+import base64
+import contextlib
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from jlabdev.main import Files, Notebook, NotebookForDocumentation, PythonDoc, notebook2doc, notebook2py, python2nb, write_notebook
+
+
+#%% Cell: 3
+"""doc
+---
+
+## Generating a Corpus
+
+The benchmarks run on a synthetic project, so that they can be scaled to any size and are comparable across machines and commits.
+All properties of the project are tunable: the number of notebooks, the cells per notebook and how they are split into exported code, markdown and examples, how deep the folders are nested, how many images the examples output and how long their tracebacks are.
+The cells that are neither exported nor markdown are examples.
+"""
+
+
+#%% Cell: 4
+CORPUS_DEFAULTS = {
+    "notebooks": 20,
+    "cells": 30,
+    "export_ratio": 0.5,
+    "markdown_ratio": 0.25,
+    "depth": 2,
+    "images_per_cell": 1,
+    "image_size": 4096,
+    "traceback_lines": 20,
+    "seed": 0,
+}
+
+
+def _export_cell(rng: random.Random, notebook_idx: int, cell_idx: int) -> List[str]:
+    name = f"function_{notebook_idx}_{cell_idx}"
+    source = [
+        "#export\n",
+        f"def {name}(value: int, scale: float = 1.0) -> float:\n",
+        "    \"\"\"\n",
+        f"    Compute something for cell {cell_idx}.\n",
+        "\n",
+        "    :param value: The input value.\n",
+        "    :type value: int\n",
+        "    :param scale: The scale of the result, defaults to 1.0.\n",
+        "    :type scale: float, optional\n",
+        "    :return: The scaled value.\n",
+        "    :rtype: float\n",
+        "    \"\"\"\n",
+    ]
+    source += [f"    value = value * {rng.randint(1, 100)} + {rng.randint(0, 100)}\n" for _ in range(rng.randint(1, 10))]
+    source += [
+        "    return value * scale\n",
+        "\n",
+        "\n",
+        f"class Model{notebook_idx}x{cell_idx}(object):\n",
+        "    def __init__(self, size: int):\n",
+        "        self.size = size\n",
+        "\n",
+        "    def forward(self, value):\n",
+        f"        return {name}(value) * self.size",
+    ]
+    return source
+
+
+def _markdown_cell(rng: random.Random, cell_idx: int) -> List[str]:
+    words = ["notebook", "python", "markdown", "export", "cell", "example", "output", "the", "a", "of", "and"]
+    source = [f"### Section {cell_idx}\n", "\n"]
+    for _ in range(rng.randint(1, 5)):
+        source.append(" ".join(rng.choice(words) for _ in range(rng.randint(5, 30))) + ".\n")
+    source.append("\n")
+    source.append("* A list item with `code`")
+    return source
+
+
+def _example_outputs(rng: random.Random, images_per_cell: int, image_size: int, traceback_lines: int) -> List[Dict]:
+    outputs = [{"name": "stdout", "output_type": "stream", "text": [f"step {i}: loss={rng.random():.4f}\n" for i in range(rng.randint(1, 20))]}]
+    for _ in range(images_per_cell):
+        data = base64.b64encode(rng.getrandbits(8 * image_size).to_bytes(image_size, "little")).decode()
+        outputs.append({"data": {"image/png": data, "text/plain": ["<Figure size 640x480 with 1 Axes>"]}, "metadata": {}, "output_type": "display_data"})
+    if traceback_lines > 0:
+        traceback = ["\u001b[0;31m---------------------------------------------------------------------------\u001b[0m"]
+        traceback += [f"\u001b[0;32m<ipython-input>\u001b[0m in \u001b[0;36m<module>\u001b[0;34m\u001b[0m\n\u001b[1;32m  {i}\u001b[0m value = compute({i})" for i in range(traceback_lines)]
+        traceback.append("\u001b[0;31mValueError\u001b[0m: Something went wrong.")
+        outputs.append({"ename": "ValueError", "evalue": "Something went wrong.", "output_type": "error", "traceback": traceback})
+    return outputs
+
+
+def generate_project(root: str, notebooks: int = 20, cells: int = 30, export_ratio: float = 0.5, markdown_ratio: float = 0.25, depth: int = 2, images_per_cell: int = 1, image_size: int = 4096, traceback_lines: int = 20, seed: int = 0) -> List[str]:
+    """
+    Generate a synthetic project of notebooks.
+
+    :param root: The folder in which the notebooks are created.
+    :type root: str
+    :param notebooks: The number of notebooks.
+    :type notebooks: int
+    :param cells: The number of cells per notebook.
+    :type cells: int
+    :param export_ratio: The fraction of cells that are exported code.
+    :type export_ratio: float
+    :param markdown_ratio: The fraction of cells that are markdown, all other cells are examples.
+    :type markdown_ratio: float
+    :param depth: The number of nested folders the notebooks are placed in.
+    :type depth: int
+    :param images_per_cell: The number of png outputs of every example cell.
+    :type images_per_cell: int
+    :param image_size: The size of every image in bytes.
+    :type image_size: int
+    :param traceback_lines: The number of lines of the traceback every example cell outputs, 0 for no traceback.
+    :type traceback_lines: int
+    :param seed: The seed of the random generator, the same seed generates the same project.
+    :type seed: int
+    :return: The paths of the notebooks relative to the root.
+    :rtype: List[str]
+    """
+    rng = random.Random(seed)
+    paths = []
+    for notebook_idx in range(notebooks):
+        folder = "/".join(f"package{(notebook_idx >> level) % 4}" for level in range(depth))
+        path = (folder + "/" if folder != "" else "") + f"notebook{notebook_idx}.ipynb"
+        notebook_cells = [{"cell_type": "markdown", "metadata": {}, "source": [f"# Notebook {notebook_idx}\n", "\n", "A synthetic notebook for benchmarking."]}]
+        for cell_idx in range(1, cells):
+            kind = rng.random()
+            if kind < export_ratio:
+                notebook_cells.append({"cell_type": "code", "execution_count": None, "metadata": {}, "outputs": [], "source": _export_cell(rng, notebook_idx, cell_idx)})
+            elif kind < export_ratio + markdown_ratio:
+                notebook_cells.append({"cell_type": "markdown", "metadata": {}, "source": _markdown_cell(rng, cell_idx)})
+            else:
+                outputs = _example_outputs(rng, images_per_cell, image_size, traceback_lines)
+                notebook_cells.append({"cell_type": "code", "execution_count": cell_idx, "metadata": {}, "outputs": outputs, "source": [f"function_{notebook_idx}_{cell_idx}(42)"]})
+        notebook = {"cells": notebook_cells, "metadata": {"language_info": {"name": "python"}}, "nbformat": 4, "nbformat_minor": 4}
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+        write_notebook(os.path.join(root, path), notebook)
+        paths.append(path)
+    return paths
+
+
+#%% Cell: 5
+"""doc
+---
+
+## Measuring
+
+Every phase is run a few times and the fastest and median time are recorded.
+The peak memory is measured in a separate run with `tracemalloc`, as tracing slows down the code.
+It only covers the python allocations of the benchmark process, so use `jobs=1` (the default) when comparing memory.
+The output of the commands is discarded while measuring.
+"""
+
+
+#%% Cell: 6
+class Benchmark(object):
+    def __init__(self, repeat: int = 3, memory: bool = True):
+        self.repeat = repeat
+        self.memory = memory
+        self.results = {}
+
+    def _run(self, function, setup) -> float:
+        if setup is not None:
+            setup()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            function()
+            return time.perf_counter() - start
+
+    def measure(self, name: str, function, setup=None) -> Dict:
+        seconds = [self._run(function, setup) for _ in range(self.repeat)]
+        result = {"seconds": seconds, "min": min(seconds), "median": statistics.median(seconds), "peak_memory": None}
+        if self.memory:
+            tracemalloc.start()
+            try:
+                self._run(function, setup)
+                result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        self.results[name] = result
+        memory = "" if result["peak_memory"] is None else f" {result['peak_memory'] / 2**20:8.1f} MB"
+        print(f"{name:<24}{result['min']:9.3f}s{result['median']:9.3f}s{memory}")
+        return result
+
+
+#%% Cell: 7
+"""doc
+The phases cover the building blocks (finding files, converting a notebook to python, extracting the documentation from python, converting a notebook to markdown) and the commands with and without a warm build cache.
+`python2nb` is measured once with all python files edited and once without changes.
+"""
+
+
+#%% Cell: 8
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _remove_files(file_paths: List[str]) -> None:
+    for file_path in file_paths:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def _edit_python_files(file_paths: List[str], run: List[int]) -> None:
+    # Adds a comment to the first code cell of every file.
+    run[0] += 1
+    for file_path in file_paths:
+        with open(file_path, "r", encoding="utf8") as f:
+            lines = f.read().split("\n")
+        for idx in range(len(lines) - 1):
+            if lines[idx].startswith("#%% Cell:") and not lines[idx + 1].startswith("\"\"\"doc"):
+                lines.insert(idx + 1, f"# benchmark edit {run[0]}")
+                break
+        with open(file_path, "w", encoding="utf8") as f:
+            f.write("\n".join(lines))
+
+
+def run_benchmarks(root: str, repeat: int = 3, jobs: Optional[int] = 1, memory: bool = True) -> Dict:
+    """
+    Benchmark all phases of jlabdev on the project in the root folder.
+
+    :param root: The project folder, e.g. created by generate_project.
+    :type root: str
+    :param repeat: How often every phase is timed.
+    :type repeat: int
+    :param jobs: The number of worker processes for the commands, defaults to 1.
+    :type jobs: int, optional
+    :param memory: Measure the peak memory of every phase, defaults to True.
+    :type memory: bool, optional
+    :return: The results per phase with the times in seconds and the peak memory in bytes.
+    :rtype: Dict
+    """
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        benchmark = Benchmark(repeat, memory)
+        Files.invalidate()
+        notebooks = Files.get_notebooks()
+        python_files = [file_path.replace(".ipynb", ".py") for file_path in notebooks]
+
+        benchmark.measure("get_files", Files.get_files, Files.invalidate)
+        benchmark.measure("to_python", lambda: [Notebook(file_path, load_outputs=False).to_python() for file_path in notebooks], lambda: _remove_files(python_files))
+        python_files = [file_path for file_path in python_files if os.path.exists(file_path)]
+        sources = []
+        for file_path in python_files:
+            with open(file_path, "r") as f:
+                sources.append(f.read())
+        benchmark.measure("extract", lambda: [PythonDoc.extract(source, "source.py") for source in sources])
+        benchmark.measure("to_markdown", lambda: [NotebookForDocumentation(file_path).to_markdown() for file_path in notebooks])
+        benchmark.measure("nb2py", lambda: notebook2py(force=True, jobs=jobs))
+        benchmark.measure("nb2py_cached", lambda: notebook2py(jobs=jobs))
+        benchmark.measure("nb2doc", lambda: notebook2doc(force=True, jobs=jobs))
+        benchmark.measure("nb2doc_cached", lambda: notebook2doc(jobs=jobs))
+        benchmark.measure("py2nb_unchanged", lambda: python2nb(jobs=jobs))
+        run = [0]
+        benchmark.measure("py2nb", lambda: python2nb(jobs=jobs), lambda: _edit_python_files(python_files, run))
+        return benchmark.results
+    finally:
+        os.chdir(cwd)
+        Files.invalidate()
+
+
+#%% Cell: 9
+"""doc
+---
+
+## Comparing Results
+
+The results are saved as json report together with the commit, python version and corpus they were measured with.
+Two reports can be compared to see which phases got faster or slower.
+"""
+
+
+#%% Cell: 10
+def make_report(results: Dict, corpus: Dict, repeat: int, jobs: Optional[int]) -> Dict:
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "corpus": corpus,
+        "repeat": repeat,
+        "jobs": jobs,
+        "results": results,
+    }
+
+
+def save_report(file_path: str, report: Dict) -> None:
+    with open(file_path, "w", encoding="utf8") as f:
+        f.write(json.dumps(report, indent=1) + "\n")
+
+
+def load_report(file_path: str) -> Dict:
+    with open(file_path, "r", encoding="utf8") as f:
+        return json.load(f)
+
+
+def compare_reports(baseline: Dict, report: Dict) -> None:
+    """
+    Print the change of the median time and peak memory of every phase between two reports.
+
+    :param baseline: The report to compare against.
+    :type baseline: Dict
+    :param report: The new report.
+    :type report: Dict
+    """
+    if baseline["corpus"] != report["corpus"]:
+        print("WARNING: The reports were measured on different corpora.")
+    print(f"{'phase':<24}{'baseline':>10}{'new':>10}{'ratio':>8}{'memory':>10}")
+    for name, result in report["results"].items():
+        if name not in baseline["results"]:
+            continue
+        old = baseline["results"][name]
+        ratio = result["median"] / old["median"] if old["median"] > 0 else float("inf")
+        memory = ""
+        if result["peak_memory"] is not None and old["peak_memory"]:
+            memory = f"{result['peak_memory'] / old['peak_memory']:9.2f}x"
+        print(f"{name:<24}{old['median']:9.3f}s{result['median']:9.3f}s{ratio:7.2f}x{memory}")
+
+
+#%% Cell: 11
+"""doc
+---
+
+## Command Line Interface
+
+```bash
+python -m jlabdev.benchmark --notebooks 100 --cells 50 --output results.json
+python -m jlabdev.benchmark --output new.json --compare results.json
+```
+
+The corpus is generated in a temporary folder, unless a folder is given with `--root`.
+"""
+
+
+#%% Cell: 12
+def benchmark(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark jlabdev on a synthetic project.")
+    for name, default in CORPUS_DEFAULTS.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=type(default), default=default)
+    parser.add_argument("--root", default=None, help="Folder for the generated project, defaults to a temporary folder.")
+    parser.add_argument("--repeat", type=int, default=3, help="How often every phase is timed.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes for the commands.")
+    parser.add_argument("--no-memory", action="store_true", help="Do not measure the peak memory.")
+    parser.add_argument("--output", default=None, help="Save the results as json to this file.")
+    parser.add_argument("--compare", default=None, help="Compare the results to this json file.")
+    args = parser.parse_args(argv)
+    corpus = {name: getattr(args, name) for name in CORPUS_DEFAULTS}
+
+    with tempfile.TemporaryDirectory(prefix="jlabdev-benchmark-") as tmp_root:
+        root = args.root if args.root is not None else tmp_root
+        generate_project(root, **corpus)
+        print(f"{'phase':<24}{'min':>10}{'median':>10}{'' if args.no_memory else 'memory':>11}")
+        results = run_benchmarks(root, args.repeat, args.jobs, not args.no_memory)
+
+    report = make_report(results, corpus, args.repeat, args.jobs)
+    if args.output is not None:
+        save_report(args.output, report)
+    if args.compare is not None:
+        print()
+        compare_reports(load_report(args.compare), report)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,344 @@
+# AUTOGENERATED FROM: jlabdev/client.ipynb
+
+
+#%% Cell: 0
+"""doc
+> **The MIT License (MIT)**
+> 
+> Copyright (c) 2020 Michael Fuerst
+> 
+> Permission is hereby granted, free of charge, to any person obtaining a copy
+> of this software and associated documentation files (the "Software"), to deal
+> in the Software without restriction, including without limitation the rights
+> to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+> copies of the Software, and to permit persons to whom the Software is
+> furnished to do so, subject to the following conditions:
+> 
+> The above copyright notice and this permission notice shall be included in all
+> copies or substantial portions of the Software.
+> 
+> THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+> IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+> FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+> AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+> LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+> OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+> SOFTWARE.
+"""
+
+
+#%% Cell: 1
+"""doc
+# jlabdev.client - Convert in the daemon if it is running
+
+> The `jlabdev` command, which sends conversions to the daemon and converts in its own process if there is none.
+
+Starting python and importing all of jlabdev takes longer than converting a single notebook.
+So this module only imports what it needs to talk to the daemon (see [jlabdev.server](server.md)) and imports the rest of jlabdev only if it has to convert in its own process.
+
+```bash
+jlabdev serve &                 # Start the daemon in the root of the project
+jlabdev nb2all pkg/model.ipynb  # Same arguments as nb2all, nb2py, nb2doc and py2nb
+jlabdev stop                    # Stop the daemon
+jlabdev find notebook2py        # Look up a function, class or words in the docs
+jlabdev locate pkg/model.py:123 # Find the notebook cell of a line of a generated python file
+```
+
+Options that only make sense for a single run (`--watch`, `--timings` and `--profile`) are never sent to the daemon.
+The daemon uses its own `--jobs` and `--git` settings.
+"""
+
+
+#%% Cell: 2
+from typing import List, Dict, Optional
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import re
+import socket
+import sys
+
+
+#%% Cell: 3
+"""doc
+---
+
+## Sending Requests
+
+The protocol is one line of json per request and per response.
+A request names the command and optionally the paths to convert and whether to ignore the build cache, e.g. `{"command": "nb2py", "paths": ["pkg/model.ipynb"], "force": false}`.
+The response contains everything the command printed and an error message if it failed, e.g. `{"output": "...", "error": null}`.
+
+The client connects to the socket in the current working directory, so it has to run in the root of the project like all commands.
+"""
+
+
+#%% Cell: 4
+SOCKET_PATH = os.path.join(".jlabdev", "server.sock")
+
+
+def request(command: str, paths: Optional[List[str]] = None, force: bool = False) -> Optional[Dict]:
+    """Send a request to the daemon of the project in the current working directory.
+
+    :param command: One of "nb2all", "nb2py", "nb2doc", "py2nb", "stop" or "ping".
+    :type command: str
+    :param paths: Only convert these files and the files in these folders, defaults to the whole project.
+    :type paths: List[str], optional
+    :param force: Ignore the build cache, defaults to False.
+    :type force: bool, optional
+    :return: The response with the "output" of the command and an "error" message (or None). None if no daemon is running or it went away during the request.
+    :rtype: Dict
+    """
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(SOCKET_PATH):
+        return None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(SOCKET_PATH)
+            with sock.makefile("rwb") as f:
+                f.write(json.dumps({"command": command, "paths": paths, "force": force}).encode("utf8") + b"\n")
+                f.flush()
+                line = f.readline()
+        except OSError:
+            return None
+    if line == b"":
+        return None
+    return json.loads(line)
+
+
+#%% Cell: 5
+"""doc
+---
+
+## Searching the Docs
+
+`jlabdev find` answers from the search index written by nb2doc (see [jlabdev.main](main.md)), which is a single json file, so it neither reads the docs nor imports the rest of jlabdev.
+A name is looked up in the symbol table (ignoring the case if there is no exact match), otherwise the pages containing all words of the query are listed.
+"""
+
+
+#%% Cell: 6
+SEARCH_INDEX_PATH = "docs/search_index.json"  # Written by nb2doc.
+SEARCH_INDEX_VERSION = 1
+
+
+def load_search_index(index_path: str = SEARCH_INDEX_PATH) -> Dict:
+    with open(index_path, "rb") as f:
+        index = json.load(f)
+    if index.get("version") != SEARCH_INDEX_VERSION:
+        raise ValueError(f"Unsupported search index version in {index_path}, run nb2doc to rebuild it.")
+    return index
+
+
+def find_symbols(index: Dict, name: str) -> List[Dict]:
+    """Find the documented classes and functions with the name.
+
+    :param index: The search index (see `load_search_index`).
+    :type index: Dict
+    :param name: The name of the symbol, the case is ignored if no symbol has exactly this name.
+    :type name: str
+    :return: The symbols with their "name", "kind", "signature", "source" file, "line", "anchor" and "page" (a dict with "path" and "title").
+    :rtype: List[Dict]
+    """
+    symbols = index["symbols"].get(name)
+    if symbols is None:
+        symbols = [symbol for key, entries in index["symbols"].items() if key.lower() == name.lower() for symbol in entries]
+    return [dict(symbol, page=index["pages"][symbol["page"]]) for symbol in symbols]
+
+
+def find_pages(index: Dict, query: str) -> List[Dict]:
+    """Find the pages containing all words of the query in their docstrings or markdown.
+
+    :param index: The search index (see `load_search_index`).
+    :type index: Dict
+    :param query: The words to search for.
+    :type query: str
+    :return: The pages with their "path" (relative to the docs folder) and "title".
+    :rtype: List[Dict]
+    """
+    words = re.findall(r"\w{2,}", query.lower())
+    if len(words) == 0:
+        return []
+    page_ids = set(index["terms"].get(words[0], []))
+    for word in words[1:]:
+        page_ids &= set(index["terms"].get(word, []))
+    return [index["pages"][page_id] for page_id in sorted(page_ids)]
+
+
+def find(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="jlabdev find", description="Find classes, functions and words in the docs.")
+    parser.add_argument("query", nargs="+", help="A class or function name or the words to search for.")
+    parser.add_argument("--index", default=SEARCH_INDEX_PATH, help=f"The search index (default: {SEARCH_INDEX_PATH}).")
+    args = parser.parse_args(argv)
+    query = " ".join(args.query)
+    try:
+        index = load_search_index(args.index)
+    except (OSError, ValueError) as e:
+        print(f"Cannot read the search index: {e}")
+        sys.exit(1)
+    docs_folder = os.path.dirname(args.index)
+    symbols = find_symbols(index, query)
+    for symbol in symbols:
+        page_path = os.path.join(docs_folder, symbol["page"]["path"]).replace("\\", "/")
+        anchor = "#" + symbol["anchor"] if symbol["anchor"] is not None else ""
+        print(f"{symbol['kind']} {symbol['name']}{symbol['signature']}  {symbol['source']}:{symbol['line']}  {page_path}{anchor}")
+    if len(symbols) > 0:
+        return
+    pages = find_pages(index, query)
+    for page in pages:
+        page_path = os.path.join(docs_folder, page["path"]).replace("\\", "/")
+        print(f"{page_path}  {page['title']}")
+    if len(pages) == 0:
+        print(f"No matches for: {query}")
+        sys.exit(1)
+
+
+#%% Cell: 7
+"""doc
+---
+
+## Locating Lines in Notebooks
+
+`jlabdev locate` maps a line of a generated python file (e.g. from a traceback) to its notebook cell using the source map saved by nb2py (see [jlabdev.main](main.md)).
+A python file without a source map (e.g. converted before source maps existed) is mapped by generating the map from its notebook, which imports the rest of jlabdev.
+If the python file was edited since it was generated, the line may belong to another cell, which is pointed out.
+"""
+
+
+#%% Cell: 8
+SOURCE_MAPS_FOLDER = os.path.join(".jlabdev", "source_maps")  # Written by nb2py.
+
+
+def load_source_map(python_path: str) -> Dict:
+    python_path = os.path.relpath(python_path).replace("\\", "/")
+    try:
+        with open(os.path.join(SOURCE_MAPS_FOLDER, python_path + ".json"), "rb") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        from jlabdev.main import SourceMap
+        return SourceMap.generate(python_path).to_dict()
+
+
+def locate(source_map: Dict, line: int) -> Optional[Dict]:
+    """Find the notebook cell of a line of a generated python file.
+
+    :param source_map: The source map of the python file (see `load_source_map`).
+    :type source_map: Dict
+    :param line: The line in the python file, starting at 1.
+    :type line: int
+    :return: The "notebook", the "cell_index" and "cell_id" of the cell in the notebook and the "cell_line" in the cell (starting at 1), None if the line is not part of a cell.
+    :rtype: Dict
+    """
+    cells = source_map["cells"]
+    idx = bisect.bisect_right([cell[0] for cell in cells], line) - 1
+    if idx < 0 or line > cells[idx][1]:
+        return None
+    first_line, _, cell_index, cell_id, first_cell_line = cells[idx]
+    return {"notebook": source_map["notebook"], "cell_index": cell_index, "cell_id": cell_id, "cell_line": max(line - first_line + first_cell_line, 1)}
+
+
+def locate_command(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="jlabdev locate", description="Find the notebook cells of lines of generated python files.")
+    parser.add_argument("locations", nargs="+", metavar="FILE:LINE", help="A line of a generated python file, e.g. pkg/model.py:123.")
+    args = parser.parse_args(argv)
+    failed = False
+    for location in args.locations:
+        python_path, _, line = location.rpartition(":")
+        if python_path == "" or not line.isdigit():
+            parser.error(f"Expected FILE:LINE, got {location}")
+        try:
+            source_map = load_source_map(python_path)
+            with open(python_path, "rb") as f:
+                data = f.read()
+        except (OSError, ValueError) as e:
+            print(f"{location}: {e}")
+            failed = True
+            continue
+        result = locate(source_map, int(line))
+        if source_map["python_hash"] is not None and hashlib.blake2b(data, digest_size=16).hexdigest() != source_map["python_hash"]:
+            print(f"WARNING: {python_path} changed since it was generated, run nb2py or py2nb to update the source map.")
+        if result is None:
+            print(f"{location}: not part of a cell of {source_map['notebook']}")
+            continue
+        cell_id = f" (id {result['cell_id']})" if result["cell_id"] is not None else ""
+        print(f"{location}: {result['notebook']} cell {result['cell_index']}{cell_id} line {result['cell_line']}")
+    if failed:
+        sys.exit(1)
+
+
+#%% Cell: 9
+"""doc
+---
+
+## Command Line Interface
+
+The arguments are only parsed as far as needed to find the paths and `--force` of a conversion.
+Anything else (e.g. `--timings`, `--help` or a path that does not exist) is left to the actual command, which then runs in this process.
+"""
+
+
+#%% Cell: 10
+def _error(message: str) -> None:
+    raise ValueError(message)
+
+
+def _parse_forwarded_args(command: str, argv: List[str]) -> Optional[argparse.Namespace]:
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.error = _error
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument("--git", action="store_true")
+    parser.add_argument("-j", "--jobs")
+    parser.add_argument("paths", nargs="*")
+    try:
+        args, unknown = parser.parse_known_args(argv)
+    except ValueError:
+        return None
+    if len(unknown) > 0 or (command == "py2nb" and args.force):
+        return None
+    for path in args.paths:
+        if not os.path.exists(path) or (os.path.relpath(path).replace("\\", "/") + "/").startswith("../"):
+            return None
+    return args
+
+
+def forward(command: str, argv: List[str]) -> None:
+    args = _parse_forwarded_args(command, argv)
+    response = None
+    if args is not None:
+        paths = [os.path.relpath(path).replace("\\", "/") for path in args.paths] if len(args.paths) > 0 else None
+        response = request(command, paths, args.force)
+    if response is None:
+        # Only import the conversions when they run in this process, that is the time the daemon saves.
+        from jlabdev import main
+        getattr(main, command)(argv)
+        return
+    print(response["output"], end="")
+    if response["error"] is not None:
+        print("ERROR: {}".format(response["error"]))
+        sys.exit(1)
+
+
+def jlabdev(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="jlabdev")
+    parser.add_argument("command", choices=["nb2all", "nb2py", "nb2doc", "py2nb", "serve", "stop", "find", "locate"], help="The command to run, see `jlabdev COMMAND --help` for its options.")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="The arguments of the command.")
+    args = parser.parse_args(argv)
+    if args.command == "serve":
+        from jlabdev.server import serve_command
+        serve_command(args.args)
+    elif args.command == "find":
+        find(args.args)
+    elif args.command == "locate":
+        locate_command(args.args)
+    elif args.command == "stop":
+        argparse.ArgumentParser(prog="jlabdev stop").parse_args(args.args)
+        response = request("stop")
+        print(response["output"] if response is not None else "No server is running.\n", end="")
+    else:
+        forward(args.command, args.args)
+
+
+#%% Cell: 11
+if __name__ == "__main__":
+    jlabdev()
@@ -42,13 +42,38 @@ With the final tool there are 4 commands available:
 
 
 #%% Cell: 2
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+import abc
+import argparse
+import ast
+import cProfile
+import concurrent.futures
+import contextlib
+import functools
+import ctypes
+import ctypes.util
+import enum
+import inspect
+import io
 import json
+import mmap
+import multiprocessing
 import os
+import posixpath
+import re
+import select
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import traceback
 import hashlib
 import shutil
 import base64
+import zipfile
+import zlib
 
 
 #%% Cell: 3
@@ -60,59 +85,893 @@ import base64
 First we will implement a helper function that allows us to find all notebooks and another helper, that gets us all the all the pure python code and code that is generated from notebooks.
 
 For that we will:
-1. Find all files in the folder and subfolders.
+1. Find all files in the folder and subfolders in a single pass (skipping hidden folders and everything matched by a `.gitignore` or `.jlabdevignore`).
 2. Filter those which end on `.ipynb` as they are notebooks.
 3. Filter for files which end on `.py` and are not in notebooks list.
 4. Filter for files which end on `.py` and are in notebooks list.
+
+The ignore files use the gitignore syntax. Since walking big projects is expensive, the result of the scan is cached for the run in a `FileIndex`.
+When only some files or folders are given (e.g. the notebook that was just saved), only those are looked at instead of the whole project.
+
+Many notebooks in a project are scratch or analysis notebooks, which have neither exported cells nor an example title and are never converted.
+`Files.has_markers` tells them apart without parsing them (see Reading Notebooks) and remembers the answer in the build cache until the notebook changes, so later runs do not scan them again.
 """
 
 
 #%% Cell: 4
+IGNORE_FILES = [".gitignore", ".jlabdevignore"]
+DEFAULT_IGNORE_PATTERNS = [".ipynb_checkpoints/", "__pycache__/", "node_modules/"]
+
+
+class IgnoreRules(object):
+    def __init__(self, patterns: Optional[List[str]] = None):
+        self.rules = []
+        for pattern in patterns or []:
+            self.add_pattern(pattern)
+
+    def add_file(self, file_path: str, base: str = "") -> None:
+        with open(file_path, "r", encoding="utf8") as f:
+            for line in f.read().split("\n"):
+                self.add_pattern(line, base)
+
+    def add_pattern(self, pattern: str, base: str = "") -> None:
+        pattern = pattern.rstrip()
+        if pattern == "" or pattern.startswith("#"):
+            return
+        negate = pattern.startswith("!")
+        if negate:
+            pattern = pattern[1:]
+        elif pattern.startswith("\\"):
+            pattern = pattern[1:]
+        dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+        if pattern == "":
+            return
+        self.rules.append((base, IgnoreRules._translate(pattern), negate, dir_only, anchored))
+
+    @staticmethod
+    def _translate(pattern: str):
+        regex = []
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith("**/", i):
+                regex.append("(?:.*/)?")
+                i += 3
+            elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+                regex.append("/.*")
+                i += 3
+            elif pattern.startswith("**", i):
+                regex.append(".*")
+                i += 2
+            elif pattern[i] == "*":
+                regex.append("[^/]*")
+                i += 1
+            elif pattern[i] == "?":
+                regex.append("[^/]")
+                i += 1
+            elif pattern[i] == "[" and pattern.find("]", i + 1) > 0:
+                end = pattern.find("]", i + 1)
+                char_class = pattern[i+1:end].replace("\\", "\\\\")
+                if char_class.startswith("!"):
+                    char_class = "^" + char_class[1:]
+                regex.append("[" + char_class + "]")
+                i = end + 1
+            elif pattern[i] == "\\" and i + 1 < len(pattern):
+                regex.append(re.escape(pattern[i+1]))
+                i += 2
+            else:
+                regex.append(re.escape(pattern[i]))
+                i += 1
+        return re.compile("".join(regex))
+
+    def is_ignored(self, path: str, is_dir: bool) -> bool:
+        ignored = False
+        for base, regex, negate, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if not path.startswith(base):
+                continue
+            relative_path = path[len(base):]
+            if not anchored:
+                relative_path = relative_path.split("/")[-1]
+            if regex.fullmatch(relative_path):
+                ignored = not negate
+        return ignored
+
+
+class FileIndex(object):
+    def __init__(self, files: List[str], folders: Optional[List[str]] = None, rules: Optional[IgnoreRules] = None):
+        self.files = files
+        self.folders = set(folders or [])
+        self.rules = rules or IgnoreRules(DEFAULT_IGNORE_PATTERNS)
+        self.notebooks = [f for f in files if f.endswith(".ipynb")]
+        self._notebook_set = set(self.notebooks)
+        self._file_set = set(files)
+        self.generated_python_files = []
+        self.pure_python_files = []
+        for f in files:
+            if not f.endswith(".py"):
+                continue
+            if f[:-len(".py")] + ".ipynb" in self._notebook_set:
+                self.generated_python_files.append(f)
+            else:
+                self.pure_python_files.append(f)
+
+    def __contains__(self, file_path: str) -> bool:
+        return file_path in self._file_set
+
+    def add(self, file_path: str) -> None:
+        if file_path in self._file_set:
+            return
+        self.files.append(file_path)
+        self._file_set.add(file_path)
+        if file_path.endswith(".ipynb"):
+            self.notebooks.append(file_path)
+            self._notebook_set.add(file_path)
+            py_path = file_path[:-len(".ipynb")] + ".py"
+            if py_path in self._file_set:
+                self.pure_python_files.remove(py_path)
+                self.generated_python_files.append(py_path)
+        elif file_path.endswith(".py"):
+            if file_path[:-len(".py")] + ".ipynb" in self._notebook_set:
+                self.generated_python_files.append(file_path)
+            else:
+                self.pure_python_files.append(file_path)
+
+    def remove(self, file_path: str) -> None:
+        if file_path not in self._file_set:
+            return
+        self.files.remove(file_path)
+        self._file_set.remove(file_path)
+        if file_path.endswith(".ipynb"):
+            self.notebooks.remove(file_path)
+            self._notebook_set.remove(file_path)
+            py_path = file_path[:-len(".ipynb")] + ".py"
+            if py_path in self._file_set:
+                self.generated_python_files.remove(py_path)
+                self.pure_python_files.append(py_path)
+        elif file_path in self.generated_python_files:
+            self.generated_python_files.remove(file_path)
+        elif file_path in self.pure_python_files:
+            self.pure_python_files.remove(file_path)
+
+
+#%% Cell: 5
 class Files(object):
+    use_git = False
+    _index = None
+
     @staticmethod
-    def get_files() -> List[str]:
-        def _join_path_cleanly(root, fname):
-            joined_path = os.path.join(root, fname)
-            linux_style_path = joined_path.replace("\\", "/")
-            root_free_path = linux_style_path.replace("./", "")
-            return root_free_path
+    def _walk(root: str, rules: IgnoreRules, start: str = ""):
+        file_paths = []
+        folders = []
+        stack = [start]
+        while len(stack) > 0:
+            rel_dir = stack.pop()
+            folders.append(rel_dir)
+            prefix = rel_dir + "/" if rel_dir != "" else ""
+            with os.scandir(os.path.join(root, rel_dir)) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            for entry in entries:
+                if entry.name in IGNORE_FILES and entry.is_file():
+                    rules.add_file(entry.path, prefix)
+            sub_dirs = []
+            for entry in entries:
+                path = prefix + entry.name
+                if entry.is_dir():
+                    if entry.name.startswith(".") or entry.is_symlink() or rules.is_ignored(path, True):
+                        continue
+                    sub_dirs.append(path)
+                elif not rules.is_ignored(path, False):
+                    file_paths.append(path)
+            stack.extend(reversed(sub_dirs))
+        return file_paths, folders
+
+    @staticmethod
+    def _git_ls_files(root: str, *args: str) -> Optional[List[str]]:
+        try:
+            result = subprocess.run(["git", "ls-files", "-z"] + list(args), cwd=root, capture_output=True, check=True)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return [f for f in result.stdout.decode("utf8").split("\0") if f != ""]
+
+    @staticmethod
+    def _list_git(root: str, rules: IgnoreRules) -> Optional[List[str]]:
+        files = Files._git_ls_files(root, "--cached", "--others", "--exclude-standard")
+        if files is None:
+            return None
+        deleted = set(Files._git_ls_files(root, "--deleted") or [])
+        for f in files:
+            if f.split("/")[-1] == ".jlabdevignore":
+                rules.add_file(os.path.join(root, f), f[:-len(".jlabdevignore")])
+
+        ignored_dirs = {}
+        def _is_dir_ignored(path):
+            if path == "":
+                return False
+            if path not in ignored_dirs:
+                parent = "/".join(path.split("/")[:-1])
+                name = path.split("/")[-1]
+                ignored_dirs[path] = _is_dir_ignored(parent) or name.startswith(".") or rules.is_ignored(path, True)
+            return ignored_dirs[path]
 
         file_paths = []
-        for root, dirs, files in os.walk("."):
-            out_dirs = []
-            for folder in dirs:
-                current_dir = root.split(os.sep)[-1]
-                if not current_dir.startswith(".") or current_dir == ".":
-                    out_dirs.append(folder)
-            dirs[:] = out_dirs
-            if ".ipynb_checkpoints" in root:
+        for f in files:
+            if f in deleted or _is_dir_ignored("/".join(f.split("/")[:-1])) or rules.is_ignored(f, False):
                 continue
-            for f in files:
-                file_paths.append(_join_path_cleanly(root, f))
-        return file_paths
+            file_paths.append(f)
+        # Same order as the directory walk: files of a folder before its subfolders.
+        def _walk_order(path):
+            parts = path.split("/")
+            return [(1, d) for d in parts[:-1]] + [(0, parts[-1])]
+        return sorted(set(file_paths), key=_walk_order)
+
+    @staticmethod
+    def scan(root: str = ".", use_git: Optional[bool] = None) -> FileIndex:
+        with Timings.measure("scan files"):
+            if use_git is None:
+                use_git = Files.use_git
+            rules = IgnoreRules(DEFAULT_IGNORE_PATTERNS)
+            files = Files._list_git(root, rules) if use_git else None
+            if files is None:
+                files, folders = Files._walk(root, rules)
+            else:
+                folders = {""}
+                for f in files:
+                    parts = f.split("/")[:-1]
+                    for i in range(len(parts)):
+                        folders.add("/".join(parts[:i+1]))
+            return FileIndex(files, folders, rules)
+
+    @staticmethod
+    def _add_parent_ignore_files(root: str, rules: IgnoreRules, rel_path: str, loaded_prefixes: set) -> None:
+        parts = rel_path.split("/") if rel_path != "" else []
+        for i in range(len(parts)):
+            prefix = "".join(part + "/" for part in parts[:i])
+            if prefix in loaded_prefixes:
+                continue
+            loaded_prefixes.add(prefix)
+            for name in IGNORE_FILES:
+                if os.path.isfile(os.path.join(root, prefix + name)):
+                    rules.add_file(os.path.join(root, prefix + name), prefix)
+
+    @staticmethod
+    def changed(since: Optional[str] = None, root: str = ".") -> List[str]:
+        """List the files changed since a git revision or, if none is given, the files staged for the next commit.
+
+        Deleted and ignored files are left out and for a changed python file that is generated from a notebook, the notebook is listed as well.
+
+        :param since: The git revision (e.g. "origin/main") to compare the working tree to, defaults to the staged files.
+        :type since: str, optional
+        :param root: The project root, defaults to ".".
+        :type root: str, optional
+        :return: The paths of the changed files relative to the project root.
+        :rtype: List[str]
+        """
+        with Timings.measure("scan files"):
+            args = ["--cached"] if since is None else [since]
+            try:
+                result = subprocess.run(["git", "diff", "--name-only", "-z", "--relative"] + args + ["--"], cwd=root, capture_output=True, check=True)
+            except OSError as e:
+                raise ValueError(f"Cannot run git: {e}")
+            except subprocess.CalledProcessError as e:
+                raise ValueError("git diff failed: " + e.stderr.decode("utf8", "replace").strip())
+            rules = IgnoreRules(DEFAULT_IGNORE_PATTERNS)
+            loaded_prefixes = set()
+            files = []
+            for f in result.stdout.decode("utf8").split("\0"):
+                if f == "" or not os.path.isfile(os.path.join(root, f)):
+                    continue
+                Files._add_parent_ignore_files(root, rules, f, loaded_prefixes)
+                folders = f.split("/")[:-1]
+                if any(folder.startswith(".") or rules.is_ignored("/".join(folders[:i+1]), True) for i, folder in enumerate(folders)):
+                    continue
+                if rules.is_ignored(f, False):
+                    continue
+                files.append(f)
+                if f.endswith(".py") and os.path.isfile(os.path.join(root, f[:-len(".py")] + ".ipynb")):
+                    files.append(f[:-len(".py")] + ".ipynb")
+            return list(dict.fromkeys(files))
+
+    @staticmethod
+    def select(paths: List[str], root: str = ".") -> FileIndex:
+        with Timings.measure("scan files"):
+            rules = IgnoreRules(DEFAULT_IGNORE_PATTERNS)
+            loaded_prefixes = set()
+            files, folders = [], []
+            for path in paths:
+                rel_path = os.path.relpath(path, root).replace("\\", "/")
+                if rel_path == ".." or rel_path.startswith("../"):
+                    raise ValueError(f"{path} is not inside the project folder.")
+                rel_path = "" if rel_path == "." else rel_path
+                if os.path.isfile(os.path.join(root, rel_path)):
+                    # Files given explicitly are converted even if they are ignored.
+                    files.append(rel_path)
+                    continue
+                if not os.path.isdir(os.path.join(root, rel_path)):
+                    raise ValueError(f"No such file or folder: {path}")
+                # The ignore files of the parent folders apply to the folder as well.
+                Files._add_parent_ignore_files(root, rules, rel_path, loaded_prefixes)
+                found_files, found_folders = Files._walk(root, rules, rel_path)
+                files.extend(found_files)
+                folders.extend(found_folders)
+            index = FileIndex(list(dict.fromkeys(files)), folders, rules)
+            # A python file is generated if its notebook exists, even if the notebook was not selected.
+            generated = set(f for f in index.pure_python_files if os.path.isfile(os.path.join(root, f[:-len(".py")] + ".ipynb")))
+            index.generated_python_files.extend(f for f in index.pure_python_files if f in generated)
+            index.pure_python_files = [f for f in index.pure_python_files if f not in generated]
+            return index
+
+    @staticmethod
+    def get_index() -> FileIndex:
+        if Files._index is None:
+            Files._index = Files.scan()
+        return Files._index
+
+    @staticmethod
+    def invalidate() -> None:
+        Files._index = None
+
+    @staticmethod
+    def get_files() -> List[str]:
+        return list(Files.get_index().files)
 
     @staticmethod
     def get_notebooks() -> List[str]:
-        def _is_notebook(file_name):
-            return file_name.endswith(".ipynb")
-        return list(filter(_is_notebook, Files.get_files()))
+        return list(Files.get_index().notebooks)
 
     @staticmethod
     def get_pure_python_files() -> List[str]:
-        notebooks = Files.get_notebooks()
-        def _is_pure_python(file_name):
-            return file_name.endswith(".py") and file_name.replace(".py", ".ipynb") not in notebooks
-        return list(filter(_is_pure_python, Files.get_files()))
+        return list(Files.get_index().pure_python_files)
 
     @staticmethod
     def get_generated_python_files() -> List[str]:
-        notebooks = Files.get_notebooks()
-        def _is_generated_from_notebook(file_name):
-            return file_name.endswith(".py") and file_name.replace(".py", ".ipynb") in notebooks
-        return list(filter(_is_generated_from_notebook, Files.get_files()))
+        return list(Files.get_index().generated_python_files)
 
+    @staticmethod
+    def has_markers(file_path: str, markers: List[str], cache: "BuildCache") -> bool:
+        try:
+            stat = os.stat(_root_path(cache.root, file_path))
+        except OSError:
+            return True  # Let the conversion report the error.
+        state = cache.markers.get(file_path)
+        if state is None or state[0] != stat.st_size or state[1] != stat.st_mtime_ns:
+            found = _scan_notebook_markers(_root_path(cache.root, file_path))
+            # [size, mtime, has_export, has_example]
+            state = [stat.st_size, stat.st_mtime_ns] + [marker in found for marker in NOTEBOOK_MARKERS]
+            cache.set_markers(file_path, state)
+        return any(state[2 + idx] for idx, marker in enumerate(NOTEBOOK_MARKERS) if marker in markers)
 
-#%% Cell: 5
+
+#%% Cell: 6
+"""doc
+---
+
+## Caching Builds
+
+Regenerating every file on every run is slow for big projects and touching files that did not change triggers rebuilds in other tools (test caches, editors, packaging).
+So we keep a manifest in `.jlabdev/cache.json` which stores the size, modification time and content hash of every input and output file of a build.
+A build is up to date if all its inputs still have the recorded content hash and its outputs were not modified since they were written.
+The hash of a file is only computed if its size or modification time changed.
+The markers found in a notebook (see `Files.has_markers`) are kept in the manifest with its size and modification time as well, so notebooks that are never converted are only scanned again when they change.
+
+Outputs are only written if their content actually changed and they are written to a temporary file first, which is then renamed, so readers never see half written files.
+"""
+
+
+#%% Cell: 7
+BUILD_CACHE_PATH = os.path.join(".jlabdev", "cache.json")
+BUILD_CACHE_VERSION = 3
+
+
+def _hash_bytes(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _root_path(root: str, file_path: str) -> str:
+    # The paths of the project are relative to its root, which is the working directory unless given.
+    return file_path if root == "." else os.path.join(root, file_path)
+
+
+def _create_temp_file(folder: str):
+    # Unlike tempfile.mkstemp, which only lets the owner read the file, the umask applies as for any new file.
+    while True:
+        tmp_path = os.path.join(folder, f".jlabdev-{os.urandom(8).hex()}.tmp")
+        try:
+            return os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666), tmp_path
+        except FileExistsError:
+            continue
+
+
+def _write_if_changed(file_path: str, content: str) -> bool:
+    with Timings.measure("write files"):
+        if os.path.exists(file_path):
+            Timings.read(file_path)
+            with open(file_path, "r", encoding="utf8") as f:
+                if f.read() == content:
+                    return False
+        folder = os.path.dirname(file_path)
+        if folder != "":
+            os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = _create_temp_file(folder if folder != "" else ".")
+        try:
+            with os.fdopen(fd, "w", encoding="utf8") as f:
+                f.write(content)
+            if os.path.exists(file_path):
+                shutil.copymode(file_path, tmp_path)
+            os.replace(tmp_path, file_path)
+            Timings.written(file_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return True
+
+
+class BuildCache(object):
+    def __init__(self, file_path: str = BUILD_CACHE_PATH, force: bool = False, root: str = "."):
+        self.file_path = file_path
+        self.force = force
+        self.root = root
+        self.files = {}
+        self.builds = {}
+        self.markers = {}
+        self._start_time_ns = time.time_ns()
+        if os.path.exists(_root_path(root, file_path)):
+            try:
+                with open(_root_path(root, file_path), "rb") as f:
+                    data = _json_load(f)
+                if data.get("version") == BUILD_CACHE_VERSION:
+                    self.files = data["files"]
+                    self.builds = data["builds"]
+                    self.markers = data.get("markers", {})
+            except (OSError, ValueError, KeyError):
+                _log(f"WARNING: Ignoring unreadable build cache {file_path}.")
+
+    def _set_state(self, file_path: str, stat: os.stat_result, digest: str) -> None:
+        # Files modified during this run could change again without changing size or mtime,
+        # so their stat is not trusted and they get hashed again next time.
+        mtime = stat.st_mtime_ns if stat.st_mtime_ns < self._start_time_ns - 2 * 10**9 else -1
+        self.files[file_path] = [stat.st_size, mtime, digest]
+
+    def set_markers(self, file_path: str, state: List) -> None:
+        # Like the file states, markers of files modified during this run are not trusted next time.
+        if state[1] < self._start_time_ns - 2 * 10**9:
+            self.markers[file_path] = state
+
+    def file_hash(self, file_path: str) -> Optional[str]:
+        try:
+            stat = os.stat(_root_path(self.root, file_path))
+        except OSError:
+            self.files.pop(file_path, None)
+            return None
+        state = self.files.get(file_path)
+        if state is not None and state[0] == stat.st_size and state[1] == stat.st_mtime_ns:
+            return state[2]
+        with Timings.measure("hash files"):
+            Timings.read(_root_path(self.root, file_path))
+            with open(_root_path(self.root, file_path), "rb") as f:
+                digest = _hash_bytes(f.read())
+        self._set_state(file_path, stat, digest)
+        return digest
+
+    def is_up_to_date(self, key: str, inputs: List[str]) -> bool:
+        build = self.builds.get(key)
+        if self.force or build is None or sorted(build["inputs"].keys()) != sorted(inputs):
+            return False
+        for file_path, digest in list(build["inputs"].items()) + list(build["outputs"].items()):
+            if self.file_hash(file_path) != digest:
+                return False
+        return True
+
+    def get_outputs(self, key: str) -> List[str]:
+        return list(self.builds[key]["outputs"].keys())
+
+    def get_info(self, key: str) -> Dict:
+        return self.builds[key]["info"]
+
+    def record(self, key: str, inputs: List[str], outputs: List[str], info: Optional[Dict] = None) -> None:
+        self.builds[key] = {
+            "inputs": {file_path: self.file_hash(file_path) for file_path in inputs},
+            "outputs": {file_path: self.file_hash(file_path) for file_path in outputs},
+            "info": info or {},
+        }
+
+    def prune(self, prefix: str, keep_keys: List[str]) -> None:
+        keep_keys = set(keep_keys)
+        for key in list(self.builds.keys()):
+            if key.startswith(prefix) and key not in keep_keys:
+                del self.builds[key]
+
+    def save(self) -> None:
+        used_files = set()
+        for build in self.builds.values():
+            used_files.update(build["inputs"].keys())
+            used_files.update(build["outputs"].keys())
+        self.files = {file_path: state for file_path, state in self.files.items() if file_path in used_files}
+        self.markers = {file_path: state for file_path, state in self.markers.items() if file_path in used_files}
+        data = {"version": BUILD_CACHE_VERSION, "files": self.files, "builds": self.builds, "markers": self.markers}
+        _write_if_changed(_root_path(self.root, self.file_path), json.dumps(data, indent=1, sort_keys=True) + "\n")
+
+
+#%% Cell: 8
+"""doc
+---
+
+## Writing Outputs
+
+The conversions do not write files themselves, they hand the generated files to an output sink.
+`DirectorySink` writes them into a folder (only if their content changed), `MemorySink` keeps them in a dict and `ZipSink` packs them into a zip archive.
+The commands write into a `DirectorySink` at the project root.
+With `--check` they write into a `CheckSink` instead, which writes nothing but lists the files whose content on disk differs from the generated one.
+Images are named by the hash of their data, so for them it is enough to check that they exist.
+"""
+
+
+#%% Cell: 9
+class OutputSink(abc.ABC):
+    @abc.abstractmethod
+    def exists(self, file_path: str) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def write(self, file_path: str, content) -> bool:
+        pass
+
+    def write_image(self, image) -> bool:
+        if self.exists(image.path):
+            return False
+        return self.write(image.path, image.to_bytes())
+
+
+class DirectorySink(OutputSink):
+    """Write the generated files into a folder, files whose content did not change are not touched.
+
+    :param root: The folder the paths of the generated files are relative to, defaults to ".".
+    :type root: str, optional
+    """
+    def __init__(self, root: str = "."):
+        self.root = root
+
+    def _path(self, file_path: str) -> str:
+        return file_path if self.root == "." else os.path.join(self.root, file_path)
+
+    def exists(self, file_path: str) -> bool:
+        return os.path.exists(self._path(file_path))
+
+    def write(self, file_path: str, content: str) -> bool:
+        return _write_if_changed(self._path(file_path), content)
+
+    def write_image(self, image) -> bool:
+        with Timings.measure("images"):
+            file_path = self._path(image.path)
+            if os.path.exists(file_path):
+                return False
+            folder = os.path.dirname(file_path)
+            os.makedirs(folder, exist_ok=True)
+            fd, tmp_path = _create_temp_file(folder)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    image.write_to(f)
+                os.replace(tmp_path, file_path)
+                Timings.written(file_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            return True
+
+
+class MemorySink(OutputSink):
+    """Collect the generated files in `files`, a dict from path to content (str for text files, bytes for images)."""
+    def __init__(self):
+        self.files = {}
+
+    def exists(self, file_path: str) -> bool:
+        return file_path in self.files
+
+    def write(self, file_path: str, content) -> bool:
+        if self.files.get(file_path) == content:
+            return False
+        self.files[file_path] = content
+        return True
+
+
+class CheckSink(OutputSink):
+    """Write nothing, but collect the generated files that are missing or differ from the files in a folder in `stale_files`.
+
+    :param root: The folder the paths of the generated files are relative to, defaults to ".".
+    :type root: str, optional
+    """
+    def __init__(self, root: str = "."):
+        self.root = root
+        self.stale_files = []
+
+    def _path(self, file_path: str) -> str:
+        return file_path if self.root == "." else os.path.join(self.root, file_path)
+
+    def exists(self, file_path: str) -> bool:
+        return os.path.exists(self._path(file_path))
+
+    def write(self, file_path: str, content) -> bool:
+        with Timings.measure("check files"):
+            mode, encoding = ("r", "utf8") if isinstance(content, str) else ("rb", None)
+            try:
+                with open(self._path(file_path), mode, encoding=encoding) as f:
+                    Timings.read(self._path(file_path))
+                    if f.read() == content:
+                        return False
+            except FileNotFoundError:
+                pass
+            self.stale_files.append(file_path)
+            return True
+
+    def write_image(self, image) -> bool:
+        if self.exists(image.path):
+            return False
+        self.stale_files.append(image.path)
+        return True
+
+
+class ZipSink(OutputSink):
+    """Write the generated files into a new zip archive, use it as a context manager or call `close` when done.
+
+    :param file_path: The path of the zip archive.
+    :type file_path: str
+    """
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.archive = zipfile.ZipFile(file_path, "w", zipfile.ZIP_DEFLATED)
+        self.hashes = {}
+
+    def exists(self, file_path: str) -> bool:
+        return file_path in self.hashes
+
+    def write(self, file_path: str, content) -> bool:
+        if isinstance(content, str):
+            content = content.encode("utf8")
+        digest = _hash_bytes(content)
+        if self.hashes.get(file_path) == digest:
+            return False
+        if file_path in self.hashes:
+            raise ValueError(f"Cannot overwrite {file_path} in {self.file_path}.")
+        self.archive.writestr(file_path, content)
+        self.hashes[file_path] = digest
+        return True
+
+    def write_image(self, image) -> bool:
+        if self.exists(image.path):
+            return False
+        with self.archive.open(image.path, "w") as f:
+            image.write_to(f)
+        self.hashes[image.path] = None
+        return True
+
+    def close(self) -> None:
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+#%% Cell: 10
+"""doc
+---
+
+## Measuring Timings
+
+To find out where the time goes, the conversions are instrumented with named phases (e.g. reading notebooks, extracting docstrings or writing files) and count the bytes and files they read and write.
+Per file the time of its conversion is recorded as well.
+The measurements are disabled by default, in which case a phase costs not more than entering an empty context manager.
+Phases can be nested, so the time of a phase includes the phases it contains, and the phases of parallel workers are summed up.
+"""
+
+
+#%% Cell: 11
+class Timings(object):
+    enabled = False
+    phases = {}
+    files = {}
+    counters = {"bytes_read": 0, "files_read": 0, "bytes_written": 0, "files_written": 0}
+    _disabled = contextlib.nullcontext()
+
+    @staticmethod
+    def reset(enabled: bool = False) -> None:
+        Timings.enabled = enabled
+        Timings.phases = {}
+        Timings.files = {}
+        Timings.counters = {"bytes_read": 0, "files_read": 0, "bytes_written": 0, "files_written": 0}
+
+    @staticmethod
+    def measure(phase: str, file_path: Optional[str] = None):
+        if not Timings.enabled:
+            return Timings._disabled
+        return Timings._measure(phase, file_path)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _measure(phase: str, file_path: Optional[str]):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            Timings._add(phase, time.perf_counter() - start, 1, file_path)
+
+    @staticmethod
+    def _add(phase: str, seconds: float, calls: int, file_path: Optional[str] = None) -> None:
+        stats = Timings.phases.setdefault(phase, [0.0, 0])
+        stats[0] += seconds
+        stats[1] += calls
+        if file_path is not None:
+            file_phases = Timings.files.setdefault(file_path, {})
+            file_phases[phase] = file_phases.get(phase, 0.0) + seconds
+
+    @staticmethod
+    def read(file_path: str) -> None:
+        if Timings.enabled:
+            Timings.counters["bytes_read"] += os.path.getsize(file_path)
+            Timings.counters["files_read"] += 1
+
+    @staticmethod
+    def written(file_path: str) -> None:
+        if Timings.enabled:
+            Timings.counters["bytes_written"] += os.path.getsize(file_path)
+            Timings.counters["files_written"] += 1
+
+    @staticmethod
+    def to_dict() -> Dict:
+        return {
+            "phases": {phase: {"seconds": seconds, "calls": calls} for phase, (seconds, calls) in Timings.phases.items()},
+            "files": Timings.files,
+            "counters": Timings.counters,
+        }
+
+    @staticmethod
+    def merge(timings: Dict) -> None:
+        for phase, stats in timings["phases"].items():
+            Timings._add(phase, stats["seconds"], stats["calls"])
+        for file_path, file_phases in timings["files"].items():
+            for phase, seconds in file_phases.items():
+                Timings.files.setdefault(file_path, {})
+                Timings.files[file_path][phase] = Timings.files[file_path].get(phase, 0.0) + seconds
+        for key, value in timings["counters"].items():
+            Timings.counters[key] += value
+
+    @staticmethod
+    def format_table(slowest_files: int = 10) -> str:
+        lines = [f"{'phase':<24}{'calls':>8}{'seconds':>10}"]
+        for phase, (seconds, calls) in sorted(Timings.phases.items(), key=lambda item: -item[1][0]):
+            lines.append(f"{phase:<24}{calls:>8}{seconds:>10.3f}")
+        counters = Timings.counters
+        size = lambda num_bytes: f"{num_bytes / 2**20:.1f} MB" if num_bytes >= 2**20 else f"{num_bytes / 2**10:.1f} KB"
+        lines.append(f"Read {size(counters['bytes_read'])} from {counters['files_read']} file(s), wrote {size(counters['bytes_written'])} to {counters['files_written']} file(s).")
+        files = sorted(Timings.files.items(), key=lambda item: -sum(item[1].values()))[:slowest_files]
+        if len(files) > 0:
+            lines.append(f"Slowest files:")
+            for file_path, file_phases in files:
+                lines.append(f"{sum(file_phases.values()):10.3f}s  {file_path}")
+        return "\n".join(lines)
+
+
+#%% Cell: 12
+"""doc
+---
+
+## Running Conversions in Parallel
+
+Every file is converted independently, so the conversions can run in a pool of worker processes.
+To keep the console output the same as in a serial run, the messages of a worker are captured and returned together with the result, so they can be printed in the original order.
+The conversions write their messages with `_log`, which `capture_output` sends to a stream for the current thread only, so a thread that captures the output of a build (e.g. in the daemon) does not get what other threads print.
+An exception in one conversion does not abort the others, it is collected and all errors are reported at the end with a `ConversionError`.
+Forking a process that runs other threads (e.g. the daemon) can deadlock the workers on locks those threads held while forking, so then the workers are started by a fork server (or spawned where there is none).
+"""
+
+
+#%% Cell: 13
+_output = threading.local()
+
+
+def _log(*args, **kwargs) -> None:
+    # Like print, but into the stream captured by the current thread (if any).
+    print(*args, file=getattr(_output, "stream", None), **kwargs)
+
+
+@contextlib.contextmanager
+def capture_output(stream):
+    """Write the messages of the conversions run by the current thread to a stream instead of stdout.
+
+    :param stream: The stream for the messages, e.g. an `io.StringIO`.
+    """
+    previous = getattr(_output, "stream", None)
+    _output.stream = stream
+    try:
+        yield stream
+    finally:
+        _output.stream = previous
+
+
+class ConversionError(RuntimeError):
+    def __init__(self, errors: List, message: Optional[str] = None):
+        self.errors = errors
+        if message is None:
+            message = f"Failed to convert {len(errors)} file(s): " + ", ".join(file_path for file_path, _ in errors)
+        super().__init__(message)
+
+
+class OutOfDateError(ConversionError):
+    def __init__(self, stale_files: List[str], errors: Optional[List] = None):
+        self.stale_files = stale_files
+        errors = errors if errors is not None else []
+        message = f"{len(stale_files)} generated file(s) are out of date: " + ", ".join(stale_files)
+        if len(errors) > 0:
+            message += f" (and {len(errors)} file(s) failed to convert)"
+        super().__init__(errors, message)
+
+
+def _call_captured(function, arg):
+    output = io.StringIO()
+    try:
+        with capture_output(output):
+            result = function(arg)
+        return result, None, output.getvalue()
+    except Exception:
+        return None, traceback.format_exc(), output.getvalue()
+
+
+def _call_worker(function, arg, timings: bool):
+    # Workers measure their own timings, which are merged by the main process.
+    Timings.reset(timings)
+    return _call_captured(function, arg), Timings.to_dict() if timings else None
+
+
+def _run_parallel(function, args: List, jobs: Optional[int] = None) -> List:
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1 or len(args) <= 1:
+        return [_call_captured(function, arg) for arg in args]
+    context = None
+    if threading.active_count() > 1:
+        context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(args)), mp_context=context) as pool:
+        results = list(pool.map(_call_worker, [function] * len(args), args, [Timings.enabled] * len(args)))
+    for _, timings in results:
+        if timings is not None:
+            Timings.merge(timings)
+    return [captured for captured, _ in results]
+
+
+def _run_filtered(function, args: List, accept, skipped_result, jobs: Optional[int] = None) -> List:
+    # Arguments rejected by accept are not sent to the workers, they get skipped_result as their result.
+    accepted = [arg for arg in args if accept(arg)]
+    results = dict(zip(accepted, _run_parallel(function, accepted, jobs)))
+    return [results.get(arg, (skipped_result, None, "")) for arg in args]
+
+
+def _report_errors(errors: List) -> None:
+    if len(errors) == 0:
+        return
+    for file_path, error in errors:
+        _log("ERROR: Failed to convert {}:\n{}".format(file_path, error))
+    raise ConversionError(errors)
+
+
+def _report_stale_files(stale_files: List[str], errors: List) -> None:
+    # Images shared by several pages are only listed once.
+    stale_files = list(dict.fromkeys(stale_files))
+    for file_path in stale_files:
+        _log("Out of date: {}".format(file_path))
+    if len(stale_files) == 0:
+        _report_errors(errors)
+        return
+    for file_path, error in errors:
+        _log("ERROR: Failed to convert {}:\n{}".format(file_path, error))
+    raise OutOfDateError(stale_files, errors)
+
+
+#%% Cell: 14
 """doc
 ---
 
@@ -122,172 +981,802 @@ A notebook is a json file with a list of cells of different types (e.g. code and
 Cells wich start with a comment of `#export` will be converted and any notebook containing these cells will be convertible.
 
 So first we want to write a set of helper functions to identify the different types of cells that we will later modify.
+
+All rules live in `Cell.classify`, which tags a cell by the first line of its source:
+* `EXPORT`: code cells starting with `#export`, they become the python file and are documented.
+* `DOC`: markdown cells (unless they start with `#hide` or `<!-- hide -->`), they become doc strings in the python file and the text of the docs.
+* `CONVERT`: code cells starting with `#convert` or `#example`, which only mark the notebook.
+* `EXAMPLE`: all other code cells (unless they start with `#hide`), they are shown as examples in the docs.
+* `HIDDEN`: everything else (hidden and empty cells, raw cells).
+
+The converters do not look at the cells directly, they classify every cell of a notebook once into a `CellRecord` with its tag, its joined source and its index among the exported cells.
 """
 
 
-#%% Cell: 6
+#%% Cell: 15
+class CellTag(enum.Enum):
+    EXPORT = "export"
+    DOC = "doc"
+    EXAMPLE = "example"
+    CONVERT = "convert"
+    HIDDEN = "hidden"
+
+
 class Cell(object):
     @staticmethod
-    def _is_non_empty_code_cell(cell) -> bool:
-        return cell["cell_type"] == "code" and len(cell["source"]) > 0
+    def classify(cell) -> CellTag:
+        source = cell["source"]
+        if len(source) == 0:
+            return CellTag.HIDDEN
+        first_line = source[0] if isinstance(source, list) else source
+        if cell["cell_type"] == "code":
+            if first_line.startswith("#export"):
+                return CellTag.EXPORT
+            if first_line.startswith("#hide"):
+                return CellTag.HIDDEN
+            if first_line.startswith("#convert") or first_line.startswith("#example"):
+                return CellTag.CONVERT
+            return CellTag.EXAMPLE
+        if cell["cell_type"] == "markdown":
+            if first_line.startswith("#hide") or first_line.startswith("<!-- hide -->"):
+                return CellTag.HIDDEN
+            return CellTag.DOC
+        return CellTag.HIDDEN
 
     @staticmethod
     def is_code_export(cell) -> bool:
-        return Cell._is_non_empty_code_cell(cell) and cell["source"][0].startswith("#export")
+        return Cell.classify(cell) is CellTag.EXPORT
 
     @staticmethod
     def is_code_example(cell) -> bool:
-        return Cell._is_non_empty_code_cell(cell) and not cell["source"][0].startswith("#hide") and not cell["source"][0].startswith("#export")
-
-    @staticmethod
-    def _is_non_empty_markdown_cell(cell) -> bool:
-        return cell["cell_type"] == "markdown" and len(cell["source"]) > 0
+        return Cell.classify(cell) in (CellTag.EXAMPLE, CellTag.CONVERT)
 
     @staticmethod
     def is_md_export(cell) -> bool:
-        return Cell._is_non_empty_markdown_cell(cell) and not cell["source"][0].startswith("#hide") and not cell["source"][0].startswith("<!-- hide -->")
+        return Cell.classify(cell) is CellTag.DOC
 
 
-#%% Cell: 7
+class CellRecord(object):
+    __slots__ = ("tag", "source", "export_index", "cell")
+
+    def __init__(self, tag: CellTag, source: str, export_index: Optional[int], cell: Dict):
+        self.tag = tag
+        self.source = source
+        self.export_index = export_index
+        self.cell = cell
+
+
+def classify_cells(cells: List[Dict]) -> List[CellRecord]:
+    """Classify the cells of a notebook.
+
+    :param cells: The cells of the notebook.
+    :type cells: List[Dict]
+    :return: A record per cell with its tag, its source as a string, its index among the exported (EXPORT and DOC) cells (None for other cells) and the cell itself.
+    :rtype: List[CellRecord]
+    """
+    records = []
+    export_index = 0
+    for cell in cells:
+        tag = Cell.classify(cell)
+        source = cell["source"] if isinstance(cell["source"], str) else "".join(cell["source"])
+        if tag is CellTag.EXPORT or tag is CellTag.DOC:
+            records.append(CellRecord(tag, source, export_index, cell))
+            export_index += 1
+        else:
+            records.append(CellRecord(tag, source, None, cell))
+    return records
+
+
+#%% Cell: 16
+"""doc
+---
+
+## Reading Notebooks
+
+Notebooks can be huge because of their outputs (plots are base64 encoded images and training loops print long logs).
+Converting a notebook to python only needs the sources of the cells, so parsing the whole notebook with `json.loads` wastes time and memory.
+
+Instead the notebook file is read in chunks and scanned with a small streaming json reader.
+Values we need (like the source of a cell) are parsed with `json.loads` one at a time, values we do not need (the outputs) are skipped by only looking for the brackets and quotes that delimit them, without ever creating python objects for them or keeping them in memory.
+This way the memory needed to convert a notebook to python scales with the size of its sources and not with the size of its outputs.
+"""
+
+
+#%% Cell: 17
+"""doc
+If [orjson](https://github.com/ijl/orjson) is installed (`pip install jlabdev[fast]`), it is used to parse json, otherwise the `json` module of the standard library.
+Json is parsed from bytes, so a file does not have to be decoded into a string first (orjson is only used for files up to 64 MB, since it keeps a copy of the whole document while parsing).
+orjson reads integers that do not fit into 64 bit as floats, so json that contains such a number is parsed by the `json` module, which keeps them exact.
+
+Notebooks are written in the format of jupyter (sorted keys, an indent of 1 and unicode characters not escaped), byte for byte the same as `json.dumps(notebook, sort_keys=True, indent=1, ensure_ascii=False)`, so diffs stay clean.
+Instead of building the whole string in memory, the json is written in small chunks while walking the notebook and the strings (which is where the bulk of the data is) are encoded by orjson or the C encoder of the `json` module.
+"""
+
+
+#%% Cell: 18
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# orjson keeps a copy of the whole document while parsing, for huge notebooks the json module needs less memory and is as fast.
+ORJSON_MAX_SIZE = 64 << 20
+# Integers outside of the 64 bit range of orjson (any with 20 digits, or 19 if negative), which it would turn into floats.
+_WIDE_INTEGER_PATTERN = re.compile(rb"(?<![\d.])(?:-\d{19}|\d{20})\d*(?![\d.eE])")
+
+
+def _json_loads(data: bytes):
+    if orjson is not None and len(data) <= ORJSON_MAX_SIZE and _WIDE_INTEGER_PATTERN.search(data) is None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # e.g. NaN, which only the json module supports
+    return json.loads(data)
+
+
+def _json_load(f):
+    data = f.read()
+    if orjson is not None and len(data) <= ORJSON_MAX_SIZE:
+        return _json_loads(data)
+    # Only keep the decoded string while parsing and not the bytes as well.
+    data = data.decode("utf8")
+    return json.loads(data)
+
+
+if orjson is not None:
+    _encode_json_string = orjson.dumps
+else:
+    def _encode_json_string(value: str) -> bytes:
+        return json.encoder.encode_basestring(value).encode("utf8")
+
+
+class _JsonWriter(object):
+    BUFFER_SIZE = 1 << 16
+
+    def __init__(self, f, indent: int = 1, sort_keys: bool = True):
+        self.f = f
+        self.indent = indent
+        self.sort_keys = sort_keys
+        self.parts = []
+        self.size = 0
+
+    def emit(self, data: bytes) -> None:
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= self.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        self.f.write(b"".join(self.parts))
+        self.parts = []
+        self.size = 0
+
+    def write(self, value, level: int = 0) -> None:
+        if isinstance(value, str):
+            self.emit(_encode_json_string(value))
+        elif isinstance(value, dict):
+            if len(value) == 0:
+                self.emit(b"{}")
+                return
+            newline = b"\n" + b" " * (self.indent * (level + 1))
+            items = sorted(value.items()) if self.sort_keys else value.items()
+            separator = b"{"
+            for key, item in items:
+                if not isinstance(key, str):
+                    key = json.dumps(key)
+                self.emit(separator + newline + _encode_json_string(key) + b": ")
+                self.write(item, level + 1)
+                separator = b","
+            self.emit(b"\n" + b" " * (self.indent * level) + b"}")
+        elif isinstance(value, (list, tuple)):
+            if len(value) == 0:
+                self.emit(b"[]")
+                return
+            newline = b"\n" + b" " * (self.indent * (level + 1))
+            end = b"\n" + b" " * (self.indent * level) + b"]"
+            if all(isinstance(item, str) for item in value):
+                # Fast path for the lines of sources and outputs.
+                self.emit(b"[" + newline + (b"," + newline).join(map(_encode_json_string, value)) + end)
+                return
+            separator = b"["
+            for item in value:
+                self.emit(separator + newline)
+                self.write(item, level + 1)
+                separator = b","
+            self.emit(end)
+        else:
+            self.emit(json.dumps(value).encode("utf8"))
+
+
+def write_notebook(file_path: str, notebook: Dict) -> None:
+    """Write a notebook file in the format of jupyter.
+
+    The file is replaced atomically and keeps its permissions.
+
+    :param file_path: The path of the notebook.
+    :type file_path: str
+    :param notebook: The notebook as parsed from the json.
+    :type notebook: Dict
+    """
+    folder = os.path.dirname(file_path)
+    fd, tmp_path = _create_temp_file(folder if folder != "" else ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            writer = _JsonWriter(f)
+            writer.write(notebook)
+            writer.emit(b"\n")
+            writer.flush()
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, tmp_path)
+        os.replace(tmp_path, file_path)
+        Timings.written(file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+#%% Cell: 19
+SKIPPED_CELL_KEYS = ["outputs", "attachments"]
+
+
+class _JsonStream(object):
+    _WHITESPACE = re.compile(rb"[ \t\n\r]*")
+    _STRUCTURE = re.compile(rb'["\[\]{}]')
+    _SCALAR = re.compile(rb"[^,:\]}\s]*")
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, f):
+        self.file = f
+        self.buffer = b""
+        self.pos = 0
+        self.mark = None
+        self.offset = 0
+
+    def _fill(self) -> bool:
+        chunk = self.file.read(self.CHUNK_SIZE)
+        if len(chunk) == 0:
+            return False
+        # Everything before the current position (or the start of the value being read) is not needed anymore.
+        keep = self.pos if self.mark is None else self.mark
+        self.buffer = self.buffer[keep:] + chunk
+        self.offset += keep
+        self.pos -= keep
+        if self.mark is not None:
+            self.mark = 0
+        return True
+
+    def peek(self) -> bytes:
+        while True:
+            self.pos = self._WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos:self.pos+1]
+
+    def tell(self) -> int:
+        return self.offset + self.pos
+
+    def expect(self, token: bytes) -> None:
+        if self.peek() != token:
+            raise ValueError(f"Invalid json: expected {token.decode()} but found {self.peek()}.")
+        self.pos += 1
+
+    def _skip_string(self) -> None:
+        self.pos += 1
+        while True:
+            end = self.buffer.find(b'"', self.pos)
+            if end < 0:
+                # Keep trailing backslashes, they decide if a quote at the start of the next chunk is escaped.
+                self.pos = len(self.buffer)
+                while self.pos > 0 and self.buffer[self.pos - 1] == ord("\\"):
+                    self.pos -= 1
+                if not self._fill():
+                    raise ValueError("Invalid json: unterminated string.")
+                continue
+            backslashes = 0
+            while end - backslashes > 0 and self.buffer[end - backslashes - 1] == ord("\\"):
+                backslashes += 1
+            self.pos = end + 1
+            if backslashes % 2 == 0:
+                return
+
+    def _skip_container(self) -> None:
+        depth = 0
+        while True:
+            match = self._STRUCTURE.search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                if not self._fill():
+                    raise ValueError("Invalid json: unexpected end of file.")
+                continue
+            self.pos = match.start()
+            token = match.group()
+            if token == b'"':
+                self._skip_string()
+                continue
+            self.pos += 1
+            depth += 1 if token == b"{" or token == b"[" else -1
+            if depth == 0:
+                return
+
+    def _skip_scalar(self) -> None:
+        while True:
+            end = self._SCALAR.match(self.buffer, self.pos).end()
+            if end < len(self.buffer) or not self._fill():
+                break
+        if end == self.pos:
+            raise ValueError(f"Invalid json: unexpected {self.peek()}.")
+        self.pos = end
+
+    def skip_value(self) -> None:
+        token = self.peek()
+        if token == b'"':
+            self._skip_string()
+        elif token == b"{" or token == b"[":
+            self._skip_container()
+        else:
+            self._skip_scalar()
+
+    def read_value(self):
+        self.peek()
+        self.mark = self.pos
+        try:
+            self.skip_value()
+            return _json_loads(self.buffer[self.mark:self.pos])
+        finally:
+            self.mark = None
+
+    def keys(self):
+        self.expect(b"{")
+        if self.peek() == b"}":
+            self.pos += 1
+            return
+        while True:
+            if self.peek() != b'"':
+                raise ValueError(f"Invalid json: expected a key but found {self.peek()}.")
+            key = self.read_value()
+            self.expect(b":")
+            yield key
+            if self.peek() == b",":
+                self.pos += 1
+                continue
+            self.expect(b"}")
+            return
+
+    def elements(self):
+        self.expect(b"[")
+        if self.peek() == b"]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.peek() == b",":
+                self.pos += 1
+                continue
+            self.expect(b"]")
+            return
+
+
+def _read_cells(stream: _JsonStream, source_spans: Optional[List] = None):
+    for _ in stream.elements():
+        cell = {}
+        for key in stream.keys():
+            if key in SKIPPED_CELL_KEYS:
+                stream.skip_value()
+            elif key == "source" and source_spans is not None:
+                stream.peek()
+                start = stream.tell()
+                cell[key] = stream.read_value()
+                source_spans.append((start, stream.tell()))
+            else:
+                cell[key] = stream.read_value()
+        yield cell
+
+
+@contextlib.contextmanager
+def _open_json_stream(file_path: str):
+    with open(file_path, "rb") as f:
+        yield _JsonStream(f)
+
+
+def read_notebook(file_path: str, load_outputs: bool = True) -> Dict:
+    """Read a notebook file.
+
+    :param file_path: The path of the notebook.
+    :type file_path: str
+    :param load_outputs: Also load the outputs and attachments of the cells, defaults to True. Without them only the sources of the notebook are held in memory.
+    :type load_outputs: bool, optional
+    :return: The notebook as parsed from the json.
+    :rtype: Dict
+    """
+    if load_outputs:
+        with open(file_path, "rb") as f:
+            return _json_load(f)
+    notebook = {}
+    with _open_json_stream(file_path) as stream:
+        for key in stream.keys():
+            if key == "cells":
+                notebook["cells"] = list(_read_cells(stream))
+            else:
+                notebook[key] = stream.read_value()
+    return notebook
+
+
+#%% Cell: 20
+"""doc
+Whether a notebook is converted at all depends on the first line of its cells: notebooks with a cell starting with `#export` are converted to python and docs, notebooks with a markdown cell starting with `# Example` only to docs.
+Before parsing a notebook, its file is mapped into memory and searched for these markers as they appear in the json (e.g. `"#export`), which is many times faster than parsing it.
+A marker can also appear elsewhere (e.g. in an output), so a notebook containing one is still parsed to be sure, but a notebook without any of them can be skipped right away.
+"""
+
+
+#%% Cell: 21
+NOTEBOOK_MARKERS = {"export": [b'"#export'], "example": [b'"# Example', b'"#Example']}
+
+
+def _scan_notebook_markers(file_path: str) -> frozenset:
+    with Timings.measure("scan markers"):
+        Timings.read(file_path)
+        with open(file_path, "rb") as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return frozenset()  # An empty file cannot be mapped.
+            with data:
+                return frozenset(marker for marker, patterns in NOTEBOOK_MARKERS.items() if any(data.find(pattern) != -1 for pattern in patterns))
+
+
+#%% Cell: 22
 """doc
 ---
 
 ## Converting Notebook to Python
 
-To convert the notebook to python, we first load it and then collect all code and documentation cells and merge them into a single code string that is written next to the notebook.
+To convert the notebook to python, we first load it (without the outputs) and then collect all code and documentation cells and merge them into a single code string that is written next to the notebook.
 """
 
 
-#%% Cell: 8
+#%% Cell: 23
 class Notebook(dict):
-    def __init__(self, file_path: str):
-        with open(file_path, "r", encoding="utf8") as f:
-            super().__init__(json.loads(f.read()))
+    def __init__(self, file_path: str, load_outputs: bool = True, content=None, root: str = "."):
+        self.stat = None
+        with Timings.measure("read notebooks"):
+            if content is None:
+                # The stat is taken before reading, so a notebook saved while it is read looks changed afterwards.
+                self.stat = os.stat(_root_path(root, file_path))
+                Timings.read(_root_path(root, file_path))
+                content = read_notebook(_root_path(root, file_path), load_outputs)
+            elif isinstance(content, (bytes, str)):
+                content = _json_loads(content)
+            super().__init__(content)
         self.file_path = file_path
+        self.root = root
+        self._records = None
 
-    def is_code_notebook(self) -> bool:
-        for cell in self["cells"]:
-            if Cell.is_code_export(cell):
-                return True
-        return False
+    def records(self) -> List[CellRecord]:
+        if self._records is None:
+            self._records = classify_cells(self["cells"])
+        return self._records
 
-    def to_python(self) -> bool:
-        if not self.is_code_notebook():
-            return False
+    def is_code_notebook(self) -> bool:
+        return any(record.tag is CellTag.EXPORT for record in self.records())
 
-        code_cells = ["# AUTOGENERATED FROM: {}".format(self.file_path)]
-        for cell in self["cells"]:
-            cell_idx = len(code_cells) - 1
-            if Cell.is_code_export(cell):
-                code = "".join(cell["source"])
-                code = code.replace("#export", f"#%% Cell: {cell_idx}", 1)
+    def _python_cells(self):
+        # Yields the index of every exported cell in the notebook and its code in the python file.
+        for cell_index, record in enumerate(self.records()):
+            if record.tag is CellTag.EXPORT:
+                code = record.source.replace("#export", f"#%% Cell: {record.export_index}", 1)
                 while code.endswith("\n"):
                     code = code[:-2]
-                code_cells.append(code)
-            elif Cell.is_md_export(cell):    
-                code = f"#%% Cell: {cell_idx}\n"
+                yield cell_index, code
+            elif record.tag is CellTag.DOC:
+                code = f"#%% Cell: {record.export_index}\n"
                 code += "\"\"\"doc\n" # start doc comment
-                code += "".join(cell["source"])
+                code += record.source
                 while code.endswith("\n"):
                     code = code[:-2]
                 code += "\n\"\"\""
-                code_cells.append(code)
-            else:
-                continue
+                yield cell_index, code
+
+    def python_code(self) -> Optional[str]:
+        if not self.is_code_notebook():
+            return None
+
+        code_cells = ["# AUTOGENERATED FROM: {}".format(self.file_path)]
+        code_cells.extend(code for _, code in self._python_cells())
         
         # One new line for inside cell and then two empty lines
         # Add another newline at the end of the document
-        code = "\n\n\n".join(code_cells) + "\n"
+        return "\n\n\n".join(code_cells) + "\n"
 
-        with open(self.file_path.replace(".ipynb", ".py"), "w", encoding="utf8") as f:
-            f.write(code)
-        
+    def source_map(self, code: Optional[str] = None) -> Optional["SourceMap"]:
+        """Map the lines of the generated python file to the cells of the notebook.
+
+        :param code: The generated python code, its hash is stored in the map to detect edits of the python file. Defaults to None.
+        :type code: str, optional
+        :return: The map or None if the notebook has no exported cells.
+        :rtype: SourceMap
+        """
+        if not self.is_code_notebook():
+            return None
+        cells = []
+        line = 4  # After the header and two empty lines.
+        for cell_index, cell_code in self._python_cells():
+            n_lines = cell_code.count("\n") + 1
+            if self.records()[cell_index].tag is CellTag.EXPORT:
+                # The marker replaces the first line of the cell.
+                cells.append([line, line + n_lines - 1, cell_index, self["cells"][cell_index].get("id"), 1])
+            else:
+                # The markdown starts after the marker and the opening quotes and ends before the closing quotes.
+                cells.append([line, line + n_lines - 2, cell_index, self["cells"][cell_index].get("id"), -1])
+            line += n_lines + 2
+        notebook_stat = [self.stat.st_size, self.stat.st_mtime_ns] if self.stat is not None else None
+        python_hash = _hash_bytes(code.encode("utf8")) if code is not None else None
+        return SourceMap(self.file_path, self.file_path.replace(".ipynb", ".py"), cells, python_hash, notebook_stat)
+
+    def to_python(self, sink: Optional[OutputSink] = None) -> bool:
+        code = self.python_code()
+        if code is None:
+            return False
+        if sink is None:
+            sink = DirectorySink(self.root)
+            # Only python files written into the project get a source map.
+            self.source_map(code).save(self.root)
+        sink.write(self.file_path.replace(".ipynb", ".py"), code)
         return True
 
 
-#%% Cell: 9
+#%% Cell: 24
+"""doc
+Tracebacks and linters point at lines of the python file, but the code lives in the notebook.
+So when a python file is written into the project, a `SourceMap` is saved to `.jlabdev/source_maps/<python file>.json`.
+It maps the range of lines of every exported cell to the index (and id) of the cell in the notebook and the line of the cell at the start of the range.
+It also stores the hash of the python file and the size and modification time of the notebook it was generated from, so edits of either are detected.
+
+`jlabdev locate pkg/module.py:123` (see [jlabdev.client](client.md)) looks up the cell of a line in the map, the docs link the exported cells to their lines in the map and py2nb skips python files which were not edited since they were generated from the notebook as it is.
+"""
+
+
+#%% Cell: 25
+SOURCE_MAPS_FOLDER = os.path.join(".jlabdev", "source_maps")
+SOURCE_MAP_VERSION = 1
+
+
+class SourceMap(object):
+    def __init__(self, notebook: str, python: str, cells: List[List], python_hash: Optional[str] = None, notebook_stat: Optional[List[int]] = None):
+        self.notebook = notebook
+        self.python = python
+        # [first line, last line, cell index, cell id, line of the cell at the first line] per exported cell in the order of the python file.
+        # Lines start at 1, the marker and opening quotes of a markdown cell are mapped to lines before its first line.
+        self.cells = cells
+        self.python_hash = python_hash
+        self.notebook_stat = notebook_stat
+
+    @staticmethod
+    def path(python_path: str) -> str:
+        return os.path.join(SOURCE_MAPS_FOLDER, python_path + ".json")
+
+    def cell_start(self, export_index: int) -> int:
+        return self.cells[export_index][0]
+
+    def is_current(self) -> bool:
+        # The python file was not edited and the notebook not saved since the python file was generated.
+        if self.python_hash is None or self.notebook_stat is None:
+            return False
+        try:
+            stat = os.stat(self.notebook)
+            if [stat.st_size, stat.st_mtime_ns] != self.notebook_stat:
+                return False
+            Timings.read(self.python)
+            with open(self.python, "rb") as f:
+                return _hash_bytes(f.read()) == self.python_hash
+        except OSError:
+            return False
+
+    def to_dict(self) -> Dict:
+        return {"version": SOURCE_MAP_VERSION, "notebook": self.notebook, "python": self.python, "python_hash": self.python_hash, "notebook_stat": self.notebook_stat, "cells": self.cells}
+
+    def save(self, root: str = ".") -> None:
+        _write_if_changed(_root_path(root, SourceMap.path(self.python)), json.dumps(self.to_dict(), separators=(",", ":")) + "\n")
+
+    @staticmethod
+    def load(python_path: str) -> Optional["SourceMap"]:
+        try:
+            with open(SourceMap.path(python_path), "rb") as f:
+                data = _json_load(f)
+            if data.get("version") != SOURCE_MAP_VERSION:
+                return None
+            return SourceMap(data["notebook"], data["python"], data["cells"], data["python_hash"], data["notebook_stat"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def generate(python_path: str) -> "SourceMap":
+        """Generate the source map of a python file from its notebook, e.g. if nb2py did not save one.
+
+        :param python_path: The path of the generated python file.
+        :type python_path: str
+        :return: The source map of the python file as the notebook would generate it now.
+        :rtype: SourceMap
+        """
+        with open(python_path, "r", encoding="utf8") as f:
+            header = f.readline()
+        if not header.startswith("# AUTOGENERATED FROM: "):
+            raise ValueError(f"{python_path} is not generated from a notebook.")
+        notebook = Notebook(header[len("# AUTOGENERATED FROM: "):].rstrip("\n"), load_outputs=False)
+        source_map = notebook.source_map(notebook.python_code())
+        if source_map is None:
+            raise ValueError(f"{notebook.file_path} has no exported cells.")
+        return source_map
+
+    @staticmethod
+    def prune(python_paths: List[str], root: str = ".") -> None:
+        folder = _root_path(root, SOURCE_MAPS_FOLDER)
+        keep = set(_root_path(root, SourceMap.path(python_path)).replace("\\", "/") for python_path in python_paths)
+        for maps_root, dirs, files in os.walk(folder, topdown=False):
+            for f in files:
+                file_path = os.path.join(maps_root, f)
+                if f.endswith(".json") and file_path.replace("\\", "/") not in keep:
+                    os.remove(file_path)
+            if maps_root != folder and len(os.listdir(maps_root)) == 0:
+                os.rmdir(maps_root)
+
+
+#%% Cell: 26
 """doc
 The actual conversion code is very simple based on the conversion of a single notebook already implemented.
-We simply find all notebooks and then convert them to python.
+We simply find all notebooks which changed and then convert them to python in parallel.
+In check mode the notebooks are converted into a `CheckSink` instead, so nothing is written and the out of date python files are reported.
+Notebooks without an `#export` marker are not even parsed.
 """
 
 
-#%% Cell: 10
-def notebook2py() -> None:
-    """Convert all notebooks in the current working directory folder.
-    """
-    notebooks = Files.get_notebooks()
+#%% Cell: 27
+def _notebook_to_python(file_path: str, sink: Optional[OutputSink] = None, root: str = ".") -> bool:
+    with Timings.measure("to python", file_path):
+        return Notebook(file_path, load_outputs=False, root=root).to_python(sink)
+
+
+def _check_python_file(file_path: str, root: str = ".") -> List[str]:
+    sink = CheckSink(root)
+    _notebook_to_python(file_path, sink, root)
+    return sink.stale_files
+
+
+def _may_export(file_path: str, cache: BuildCache) -> bool:
+    return Files.has_markers(file_path, ["export"], cache)
+
+
+def _record_python_files(notebooks: List[str], stale: List[str], results: List, cache: BuildCache) -> List:
+    errors = []
+    for file_path, (converted, error, output) in zip(stale, results):
+        _log(output, end="")
+        if error is not None:
+            errors.append((file_path, error))
+            continue
+        outputs = [file_path.replace(".ipynb", ".py")] if converted else []
+        cache.record("nb2py:" + file_path, [file_path], outputs)
     converted = 0
     for file_path in notebooks:
-        notebook = Notebook(file_path)
-        if notebook.to_python():
+        key = "nb2py:" + file_path
+        if key in cache.builds and len(cache.get_outputs(key)) > 0:
             converted += 1
-    print(f"Converted {converted} notebook(s) to python out of {len(notebooks)} total.")
+    _log(f"Converted {converted} notebook(s) to python out of {len(notebooks)} total ({len(stale)} built, {len(notebooks) - len(stale)} skipped).")
+    return errors
 
 
-#%% Cell: 11
+def _stale_python_files(notebooks: List[str], cache: BuildCache) -> List[str]:
+    return [file_path for file_path in notebooks if not cache.is_up_to_date("nb2py:" + file_path, [file_path])]
+
+
+def _build_python_files(notebooks: List[str], cache: BuildCache, jobs: Optional[int] = None) -> List:
+    stale = _stale_python_files(notebooks, cache)
+    convert = functools.partial(_notebook_to_python, root=cache.root)
+    return _record_python_files(notebooks, stale, _run_filtered(convert, stale, functools.partial(_may_export, cache=cache), False, jobs), cache)
+
+
+def _collect_python_checks(notebooks: List[str], stale: List[str], results: List):
+    stale_files = []
+    errors = []
+    for file_path, (result, error, output) in zip(stale, results):
+        _log(output, end="")
+        if error is not None:
+            errors.append((file_path, error))
+            continue
+        stale_files.extend(result)
+    _log(f"Checked {len(stale)} notebook(s) out of {len(notebooks)} total ({len(notebooks) - len(stale)} up to date in the build cache).")
+    return stale_files, errors
+
+
+def _check_python_files(notebooks: List[str], cache: BuildCache, jobs: Optional[int] = None) -> None:
+    stale = _stale_python_files(notebooks, cache)
+    check = functools.partial(_check_python_file, root=cache.root)
+    _report_stale_files(*_collect_python_checks(notebooks, stale, _run_filtered(check, stale, functools.partial(_may_export, cache=cache), [], jobs)))
+
+
+def notebook2py(rescan: bool = True, force: bool = False, jobs: Optional[int] = None, paths: Optional[List[str]] = None, check: bool = False, root: str = ".") -> None:
+    """Convert all notebooks in the current working directory folder.
+
+    Notebooks which did not change since the last run are skipped (see BuildCache).
+
+    :param rescan: Scan the project for files again instead of reusing the files found by a previous command, defaults to True.
+    :type rescan: bool, optional
+    :param force: Ignore the build cache and convert all notebooks, defaults to False.
+    :type force: bool, optional
+    :param jobs: The number of worker processes, defaults to the number of CPUs.
+    :type jobs: int, optional
+    :param paths: Only convert these notebooks and the notebooks in these folders, defaults to the whole project.
+    :type paths: List[str], optional
+    :param check: Write nothing and raise an OutOfDateError listing the python files that are missing or differ from the generated code, defaults to False.
+    :type check: bool, optional
+    :param root: The root folder of the project, defaults to the current working directory.
+    :type root: str, optional
+    """
+    if paths is not None:
+        notebooks = Files.select(paths, root).notebooks
+    elif root != ".":
+        notebooks = Files.scan(root).notebooks
+    else:
+        if rescan:
+            Files.invalidate()
+        notebooks = Files.get_notebooks()
+    cache = BuildCache(force=force, root=root)
+    if check:
+        _check_python_files(notebooks, cache, jobs)
+        return
+    errors = _build_python_files(notebooks, cache, jobs)
+    if paths is None:
+        cache.prune("nb2py:", ["nb2py:" + file_path for file_path in notebooks])
+        SourceMap.prune([file_path.replace(".ipynb", ".py") for file_path in notebooks], root)
+    cache.save()
+    _report_errors(errors)
+
+
+#%% Cell: 28
 """doc
 ---
 
 ## Convert Python to Markdown Documentation
 
-This is actually more complicated. For this we will go through the source code line by line and find classes and functions to then find any docstrings attached to them
+This is actually more complicated. For this we parse the source code once with the `ast` module into a table of symbols (name, kind, line, signature and docstring) for all public classes and functions and the markdown doc strings.
+The markdown is then rendered from this table, converting `:param x:`, `:type x:`, `:return:` and `:rtype:` in the docstrings into lists.
 """
 
 
-#%% Cell: 12
+#%% Cell: 29
+class DocSymbol(object):
+    def __init__(self, name: str, kind: str, line: int, indent: int = 0, signature: str = "", docstring: Optional[str] = None, doc_lines: Optional[List[str]] = None):
+        self.name = name
+        self.kind = kind
+        self.line = line
+        self.indent = indent
+        self.signature = signature
+        self.docstring = docstring
+        self.doc_lines = doc_lines
+
+    def to_dict(self) -> Dict:
+        return {"name": self.name, "kind": self.kind, "line": self.line, "signature": self.signature, "docstring": self.docstring}
+
+
 class PythonDoc(object):
-    @staticmethod
-    def _is_definition(line):
-        return (line.startswith("def ") or line.startswith("class ")) and not (line.startswith("def _") or line.startswith("class _"))
+    STRING_START = re.compile(r"([rRuUbBfF]*)(\"\"\"|'''|\"|')")
+    HEADER = re.compile(r"(?:async\s+)?(?:def|class)\s+\w+\s*(\()?")
+    BLANK_LINES = re.compile(r"\n{3,}")
+    IMAGE_LINK = re.compile(r"(!\[(?:(?!\]\().)*\]\()(?!data:)", re.DOTALL)
 
     @staticmethod
     def _add_separator(doc):
         doc.append("\n\n")
 
     @staticmethod
-    def _common_header(indent, def_type, name, superclass=""):
-        level = int(indent / 4) + 1
-        header_style = "#" + ("#"*level)
-        return f"{header_style} *{def_type}* **{name}**{superclass}"
-
-    @staticmethod
-    def _add_class_doc_header(doc, line, indent):
-        superclass = ""
-        if "(" in line:
-            name, superclass = line.split(" ")[1].split("(")
-            superclass = "(" + superclass.split(")")[0] + ")"
-        else:
-            name = line.split(" ")[1].split(":")[0]
-        doc.append(PythonDoc._common_header(indent, "class", name, superclass))
-    
-    @staticmethod
-    def _add_def_doc_header(doc, line, indent):
-        fun_name, args = line.split(" ")[1].split("(")
-        doc.append(PythonDoc._common_header(indent, "def", fun_name))
-    
-    @staticmethod
-    def _add_code_link(doc, source_path_relative, line_idx):
-        if source_path_relative is not None:
-            doc[-1] += f" [[src]]({source_path_relative}#L{line_idx+1})"
-
-    @staticmethod
-    def _add_object_doc_start(doc, line):
-        line = line[3:]
-        if line.rstrip().endswith("\"\"\""):
-            PythonDoc._add_doc_string(doc, line[:-3].lstrip().rstrip())
-            return False
-        else:
-            line = line.lstrip().rstrip()
-            if line != "":
-                PythonDoc._add_doc_string(doc, line)
-            return True
+    def _common_header(indent, def_type, name, superclass=""):
+        level = int(indent / 4) + 1
+        header_style = "#" + ("#"*level)
+        return f"{header_style} *{def_type}* **{name}**{superclass}"
 
     @staticmethod
-    def _add_doc_end(doc, line):
-        line = line[:-3].rstrip()
-        if line != "":
-            PythonDoc._add_doc_string(doc, line)
+    def _add_code_link(doc, source_path_relative, line_idx):
+        if source_path_relative is not None:
+            doc[-1] += f" [[src]]({source_path_relative}#L{line_idx+1})"
 
     @staticmethod
     def _add_doc_string(doc, line):
@@ -306,7 +1795,7 @@ class PythonDoc(object):
                 new_param_header = f"* **{param_name}** *({param_type})*:"
                 doc[-1] = doc[-1].replace(old_param_header, new_param_header)
             else:
-                print("ERROR: Invalid doc format, ':param X:' must come before ':type X:'.")
+                _log("ERROR: Invalid doc format, ':param X:' must come before ':type X:'.")
         # :return: is an easy replace.
         elif line.lstrip().startswith(":return:"):
             doc.append(line.replace(":return:", "* **returns**:"))
@@ -318,107 +1807,220 @@ class PythonDoc(object):
                 new_param_header = f"* **returns** *({line})*:"
                 doc[-1] = doc[-1].replace(old_param_header, new_param_header)
             else:
-                print("ERROR: Invalid doc format, ':return:' must come before ':rtype:'.")
+                _log("ERROR: Invalid doc format, ':return:' must come before ':rtype:'.")
         else:
             doc.append(line)
 
     @staticmethod
-    def extract(source:str, source_path_relative:str = None, global_line_offset: int = 0) -> str:
-        state_reading_docstring = False
-        state_expecting_docstring = False
-        state_reading_string = False
+    def _column(line: str, byte_offset: int) -> int:
+        # The ast reports columns as utf8 byte offsets.
+        if line.isascii():
+            return byte_offset
+        return len(line.encode("utf8")[:byte_offset].decode("utf8", "ignore"))
 
-        doc = []
-        current_doc_indentation = 0
-        for line_idx, orig_line in enumerate(source.split("\n")):
-            line = orig_line.lstrip()
-            if "\"\"\"" in line:
-                state_reading_string = not state_reading_string
-            indent = len(orig_line) - len(line)
-            if not state_reading_docstring:
-                if PythonDoc._is_definition(line):
-                    if state_expecting_docstring:
-                        doc.append("*(no documentation found)*")
-                    if line.startswith("class "):
-                        PythonDoc._add_separator(doc)
-                        PythonDoc._add_class_doc_header(doc, line, indent)
-                    elif line.startswith("def "):
-                        PythonDoc._add_separator(doc)
-                        PythonDoc._add_def_doc_header(doc, line, indent)
-                    else:
-                        raise RuntimeError(f"This case should not happen. Cannot understad type of line: {line}")
-                    PythonDoc._add_code_link(doc, source_path_relative, line_idx + global_line_offset)
-                    state_expecting_docstring = True
-                elif state_reading_string and line.startswith("\"\"\"doc"):
-                    # Start module docstring """doc
-                    if state_expecting_docstring:
-                        doc.append("*(no documentation found)*")
-                    state_expecting_docstring = False
-                    current_doc_indentation = indent
-                    PythonDoc._add_separator(doc)
-                    state_reading_docstring = True
-                elif state_expecting_docstring and state_reading_string and line.startswith("\"\"\""):
-                    # Start docstring for function/class """
-                    state_expecting_docstring = False
-                    current_doc_indentation = indent
-                    state_reading_docstring = PythonDoc._add_object_doc_start(doc, line)
-            elif state_reading_docstring:
-                if "\"\"\"" in line:
-                    if not line.rstrip().endswith("\"\"\""):
-                        print("WARNING: Your last documentation line should close with \"\"\" doc might be truncated or broken.")
-                    state_reading_docstring = False  # Close the open docstring
-                    PythonDoc._add_doc_end(doc, orig_line[current_doc_indentation:])
-                else:
-                    PythonDoc._add_doc_string(doc, orig_line[current_doc_indentation:].rstrip())
+    @staticmethod
+    def _get_string_lines(lines: List[str], node) -> List[str]:
+        # Returns the lines of a string literal as written, the first line starting after the quotes and the last ending before them.
+        first = lines[node.lineno - 1]
+        start = PythonDoc._column(first, node.col_offset)
+        match = PythonDoc.STRING_START.match(first, start)
+        quote_length = len(match.group(2))
+        last = lines[node.end_lineno - 1]
+        end = PythonDoc._column(last, node.end_col_offset) - quote_length
+        if node.lineno == node.end_lineno:
+            return [first[match.end():end]]
+        return [first[match.end():]] + [line[start:] for line in lines[node.lineno:node.end_lineno - 1]] + [last[start:end]]
+
+    @staticmethod
+    def _get_doc_lines(lines: List[str], node, doc_block: bool) -> List[str]:
+        # The text after the opening quotes of a doc block is ignored, empty first and last lines are dropped.
+        string_lines = PythonDoc._get_string_lines(lines, node)
+        if len(string_lines) == 1:
+            return [string_lines[0].strip()]
+        doc_lines = [line.rstrip() for line in string_lines[1:-1]]
+        if not doc_block and string_lines[0].strip() != "":
+            doc_lines.insert(0, string_lines[0].strip())
+        if string_lines[-1].rstrip() != "":
+            doc_lines.append(string_lines[-1].rstrip())
+        return doc_lines
+
+    @staticmethod
+    def _get_docstring_node(node):
+        if len(node.body) > 0 and isinstance(node.body[0], ast.Expr) and isinstance(node.body[0].value, ast.Constant) and isinstance(node.body[0].value.value, str):
+            return node.body[0].value
+        return None
+
+    @staticmethod
+    def _is_doc_block(lines: List[str], node) -> bool:
+        line = lines[node.lineno - 1]
+        return line[PythonDoc._column(line, node.col_offset):].startswith("\"\"\"doc")
+
+    @staticmethod
+    def _get_segment(lines: List[str], node) -> str:
+        first, last = lines[node.lineno - 1], lines[node.end_lineno - 1]
+        start, end = PythonDoc._column(first, node.col_offset), PythonDoc._column(last, node.end_col_offset)
+        if node.lineno == node.end_lineno:
+            return first[start:end]
+        return "\n".join([first[start:]] + lines[node.lineno:node.end_lineno - 1] + [last[:end]])
+
+    @staticmethod
+    def _get_signature(lines: List[str], node) -> str:
+        if isinstance(node, ast.ClassDef):
+            line = lines[node.lineno - 1]
+            header = PythonDoc.HEADER.match(line, PythonDoc._column(line, node.col_offset))
+            if header is None or header.group(1) is None:
+                return ""
+            bases = [" ".join(PythonDoc._get_segment(lines, base).split()) for base in node.bases + node.keywords]
+            return "(" + ", ".join(bases) + ")"
+        signature = "(" + ast.unparse(node.args) + ")"
+        if node.returns is not None:
+            signature += " -> " + ast.unparse(node.returns)
+        return signature
+
+    @staticmethod
+    def _walk(node):
+        # Definitions and strings are statements, which never occur inside expressions.
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, ast.expr):
+                continue
+            yield child
+            yield from PythonDoc._walk(child)
+
+    @staticmethod
+    def parse(source: str) -> List[DocSymbol]:
+        """
+        Parse python source code into a table of the documented symbols.
+
+        Public classes and functions are found at any nesting level, markdown doc strings become symbols of the kind "doc".
+        Line numbers start at 0.
+
+        :param source: The python source code.
+        :type source: str
+        :return: The symbols in the order they appear in the source.
+        :rtype: List[DocSymbol]
+        """
+        with Timings.measure("parse docstrings"):
+            tree = ast.parse(source)
+            lines = source.split("\n")
+            symbols = []
+            docstring_nodes = set()
+            for node in PythonDoc._walk(tree):
+                if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                    docstring_node = PythonDoc._get_docstring_node(node)
+                    if docstring_node is not None and PythonDoc._is_doc_block(lines, docstring_node):
+                        docstring_node = None
+                    if docstring_node is not None:
+                        docstring_nodes.add(docstring_node)
+                    if node.name.startswith("_"):
+                        continue
+                    # A class without docstring is documented by the docstring of its constructor.
+                    if docstring_node is None and isinstance(node, ast.ClassDef):
+                        for child in node.body:
+                            if isinstance(child, ast.FunctionDef) and child.name == "__init__":
+                                docstring_node = PythonDoc._get_docstring_node(child)
+                    kind = {ast.FunctionDef: "def", ast.AsyncFunctionDef: "async def", ast.ClassDef: "class"}[type(node)]
+                    symbol = DocSymbol(node.name, kind, node.lineno - 1, PythonDoc._column(lines[node.lineno - 1], node.col_offset), PythonDoc._get_signature(lines, node))
+                    if docstring_node is not None:
+                        symbol.docstring = inspect.cleandoc(docstring_node.value)
+                        symbol.doc_lines = PythonDoc._get_doc_lines(lines, docstring_node, doc_block=False)
+                    symbols.append(symbol)
+                elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+                    if node.value not in docstring_nodes and PythonDoc._is_doc_block(lines, node.value) and node.lineno != node.end_lineno:
+                        doc_lines = PythonDoc._get_doc_lines(lines, node.value, doc_block=True)
+                        symbols.append(DocSymbol("", "doc", node.lineno - 1, node.col_offset, docstring="\n".join(doc_lines), doc_lines=doc_lines))
+            symbols.sort(key=lambda symbol: symbol.line)
+            return symbols
+
+    @staticmethod
+    def parse_cells(sources: List[str]) -> List[List[DocSymbol]]:
+        # Parses all cells of a notebook at once and falls back to parsing cell by cell if any cell is broken.
+        try:
+            symbols = PythonDoc.parse("\n".join(sources))
+        except SyntaxError:
+            return [PythonDoc.parse_safe(source) for source in sources]
+        cell_symbols = [[] for _ in sources]
+        cell_idx, start, end = 0, 0, 0
+        for symbol in symbols:
+            while cell_idx < len(sources) and symbol.line >= start + sources[cell_idx].count("\n") + 1:
+                start += sources[cell_idx].count("\n") + 1
+                cell_idx += 1
+            symbol.line -= start
+            cell_symbols[cell_idx].append(symbol)
+        return cell_symbols
+
+    @staticmethod
+    def parse_safe(source: str) -> List[DocSymbol]:
+        try:
+            return PythonDoc.parse(source)
+        except SyntaxError as e:
+            _log(f"WARNING: Cannot parse code for documentation (line {e.lineno}: {e.msg}), skipping it.")
+            return []
 
-        doc = "\n".join(doc) + "\n"
+    @staticmethod
+    def render(symbols: List[DocSymbol], source_path_relative: str = None, global_line_offset: int = 0) -> str:
+        with Timings.measure("render markdown"):
+            doc = []
+            expecting_docstring = False
+            for symbol in symbols:
+                if expecting_docstring:
+                    doc.append("*(no documentation found)*")
+                PythonDoc._add_separator(doc)
+                if symbol.kind != "doc":
+                    doc.append(PythonDoc._common_header(symbol.indent, symbol.kind, symbol.name, symbol.signature if symbol.kind == "class" else ""))
+                    PythonDoc._add_code_link(doc, source_path_relative, symbol.line + global_line_offset)
+                for line in symbol.doc_lines or []:
+                    PythonDoc._add_doc_string(doc, line)
+                expecting_docstring = symbol.doc_lines is None
+
+            return PythonDoc.collapse_blank_lines("\n".join(doc) + "\n").lstrip()
 
-        while "\n\n\n" in doc:
-            doc = doc.replace("\n\n\n", "\n\n")
+    @staticmethod
+    def extract(source:str, source_path_relative:str = None, global_line_offset: int = 0) -> str:
+        return PythonDoc.render(PythonDoc.parse_safe(source), source_path_relative, global_line_offset)
 
-        return doc.lstrip()
+    @staticmethod
+    def collapse_blank_lines(doc: str) -> str:
+        return PythonDoc.BLANK_LINES.sub("\n\n", doc)
 
+    @staticmethod
     def fix_paths(output):
-        start = 0
-        idx = output.find("![", start)
-        while idx >= 0:
-            left = output.find("](", idx)
-            if left != output.find("](data:", idx):
-                output = output[:left] + "](../" + output[left+2:]
-            start = idx + 1
-            idx = output.find("![", start)
-        return output
+        # Image links point one folder up, as docs are in the docs folder, except for inline data.
+        return PythonDoc.IMAGE_LINK.sub(r"\1../", output)
 
     # TODO make cleaner
     @staticmethod
-    def python_to_markdown(file_path) -> str:
-        with open(file_path, "r") as f:
-            source = f.readlines()
+    def markdown_page(source: str, file_path: str) -> Optional["DocPage"]:
+        lines = io.StringIO(source).readlines()
         title = None
-        for idx, line in enumerate(source):
+        for idx, line in enumerate(lines):
             if line.startswith("\"\"\"doc"):
-                if source[idx+1].startswith("# "):
-                    title = source[idx+1][2:-1]
+                if lines[idx+1].startswith("# "):
+                    title = lines[idx+1][2:-1]
                     break
         if title is None:
-            return None, None
+            return None
 
         md_name = file_path.replace(".py", ".md")
-        md_path = os.path.join("docs", md_name).replace("\\", "/")
         base_path_relative = "/".join([".." for _ in range(len(md_name.split("/"))-1)])
         source_path_relative = os.path.join("..", base_path_relative, md_name.replace(".md", ".py"))
-        doc = "[Back to Overview]({})\n\n".format(base_path_relative + "/README.md")
-        doc += PythonDoc.extract("".join(source), source_path_relative)
-        doc = PythonDoc.fix_paths(doc)
+        doc = "[Back to Overview]({})\n\n".format(posixpath.join(base_path_relative, "README.md"))
+        symbols = PythonDoc.parse_safe(source)
+        doc += PythonDoc.render(symbols, source_path_relative)
+        search = _page_search_data(doc, [(symbol, file_path, symbol.line + 1) for symbol in symbols], [])
+        return DocPage(md_name, title, PythonDoc.fix_paths(doc), search=search)
 
-        path = "/".join(md_path.split("/")[:-1])
-        os.makedirs(path, exist_ok=True)
-        with open(md_path, "w", encoding="utf8") as f:
-            f.write(doc)
-        return md_name, title
+    @staticmethod
+    def python_to_markdown(file_path, sink: Optional[OutputSink] = None) -> str:
+        Timings.read(file_path)
+        with open(file_path, "r") as f:
+            page = PythonDoc.markdown_page(f.read(), file_path)
+        if page is None:
+            return None, None
+        page.write(sink if sink is not None else DirectorySink())
+        return page.name, page.title
 
 
-#%% Cell: 13
+#%% Cell: 30
 """doc
 ---
 
@@ -428,112 +2030,896 @@ Additionally to the regular python to markdown here we want to extract the examp
 """
 
 
-#%% Cell: 14
+#%% Cell: 31
+"""doc
+Images in the outputs of the examples are stored in `docs/jlabdev_images` named by a hash of their encoded data.
+An `ImageBlob` only holds the encoded data and the name of an image.
+This way an image that already exists (e.g. from a previous run or the same plot in another notebook) is found without decoding it and large images are decoded in chunks while an output sink writes them.
+PNG, JPEG and SVG outputs are supported.
+The images are reference counted by the pages using them, so an image is deleted as soon as no page references it anymore.
+"""
+
+
+#%% Cell: 32
+IMAGES_FOLDER = "docs/jlabdev_images"
+IMAGE_TYPES = {"image/png": ".png", "image/jpeg": ".jpg", "image/svg+xml": ".svg"}
+
+
+class ImageBlob(object):
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, data, mime_type: str, folder: str = IMAGES_FOLDER):
+        if isinstance(data, list):
+            data = "".join(data)
+        self.data = data
+        self.mime_type = mime_type
+        with Timings.measure("images"):
+            digest = hashlib.blake2b(digest_size=16)
+            for chunk in self._chunks():
+                digest.update(chunk.encode("utf8"))
+        self.path = folder + "/" + digest.hexdigest() + IMAGE_TYPES[mime_type]
+
+    def _chunks(self):
+        for start in range(0, len(self.data), self.CHUNK_SIZE):
+            yield self.data[start:start+self.CHUNK_SIZE]
+
+    def write_to(self, f) -> None:
+        if self.mime_type == "image/svg+xml":
+            f.write(self.data.encode("utf8"))
+            return
+        remainder = ""
+        for chunk in self._chunks():
+            chunk = remainder + "".join(chunk.split())
+            if "=" in chunk:
+                # Padding ends the image, anything after it is ignored like b64decode does.
+                remainder = chunk
+                break
+            end = len(chunk) - len(chunk) % 4
+            f.write(base64.b64decode(chunk[:end]))
+            remainder = chunk[end:]
+        f.write(base64.b64decode(remainder))
+
+    def to_bytes(self) -> bytes:
+        f = io.BytesIO()
+        self.write_to(f)
+        return f.getvalue()
+
+    def head(self, size: int = 1 << 16) -> bytes:
+        # At most the first size bytes of the image, enough for the header without decoding all of it.
+        chunk = "".join(self.data[:size * 4 // 3].split()).split("=")[0]
+        return base64.b64decode(chunk[:len(chunk) - len(chunk) % 4])
+
+
+class ImageStore(object):
+    def __init__(self, folder: str = IMAGES_FOLDER, root: str = "."):
+        self.folder = folder
+        self.root = root
+        self.references = {}
+
+    def is_image(self, file_path: str) -> bool:
+        return file_path.startswith(self.folder + "/")
+
+    def count_references(self, cache: BuildCache, prefix: str = "nb2doc:") -> None:
+        self.references = {}
+        for key, build in cache.builds.items():
+            if key.startswith(prefix):
+                self.retain(build["outputs"].keys())
+
+    def retain(self, file_paths: List[str]) -> None:
+        for file_path in set(file_paths):
+            if self.is_image(file_path):
+                self.references[file_path] = self.references.get(file_path, 0) + 1
+
+    def release(self, file_paths: List[str]) -> None:
+        for file_path in set(file_paths):
+            if not self.is_image(file_path) or file_path not in self.references:
+                continue
+            self.references[file_path] -= 1
+            if self.references[file_path] <= 0:
+                del self.references[file_path]
+                if os.path.exists(_root_path(self.root, file_path)):
+                    os.remove(_root_path(self.root, file_path))
+
+
+#%% Cell: 33
+"""doc
+The outputs of examples can be huge (e.g. the log of a training loop), which makes the pages slow to generate, slow to render and bloats the repository.
+An `OutputBudget` limits the lines and bytes of text and the number of images per example cell and per page, as well as the size of every image.
+Text past a limit is cut off with a marker and images past a limit are left out.
+Outputs past a limit are neither joined nor decoded, the size of an image is estimated from the length of its encoded data.
+With `spill` nothing is lost: the complete text output of a truncated cell is written to `docs/jlabdev_outputs` (named by its hash like the images) and linked, and images past a limit are linked instead of shown.
+"""
+
+
+#%% Cell: 34
+OUTPUTS_FOLDER = "docs/jlabdev_outputs"
+
+
+def _parse_size(value: str) -> int:
+    match = re.fullmatch(r"(\d+)([kKmM]?)", value.strip())
+    if match is None:
+        raise ValueError(f"Invalid size: {value}")
+    return int(match.group(1)) * {"": 1, "k": 1 << 10, "m": 1 << 20}[match.group(2).lower()]
+
+
+def _format_size(size: int) -> str:
+    if size >= 1 << 20:
+        return f"{size / (1 << 20):.1f} MB"
+    if size >= 1 << 10:
+        return f"{size / (1 << 10):.1f} kB"
+    return f"{size} bytes"
+
+
+class OutputBudget(object):
+    """Limits for the outputs of example cells that are copied into the docs, None means no limit.
+
+    :param cell_lines: The maximum number of lines of text output per cell.
+    :type cell_lines: int, optional
+    :param cell_bytes: The maximum number of bytes of text output per cell.
+    :type cell_bytes: int, optional
+    :param cell_images: The maximum number of images per cell.
+    :type cell_images: int, optional
+    :param page_lines: The maximum number of lines of text output per page.
+    :type page_lines: int, optional
+    :param page_bytes: The maximum number of bytes of text output per page.
+    :type page_bytes: int, optional
+    :param page_images: The maximum number of images per page.
+    :type page_images: int, optional
+    :param image_bytes: The maximum size of an image in bytes.
+    :type image_bytes: int, optional
+    :param spill: Write the complete text of truncated outputs to a linked file and link images past a limit instead of leaving them out, defaults to False.
+    :type spill: bool, optional
+    """
+    LIMITS = ["cell_lines", "cell_bytes", "cell_images", "page_lines", "page_bytes", "page_images", "image_bytes"]
+
+    def __init__(self, cell_lines: Optional[int] = None, cell_bytes: Optional[int] = None, cell_images: Optional[int] = None,
+                 page_lines: Optional[int] = None, page_bytes: Optional[int] = None, page_images: Optional[int] = None,
+                 image_bytes: Optional[int] = None, spill: bool = False):
+        self.cell_lines = cell_lines
+        self.cell_bytes = cell_bytes
+        self.cell_images = cell_images
+        self.page_lines = page_lines
+        self.page_bytes = page_bytes
+        self.page_images = page_images
+        self.image_bytes = image_bytes
+        self.spill = spill
+
+    @staticmethod
+    def parse(spec: str) -> "OutputBudget":
+        """Parse a budget from a comma separated list of limits, e.g. "cell_lines=100,page_bytes=1M,image_bytes=500k,spill".
+
+        :param spec: The limits as `name=value` with an optional k or M suffix for sizes and `spill` to spill truncated outputs.
+        :type spec: str
+        :return: The budget.
+        :rtype: OutputBudget
+        """
+        budget = OutputBudget()
+        for item in spec.split(","):
+            item = item.strip()
+            if item == "spill":
+                budget.spill = True
+                continue
+            name, _, value = item.partition("=")
+            if name not in OutputBudget.LIMITS or value == "":
+                raise ValueError(f"Invalid output budget: {item} (use {'=N, '.join(OutputBudget.LIMITS)}=N or spill).")
+            setattr(budget, name, _parse_size(value))
+        return budget
+
+    def to_spec(self) -> str:
+        limits = [f"{name}={getattr(self, name)}" for name in OutputBudget.LIMITS if getattr(self, name) is not None]
+        return ",".join(limits + (["spill"] if self.spill else []))
+
+
+class _PageBudget(object):
+    # What is left of the budget of a page while its cells are rendered.
+    def __init__(self, budget: Optional[OutputBudget]):
+        self.budget = budget if budget is not None else OutputBudget()
+        self.lines = self.budget.page_lines
+        self.bytes = self.budget.page_bytes
+        self.images = self.budget.page_images
+
+    @staticmethod
+    def _min(a: Optional[int], b: Optional[int]) -> Optional[int]:
+        if a is None or b is None:
+            return a if b is None else b
+        return min(a, b)
+
+    @staticmethod
+    def _spend(left: Optional[int], amount: int) -> Optional[int]:
+        return left - amount if left is not None else None
+
+    def cell_limits(self):
+        return self._min(self.budget.cell_lines, self.lines), self._min(self.budget.cell_bytes, self.bytes), self._min(self.budget.cell_images, self.images)
+
+    def spend(self, lines: int, size: int, images: int) -> None:
+        self.lines = self._spend(self.lines, lines)
+        self.bytes = self._spend(self.bytes, size)
+        self.images = self._spend(self.images, images)
+
+
+#%% Cell: 35
+"""doc
+Plots saved by matplotlib are PNGs compressed with the default zlib level and are often larger than they are shown.
+`ImageOptions` process the images of example outputs before they are written: `optimize` deflates the pixel data of PNGs again with the best compression and drops their text and time chunks, which keeps every pixel.
+This only needs `zlib`, so it works without any other library.
+`max_size` downsizes images whose width or height is larger and `thumbnail` shows a small version of large images, which links to the full image.
+Both need [Pillow](https://python-pillow.org), without it they are ignored with a warning.
+The colors of a downsized palette PNG are mapped back to its palette and a processed image that is not smaller than the original is replaced by the original, so processing never makes the docs larger.
+SVG images are left as they are.
+
+A processed image is named by the hash of the original image and the options applied to it (e.g. `<hash>-opt-max1600.png`), so like any other image it is only processed when no file of that name exists yet, no matter how many pages or builds use it.
+The images of a page are processed in a pool of threads (zlib and Pillow do not hold the GIL while they compress), on top of the worker processes that build the pages.
+"""
+
+
+#%% Cell: 36
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_DROPPED_CHUNKS = (b"tEXt", b"zTXt", b"iTXt", b"tIME")
+
+
+def _image_dimensions(head: bytes, mime_type: str) -> Optional[Tuple[int, int]]:
+    # The width and height from the header of a PNG or JPEG, None if they are not in its first bytes.
+    if mime_type == "image/png":
+        if head.startswith(PNG_SIGNATURE) and head[12:16] == b"IHDR" and len(head) >= 24:
+            return struct.unpack(">II", head[16:24])
+        return None
+    if mime_type != "image/jpeg" or not head.startswith(b"\xff\xd8"):
+        return None
+    pos = 2
+    while pos + 9 <= len(head) and head[pos] == 0xFF:
+        marker = head[pos + 1]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", head[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + struct.unpack(">H", head[pos + 2:pos + 4])[0]
+    return None
+
+
+def _optimize_png(data: bytes) -> bytes:
+    # Deflate the pixel data again with the best compression, the original is kept if that is not smaller.
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+    chunks = []
+    pixel_data = []
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+        if kind == b"IDAT":
+            if len(pixel_data) == 0:
+                chunks.append((kind, None))
+            pixel_data.append(body)
+        elif kind not in _PNG_DROPPED_CHUNKS:
+            chunks.append((kind, body))
+        if kind == b"IEND":
+            break
+    if len(pixel_data) == 0 or chunks[-1][0] != b"IEND":
+        return data
+    try:
+        pixels = zlib.decompress(b"".join(pixel_data))
+    except zlib.error:
+        return data
+    compressed = None
+    for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        candidate = compressor.compress(pixels) + compressor.flush()
+        if compressed is None or len(candidate) < len(compressed):
+            compressed = candidate
+    optimized = [PNG_SIGNATURE]
+    for kind, body in chunks:
+        body = compressed if body is None else body
+        optimized.append(struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body)))
+    optimized = b"".join(optimized)
+    return optimized if len(optimized) < len(data) else data
+
+
+def _resize_image(data: bytes, mime_type: str, max_size: int) -> bytes:
+    with PILImage.open(io.BytesIO(data)) as source:
+        if source.width <= max_size and source.height <= max_size:
+            return data
+        image = source
+        # Filtering adds colors, without a palette again the smaller image would take more bytes than the original.
+        # The colors of an opaque palette image are mapped back to its own palette, which keeps lines and text sharp.
+        palette = source if source.mode == "P" and "transparency" not in source.info else None
+        if palette is not None:
+            image = image.convert("RGB")
+        elif mime_type == "image/png" and image.mode not in ("L", "LA", "RGB", "RGBA"):
+            image = image.convert("RGBA")
+        image.thumbnail((max_size, max_size), PILImage.LANCZOS)
+        if palette is not None:
+            image = image.quantize(palette=palette, dither=PILImage.Dither.NONE)
+        elif source.mode == "P":
+            image = image.quantize(256, method=PILImage.FASTOCTREE)
+        f = io.BytesIO()
+        if mime_type == "image/jpeg":
+            image.save(f, "JPEG", quality=90, optimize=True)
+        else:
+            image.save(f, "PNG", optimize=True)
+        return f.getvalue()
+
+
+class ProcessedImage(object):
+    """An image output processed according to `ImageOptions`, which is written like an `ImageBlob`.
+
+    :param source: The original image.
+    :type source: ImageBlob
+    :param optimize: Compress a PNG again without changing its pixels.
+    :type optimize: bool
+    :param max_size: Downsize the image to at most this many pixels in width and height, requires Pillow. None keeps the size.
+    :type max_size: int, optional
+    """
+    def __init__(self, source: ImageBlob, optimize: bool, max_size: Optional[int] = None):
+        self.source = source
+        self.mime_type = source.mime_type
+        self.optimize = optimize
+        self.max_size = max_size
+        tags = (["opt"] if optimize else []) + ([f"max{max_size}"] if max_size is not None else [])
+        stem, extension = os.path.splitext(source.path)
+        self.path = stem + "-" + "-".join(tags) + extension
+        self.data = None
+
+    def prepare(self) -> None:
+        if self.data is not None:
+            return
+        original = self.source.to_bytes()
+        data = original
+        if self.max_size is not None:
+            data = _resize_image(data, self.mime_type, self.max_size)
+        if self.optimize and self.mime_type == "image/png":
+            data = _optimize_png(data)
+        # Like _optimize_png, keep the original if processing did not make it smaller.
+        self.data = data if len(data) < len(original) else original
+
+    def write_to(self, f) -> None:
+        self.prepare()
+        f.write(self.data)
+
+    def to_bytes(self) -> bytes:
+        self.prepare()
+        return self.data
+
+
+class ImageOptions(object):
+    """How the images of example outputs are processed before they are copied into the docs.
+
+    :param optimize: Compress PNG images again with the best zlib compression and drop their text and time chunks, the pixels stay the same. Defaults to False.
+    :type optimize: bool, optional
+    :param max_size: Downsize images whose width or height is larger to this many pixels, requires Pillow. Defaults to no limit.
+    :type max_size: int, optional
+    :param thumbnail: Show images whose width or height is larger as a thumbnail of this many pixels, which links to the full image, requires Pillow. Defaults to no thumbnails.
+    :type thumbnail: int, optional
+    """
+    SIZES = ["max_size", "thumbnail"]
+
+    def __init__(self, optimize: bool = False, max_size: Optional[int] = None, thumbnail: Optional[int] = None):
+        if PILImage is None and (max_size is not None or thumbnail is not None):
+            _log("WARNING: Pillow is not installed, so images are neither downsized nor shown as thumbnails (pip install jlabdev[images]).")
+            max_size, thumbnail = None, None
+        self.optimize = optimize
+        self.max_size = max_size
+        self.thumbnail = thumbnail
+
+    @staticmethod
+    def parse(spec: str) -> "ImageOptions":
+        """Parse the options from a comma separated list, e.g. "optimize,max_size=1600,thumbnail=400".
+
+        :param spec: `optimize` to compress PNGs losslessly and the sizes as `name=pixels`.
+        :type spec: str
+        :return: The options.
+        :rtype: ImageOptions
+        """
+        options = {}
+        for item in spec.split(","):
+            item = item.strip()
+            if item == "optimize":
+                options["optimize"] = True
+                continue
+            name, _, value = item.partition("=")
+            if name not in ImageOptions.SIZES or not value.strip().isdigit() or int(value) == 0:
+                raise ValueError(f"Invalid image option: {item} (use optimize, {'=N, '.join(ImageOptions.SIZES)}=N).")
+            options[name] = int(value)
+        return ImageOptions(**options)
+
+    def to_spec(self) -> str:
+        sizes = [f"{name}={getattr(self, name)}" for name in ImageOptions.SIZES if getattr(self, name) is not None]
+        return ",".join((["optimize"] if self.optimize else []) + sizes)
+
+    def process(self, image: ImageBlob):
+        """Find the image to link as the full image and the thumbnail to show instead of it (None to show the full image).
+
+        :param image: The original image.
+        :type image: ImageBlob
+        :return: The full image and the thumbnail, both are either the original image or a ProcessedImage.
+        :rtype: Tuple[Union[ImageBlob, ProcessedImage], Optional[ProcessedImage]]
+        """
+        if image.mime_type == "image/svg+xml":
+            return image, None
+        longest = None
+        if self.max_size is not None or self.thumbnail is not None:
+            size = _image_dimensions(image.head(), image.mime_type)
+            longest = max(size) if size is not None else None
+        max_size = self.max_size if longest is not None and self.max_size is not None and longest > self.max_size else None
+        optimize = self.optimize and image.mime_type == "image/png"
+        full = image
+        if max_size is not None or optimize:
+            full = ProcessedImage(image, optimize, max_size)
+        thumbnail = None
+        if longest is not None and self.thumbnail is not None and min(longest, max_size or longest) > self.thumbnail:
+            thumbnail = ProcessedImage(image, optimize, self.thumbnail)
+        return full, thumbnail
+
+
+#%% Cell: 37
+"""doc
+Most builds of a page follow an edit of a few cells, but every exported cell has to be parsed and rendered again to document it.
+So the rendered markdown and the symbols of every exported cell are kept in a `DocCellCache` in `.jlabdev/doc_cells`, one file per notebook.
+A cell is found by the hash of its source and of the path of its python file, so it is only parsed again when it changed.
+The source links of a cell are stored relative to the cell and moved to the line of the cell in the python file when the page is assembled, so cells that only moved are found as well.
+The least recently used cells are evicted once a notebook has more than `DocCellCache.MAX_ENTRIES` of them and the files of deleted notebooks are removed by full builds.
+`--force` ignores the cached cells and check mode does not write them.
+"""
+
+
+#%% Cell: 38
+DOC_CELL_CACHE_FOLDER = os.path.join(".jlabdev", "doc_cells")
+DOC_CELL_CACHE_VERSION = 1
+
+
+class DocCellCache(object):
+    MAX_ENTRIES = 1000
+
+    def __init__(self, file_path: str, force: bool = False, root: str = "."):
+        self.file_path = file_path
+        self.cache_path = _root_path(root, DocCellCache.path(file_path))
+        self.entries = {}
+        self.n_used = 0
+        self.changed = False
+        if force or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, "rb") as f:
+                data = _json_load(f)
+            if data.get("version") == DOC_CELL_CACHE_VERSION and data.get("file_path") == file_path:
+                self.entries = data["entries"]
+        except (OSError, ValueError, KeyError):
+            _log(f"WARNING: Ignoring unreadable doc cell cache {self.cache_path}.")
+
+    @staticmethod
+    def path(file_path: str) -> str:
+        return os.path.join(DOC_CELL_CACHE_FOLDER, _hash_bytes(file_path.encode("utf8")) + ".json")
+
+    def extract(self, sources: List[str], source_path_relative: Optional[str]) -> List[Tuple[str, List[DocSymbol]]]:
+        cells = []
+        used = set()
+        for source in sources:
+            key = _hash_bytes(f"{source_path_relative}\0{source}".encode("utf8"))
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                try:
+                    symbols = PythonDoc.parse(source)
+                except SyntaxError:
+                    # Broken cells are not cached, so the warning is printed on every build.
+                    cells.append(("", PythonDoc.parse_safe(source)))
+                    continue
+                entry = {"markdown": PythonDoc.render(symbols, source_path_relative), "symbols": [symbol.to_dict() for symbol in symbols]}
+                self.changed = True
+            # Used cells move to the end, so the least recently used cells are the first ones.
+            self.entries[key] = entry
+            used.add(key)
+            symbols = [DocSymbol(symbol["name"], symbol["kind"], symbol["line"], signature=symbol["signature"], docstring=symbol["docstring"]) for symbol in entry["symbols"]]
+            cells.append((entry["markdown"], symbols))
+        self.n_used = len(used)
+        return cells
+
+    @staticmethod
+    def move_links(markdown: str, source_path_relative: Optional[str], global_line_offset: int) -> str:
+        if source_path_relative is None or global_line_offset == 0:
+            return markdown
+        link = re.compile(r"(\[\[src\]\]\(" + re.escape(source_path_relative) + r"#L)(\d+)\)")
+        return link.sub(lambda match: f"{match.group(1)}{int(match.group(2)) + global_line_offset})", markdown)
+
+    def save(self) -> None:
+        if not self.changed:
+            return
+        for key in list(self.entries.keys())[:max(len(self.entries) - max(DocCellCache.MAX_ENTRIES, self.n_used), 0)]:
+            del self.entries[key]
+        data = {"version": DOC_CELL_CACHE_VERSION, "file_path": self.file_path, "entries": self.entries}
+        _write_if_changed(self.cache_path, json.dumps(data) + "\n")
+
+    @staticmethod
+    def prune(file_paths: List[str], root: str = ".") -> None:
+        folder = _root_path(root, DOC_CELL_CACHE_FOLDER)
+        if not os.path.isdir(folder):
+            return
+        keep = set(os.path.basename(DocCellCache.path(file_path)) for file_path in file_paths)
+        for f in os.listdir(folder):
+            if f.endswith(".json") and f not in keep:
+                os.remove(os.path.join(folder, f))
+
+
+#%% Cell: 39
 class NotebookForDocumentation(Notebook):
+    ANSI_ESCAPE = re.compile("\x1b[^m]*m")
+
     def is_example_notebook(self) -> bool:
         if Notebook.is_code_notebook(self):
             return False
-        for cell in self["cells"]:
-            if Cell.is_md_export(cell) and (cell["source"][0].startswith("# Example") or cell["source"][0].startswith("#Example")):
+        for record in self.records():
+            if record.tag is CellTag.DOC and (record.source.startswith("# Example") or record.source.startswith("#Example")):
                 return True
         return False
 
-    def _extract_doc(self, base_path_relative, py_name) -> str:
+    @staticmethod
+    def _iter_output_lines(outputs: List[Dict]):
+        for outp in outputs:
+            if "text" in outp:
+                text = outp["text"]
+                yield from text if isinstance(text, list) else text.splitlines(True)
+            if "traceback" in outp:
+                for entry in outp["traceback"]:
+                    yield NotebookForDocumentation.ANSI_ESCAPE.sub("", entry) + "\n"
+
+    @staticmethod
+    def _image_size(data, mime_type: str) -> int:
+        size = sum(len(chunk) for chunk in data) if isinstance(data, list) else len(data)
+        return size if mime_type == "image/svg+xml" else size * 3 // 4
+
+    @staticmethod
+    def _process_image(image: ImageBlob, image_options: Optional[ImageOptions]):
+        if image_options is None:
+            return image, None
+        return image_options.process(image)
+
+    @staticmethod
+    def _render_outputs(outputs: List[Dict], base_path_relative: str, page_budget: _PageBudget, images: Dict, files: Dict, image_options: Optional[ImageOptions] = None) -> List[str]:
+        max_lines, max_bytes, max_images = page_budget.cell_limits()
+        doc = []
+        text = []
+        n_lines = 0
+        n_bytes = 0
+        truncated = False
+        for line in NotebookForDocumentation._iter_output_lines(outputs):
+            if max_lines is not None and n_lines >= max_lines:
+                truncated = True
+                break
+            if max_bytes is not None:
+                encoded = line.encode("utf8")
+                if n_bytes + len(encoded) > max_bytes:
+                    line = encoded[:max_bytes - n_bytes].decode("utf8", "ignore")
+                    if line != "":
+                        text.append(line)
+                        n_lines += 1
+                        n_bytes += len(line.encode("utf8"))
+                    truncated = True
+                    break
+                n_bytes += len(encoded)
+            text.append(line)
+            n_lines += 1
+        text = "".join(text)
+        if text != "":
+            doc.append("\nOutput:\n```\n")
+            doc.append(text if not truncated or text.endswith("\n") else text + "\n")
+            doc.append("```\n")
+        if truncated:
+            marker = f"Output truncated after {n_lines} line(s)" if text != "" else "Output omitted"
+            if page_budget.budget.spill:
+                spilled = "".join(NotebookForDocumentation._iter_output_lines(outputs))
+                spill_path = OUTPUTS_FOLDER + "/" + _hash_bytes(spilled.encode("utf8")) + ".txt"
+                files[spill_path] = spilled
+                marker += f", see the [full output]({posixpath.join('..', base_path_relative, spill_path)})"
+            doc.append(f"\n*{marker}.*\n")
+
+        n_images = 0
+        for outp in outputs:
+            if "data" not in outp:
+                continue
+            for mime_type in IMAGE_TYPES:
+                if mime_type not in outp["data"]:
+                    continue
+                data = outp["data"][mime_type]
+                size = NotebookForDocumentation._image_size(data, mime_type) if page_budget.budget.image_bytes is not None else 0
+                if (max_images is None or n_images < max_images) and (page_budget.budget.image_bytes is None or size <= page_budget.budget.image_bytes):
+                    image, thumbnail = NotebookForDocumentation._process_image(ImageBlob(data, mime_type), image_options)
+                    images[image.path] = image
+                    # Image links are moved into the docs folder by fix_paths, other links are written for it.
+                    if thumbnail is None:
+                        doc.append(f"![data]({posixpath.join(base_path_relative, image.path)})\n")
+                    else:
+                        images[thumbnail.path] = thumbnail
+                        doc.append(f"[![data]({posixpath.join(base_path_relative, thumbnail.path)})]({posixpath.join('..', base_path_relative, image.path)})\n")
+                    n_images += 1
+                elif page_budget.budget.spill:
+                    image, _ = NotebookForDocumentation._process_image(ImageBlob(data, mime_type), image_options)
+                    images[image.path] = image
+                    doc.append(f"\n*[Image]({posixpath.join('..', base_path_relative, image.path)}) not shown ({_format_size(NotebookForDocumentation._image_size(data, mime_type))}).*\n")
+                else:
+                    doc.append(f"\n*Image omitted ({_format_size(NotebookForDocumentation._image_size(data, mime_type))}).*\n")
+                break
+        page_budget.spend(n_lines, n_bytes, n_images)
+        return doc
+
+    def _extract_doc(self, base_path_relative, code: Optional[str], output_budget: Optional[OutputBudget] = None, cell_cache: Optional[DocCellCache] = None, image_options: Optional[ImageOptions] = None):
         source_path_relative = None
-        py_code = None
-        if os.path.exists(py_name):
+        source_map = None
+        if code is not None:
             source_path_relative = os.path.join("..", base_path_relative, self.file_path.replace(".ipynb", ".py"))
-            with open(py_name, "r") as f:
-                py_code = f.read().split("\n")
+            source_map = self.source_map()
 
-        doc = "[Back to Overview]({})\n\n".format(base_path_relative + "/README.md")
+        doc = ["[Back to Overview]({})\n\n".format(posixpath.join(base_path_relative, "README.md"))]
         images = {}
+        files = {}
+        page_budget = _PageBudget(output_budget)
         title = None
-        cell_idx = 0
-        for cell in self["cells"]:
-            # Example Cell
-            if cell["cell_type"] == "code" and len(cell["source"]) > 0 and not cell["source"][0].startswith("#export") and not cell["source"][0].startswith("#hide") and not cell["source"][0].startswith("#convert") and not cell["source"][0].startswith("#example"):
-                doc += "\nExample:\n"
-                doc += "```python\n"
-                for line in cell["source"]:
-                    doc += line
-                doc += "\n```\n"
-                image_data = []
-                outp_text = ""
-                for outp in cell["outputs"]:
-                    if "text" in outp:
-                        for entry in outp["text"]:
-                            outp_text += entry
-                    if "data" in outp:
-                        if "image/png" in outp["data"]:
-                            image_data.append(outp["data"]["image/png"])
-                    if "traceback" in outp:
-                        for entry in outp["traceback"]:
-                            while entry.find('\x1b') >= 0:
-                                start = entry.find('\x1b')
-                                end = entry.find("m", start)
-                                entry = entry[:start] + entry[end+1:]
-                            outp_text += entry + "\n"
-
-                if outp_text != "":
-                    doc += "\nOutput:\n"
-                    doc += "```\n"
-                    doc += outp_text
-                    doc += "```\n"
-                for img in image_data:
-                    md5 = hashlib.md5(img.encode('utf-8')).hexdigest()
-                    with open("docs/jlabdev_images/{}.png".format(md5), "wb") as fh:
-                        
-                        fh.write(base64.b64decode(img))
-                    doc +="![data](" + base_path_relative + "/docs/jlabdev_images/{}.png)\n".format(md5)
-                doc += "\n\n"
-
-            # Export Cell
-            if Cell.is_code_export(cell):
-                source = "".join(cell["source"])
-                global_line_offset = -1
-                for line_idx, line in enumerate(py_code):
-                    if line.lstrip().rstrip() == f"#%% Cell: {cell_idx}":
-                        global_line_offset = line_idx
-                doc += PythonDoc.extract(source, source_path_relative, global_line_offset) + "\n"
-
-            # Regular Markdown Cell
-            if Cell.is_md_export(cell):
-                for line in cell["source"]:
-                    if line.startswith("# ") and title is None:
-                        title = line[2:]
-                    doc += line
-                doc += "\n\n"
-
-            if Cell.is_code_export(cell) or Cell.is_md_export(cell):
-                cell_idx += 1
-        
-        doc += "\n"
-        while "\n\n\n" in doc:
-            doc = doc.replace("\n\n\n", "\n\n")
-        
-        return doc.lstrip(), title
-
-    def to_markdown(self) -> str:
+        records = self.records()
+        export_sources = [record.source for record in records if record.tag is CellTag.EXPORT]
+        if cell_cache is not None:
+            code_cells = cell_cache.extract(export_sources, source_path_relative)
+        else:
+            code_cells = [(PythonDoc.render(symbols, source_path_relative), symbols) for symbols in PythonDoc.parse_cells(export_sources)]
+        code_cell_idx = 0
+        search_symbols = []
+        search_texts = []
+        for record in records:
+            if record.tag is CellTag.EXAMPLE:
+                doc.append("\nExample:\n```python\n")
+                doc.append(record.source)
+                doc.append("\n```\n")
+                doc.extend(NotebookForDocumentation._render_outputs(record.cell["outputs"], base_path_relative, page_budget, images, files, image_options))
+                doc.append("\n\n")
+
+            elif record.tag is CellTag.EXPORT:
+                # The source links count from 0, the lines of the source map from 1.
+                global_line_offset = source_map.cell_start(record.export_index) - 1 if source_map is not None else -1
+                markdown, symbols = code_cells[code_cell_idx]
+                doc.append(DocCellCache.move_links(markdown, source_path_relative, global_line_offset) + "\n")
+                for symbol in symbols:
+                    search_symbols.append((symbol, self.file_path.replace(".ipynb", ".py"), symbol.line + global_line_offset + 1))
+                code_cell_idx += 1
+
+            elif record.tag is CellTag.DOC:
+                if title is None:
+                    for line in io.StringIO(record.source):
+                        if line.startswith("# "):
+                            title = line[2:]
+                            break
+                doc.append(record.source)
+                doc.append("\n\n")
+                search_texts.append(record.source)
+
+        doc.append("\n")
+        doc = PythonDoc.collapse_blank_lines("".join(doc)).lstrip()
+        return doc, title, images, files, _page_search_data(doc, search_symbols, search_texts)
+
+    def markdown_page(self, code: Optional[str] = None, output_budget: Optional[OutputBudget] = None, cell_cache: Optional[DocCellCache] = None, image_options: Optional[ImageOptions] = None) -> Optional["DocPage"]:
         if not self.is_code_notebook() and not self.is_example_notebook():
-            return None, None
-        
-        md_name = self.file_path.replace(".ipynb", ".md")
-        py_name = self.file_path.replace(".ipynb", ".py")
+            return None
+        if code is None:
+            code = self.python_code()
 
-        md_path = os.path.join("docs", md_name).replace("\\", "/")
+        md_name = self.file_path.replace(".ipynb", ".md")
         base_path_relative = "/".join([".." for _ in range(len(md_name.split("/"))-1)])
-        doc, title = self._extract_doc(base_path_relative, py_name)
-        doc = PythonDoc.fix_paths(doc)
+        doc, title, images, files, search = self._extract_doc(base_path_relative, code, output_budget, cell_cache, image_options)
+        return DocPage(md_name, title, PythonDoc.fix_paths(doc), images, files, search)
 
-        path = "/".join(md_path.split("/")[:-1])
-        os.makedirs(path, exist_ok=True)
-        with open(md_path, "w", encoding="utf8") as f:
-            f.write(doc)
-        return md_name, title
+    def to_markdown(self, sink: Optional[OutputSink] = None, output_budget: Optional[OutputBudget] = None) -> str:
+        page = self.markdown_page(output_budget=output_budget)
+        if page is None:
+            self.output_files = []
+            return None, None
+        self.output_files = page.write(sink if sink is not None else DirectorySink())
+        return page.name, page.title
 
 
-#%% Cell: 15
+#%% Cell: 40
+"""doc
+---
+
+## Converting in Memory
+
+The conversions above are also available as a pure API, which takes a notebook as a dict, the bytes of its json or its path and returns the generated files as values instead of writing them.
+This is useful for tools that convert many notebooks without touching the disk (e.g. a pre-commit hook or a server).
+The generated files can be written later on with any output sink.
+"""
+
+
+#%% Cell: 41
+class DocPage(object):
+    def __init__(self, name: str, title: str, markdown: str, images: Optional[Dict[str, ImageBlob]] = None, files: Optional[Dict[str, str]] = None, search: Optional[Dict] = None):
+        self.name = name
+        self.path = os.path.join("docs", name).replace("\\", "/")
+        self.title = title
+        self.markdown = markdown
+        self.images = images if images is not None else {}
+        self.files = files if files is not None else {}
+        self.search = search if search is not None else {"symbols": [], "terms": []}
+
+    def write(self, sink: OutputSink) -> List[str]:
+        if not isinstance(sink, CheckSink):
+            self._prepare_images(sink)
+        for image in self.images.values():
+            sink.write_image(image)
+        for file_path, content in self.files.items():
+            sink.write(file_path, content)
+        sink.write(self.path, self.markdown)
+        return [self.path] + list(self.images.keys()) + list(self.files.keys())
+
+    def _prepare_images(self, sink: OutputSink) -> None:
+        # Process the images that are not written yet in parallel, the sink then writes them one after the other.
+        pending = [image for image in self.images.values() if isinstance(image, ProcessedImage) and not sink.exists(image.path)]
+        if len(pending) == 0:
+            return
+        with Timings.measure("process images"):
+            if len(pending) == 1:
+                pending[0].prepare()
+                return
+            with concurrent.futures.ThreadPoolExecutor(min(len(pending), os.cpu_count() or 1)) as executor:
+                list(executor.map(ProcessedImage.prepare, pending))
+
+
+class Conversion(object):
+    def __init__(self, file_path: str, python: Optional[str], page: Optional[DocPage]):
+        self.file_path = file_path
+        self.python = python
+        self.page = page
+
+    def write(self, sink: OutputSink) -> List[str]:
+        outputs = []
+        if self.python is not None:
+            outputs.append(self.file_path.replace(".ipynb", ".py"))
+            sink.write(outputs[0], self.python)
+        if self.page is not None:
+            outputs.extend(self.page.write(sink))
+        return outputs
+
+
+def convert_notebook(notebook, file_path: Optional[str] = None, markdown: bool = True, output_budget: Optional[OutputBudget] = None, image_options: Optional[ImageOptions] = None) -> Conversion:
+    """Convert a notebook to python and markdown without writing any files.
+
+    :param notebook: The notebook as a dict, the bytes of its json or the path of the notebook file.
+    :type notebook: Union[Dict, bytes, str]
+    :param file_path: The path of the notebook relative to the project root, which names the generated files. Required unless the notebook is given as a path.
+    :type file_path: str, optional
+    :param markdown: Also generate the markdown documentation, defaults to True. Without it the outputs of the cells are not loaded.
+    :type markdown: bool, optional
+    :param output_budget: Limits for the outputs of the examples in the documentation, defaults to no limits.
+    :type output_budget: OutputBudget, optional
+    :param image_options: How to process the images of the examples in the documentation, defaults to copying them as they are.
+    :type image_options: ImageOptions, optional
+    :return: The generated python (None if nothing is exported) and the doc page with its title and images (None if the notebook has no documentation). Use `write` to write them to an output sink.
+    :rtype: Conversion
+    """
+    if isinstance(notebook, str):
+        if file_path is None:
+            file_path = notebook
+        notebook = read_notebook(notebook, load_outputs=markdown)
+    elif file_path is None:
+        raise ValueError("A file_path is required to convert a notebook that is not read from a path.")
+    nb = NotebookForDocumentation(file_path, load_outputs=markdown, content=notebook)
+    code = nb.python_code()
+    page = nb.markdown_page(code, output_budget, image_options=image_options) if markdown else None
+    return Conversion(file_path, code, page)
+
+
+def convert_python(source, file_path: str) -> Optional[DocPage]:
+    """Convert a python file (with `\"\"\"doc` blocks) to markdown documentation without writing any files.
+
+    :param source: The source code of the python file.
+    :type source: Union[str, bytes]
+    :param file_path: The path of the python file relative to the project root, which names the generated page.
+    :type file_path: str
+    :return: The doc page with its title, None if the file has no title.
+    :rtype: DocPage
+    """
+    if isinstance(source, bytes):
+        source = source.decode("utf8")
+    return PythonDoc.markdown_page(source, file_path)
+
+
+#%% Cell: 42
+"""doc
+---
+
+## Search Index
+
+Next to the index in `docs/README.md`, nb2doc writes `docs/search_index.json`, so a docs site or `jlabdev find` (see [jlabdev.client](client.md)) can look up names and words without reading the pages.
+It lists the pages (path and title) and contains a symbol table and an inverted index.
+The symbol table maps the name of every documented class and function to its page, the anchor of its heading, its signature and its line in the python file.
+The inverted index maps every word of the docstrings and markdown cells (names with underscores also by their parts) to the pages using it.
+
+The search data of a page is collected while the page is generated and kept in the build cache next to its title, so the index is updated together with the README without reading unchanged pages.
+The anchors are the ones github generates for the headings.
+"""
+
+
+#%% Cell: 43
+# The index is read by `jlabdev find`, which defines its path and format version.
+from jlabdev.client import SEARCH_INDEX_PATH, SEARCH_INDEX_VERSION
+
+
+class _SearchIndex(object):
+    HEADING = re.compile(r"^#{1,6} (.*)$")
+    SYMBOL_HEADING = re.compile(r"\*(?:class|def|async def)\* \*\*(\w+)\*\*")
+    LINK = re.compile(r"\[((?:[^\[\]]|\[[^\]]*\])*)\]\([^)]*\)")
+    NOT_IN_ANCHOR = re.compile(r"[^\w\- ]")
+    WORD = re.compile(r"\w{2,}")
+
+    @staticmethod
+    def heading_anchors(markdown: str) -> List[Tuple[str, str]]:
+        anchors = []
+        counts = {}
+        in_code = False
+        for line in markdown.split("\n"):
+            if line.startswith("```"):
+                in_code = not in_code
+                continue
+            match = _SearchIndex.HEADING.match(line) if not in_code else None
+            if match is None:
+                continue
+            anchor = _SearchIndex.LINK.sub(r"\1", match.group(1)).strip().lower()
+            anchor = _SearchIndex.NOT_IN_ANCHOR.sub("", anchor).replace(" ", "-")
+            # Like github, the second heading with the same anchor gets "-1" appended, the third "-2" and so on.
+            if anchor in counts:
+                counts[anchor] += 1
+                anchors.append((match.group(1), f"{anchor}-{counts[anchor]}"))
+            else:
+                counts[anchor] = 0
+                anchors.append((match.group(1), anchor))
+        return anchors
+
+    @staticmethod
+    def terms(texts: List[str]) -> List[str]:
+        terms = set()
+        for text in texts:
+            for word in _SearchIndex.WORD.findall(text.lower()):
+                if word.isdigit():
+                    continue
+                terms.add(word)
+                if "_" in word:
+                    terms.update(part for part in word.split("_") if len(part) > 1 and not part.isdigit())
+        return sorted(terms)
+
+
+def _page_search_data(markdown: str, symbols: List[Tuple[DocSymbol, Optional[str], int]], texts: List[str]) -> Dict:
+    # The symbols are (symbol, python file, line) in the order they are rendered, so their headings are found in the same order.
+    headings = _SearchIndex.heading_anchors(markdown)
+    heading_idx = 0
+    entries = []
+    for symbol, source_path, line in symbols:
+        if symbol.kind == "doc":
+            continue
+        anchor = None
+        for idx in range(heading_idx, len(headings)):
+            match = _SearchIndex.SYMBOL_HEADING.match(headings[idx][0])
+            if match is not None and match.group(1) == symbol.name:
+                anchor = headings[idx][1]
+                heading_idx = idx + 1
+                break
+        entry = symbol.to_dict()
+        del entry["docstring"]
+        entry.update({"anchor": anchor, "source": source_path, "line": line})
+        entries.append(entry)
+    texts = texts + [symbol.docstring for symbol, _, _ in symbols if symbol.docstring] + [entry["name"] for entry in entries]
+    return {"symbols": entries, "terms": _SearchIndex.terms(texts)}
+
+
+def _search_index_json(pages: List[Tuple[str, str, Optional[Dict]]]) -> str:
+    index = {"version": SEARCH_INDEX_VERSION, "pages": [], "symbols": {}, "terms": {}}
+    for page_idx, (name, title, search) in enumerate(pages):
+        index["pages"].append({"path": name, "title": title.strip()})
+        for symbol in search["symbols"]:
+            index["symbols"].setdefault(symbol["name"], []).append(dict(symbol, page=page_idx))
+        for term in search["terms"]:
+            index["terms"].setdefault(term, []).append(page_idx)
+    return json.dumps(index, sort_keys=True, separators=(",", ":"), ensure_ascii=False) + "\n"
+
+
+#%% Cell: 44
 DOC_INDEX_TEMPLATE = """
 # Examples
 
@@ -545,73 +2931,708 @@ DOC_INDEX_TEMPLATE = """
 
 """
 
-def notebook2doc(readme_template=None) -> None:
+def _find_orphaned_docs(live_files: List[str], root: str = ".") -> List[str]:
+    live_files = set(live_files)
+    generated_folders = [os.path.join("docs", "jlabdev_images"), os.path.join("docs", "jlabdev_outputs")]
+    orphaned_files = []
+    for folder, dirs, files in os.walk(_root_path(root, "docs")):
+        folder = folder if root == "." else os.path.relpath(folder, root)
+        for f in sorted(files):
+            file_path = os.path.join(folder, f).replace("\\", "/")
+            if file_path not in live_files and (f.endswith(".md") or folder in generated_folders):
+                orphaned_files.append(file_path)
+    return orphaned_files
+
+
+def _remove_orphaned_docs(live_files: List[str], root: str = ".") -> None:
+    docs_folder = _root_path(root, "docs")
+    images_folder = _root_path(root, os.path.join("docs", "jlabdev_images"))
+    for file_path in _find_orphaned_docs(live_files, root):
+        os.remove(_root_path(root, file_path))
+        _log("Removed orphaned doc: {}".format(file_path))
+    for folder, dirs, files in os.walk(docs_folder, topdown=False):
+        if folder != docs_folder and folder != images_folder and len(os.listdir(folder)) == 0:
+            os.rmdir(folder)
+
+
+def _build_doc_page(source_path: str, sink: Optional[OutputSink] = None, output_budget: Optional[OutputBudget] = None, force: bool = False, image_options: Optional[ImageOptions] = None, root: str = "."):
+    with Timings.measure("to markdown", source_path):
+        if source_path.endswith(".ipynb"):
+            cell_cache = DocCellCache(source_path, force, root)
+            page = NotebookForDocumentation(source_path, root=root).markdown_page(output_budget=output_budget, cell_cache=cell_cache, image_options=image_options)
+            if not isinstance(sink, CheckSink):
+                cell_cache.save()
+        else:
+            Timings.read(_root_path(root, source_path))
+            with open(_root_path(root, source_path), "r") as f:
+                page = PythonDoc.markdown_page(f.read(), source_path)
+        if page is None:
+            return None, None, [], None
+        return page.name, page.title, page.write(sink if sink is not None else DirectorySink(root)), page.search
+
+
+def _check_doc_page(source_path: str, output_budget: Optional[OutputBudget] = None, force: bool = False, image_options: Optional[ImageOptions] = None, root: str = "."):
+    sink = CheckSink(root)
+    return _build_doc_page(source_path, sink, output_budget, force, image_options, root) + (sink.stale_files,)
+
+
+def _may_have_doc(source_path: str, cache: BuildCache) -> bool:
+    return not source_path.endswith(".ipynb") or Files.has_markers(source_path, ["export", "example"], cache)
+
+
+def _is_doc_up_to_date(cache: BuildCache, source_path: str, output_budget: Optional[OutputBudget], image_options: Optional[ImageOptions] = None) -> bool:
+    # Pages built with another output budget or other image options are stale, even though their inputs did not change.
+    key = "nb2doc:" + source_path
+    if not cache.is_up_to_date(key, [source_path]):
+        return False
+    info = cache.get_info(key)
+    if info.get("name") is not None and "search" not in info:
+        return False  # Built before pages had search data.
+    if info.get("image_options") != (image_options.to_spec() if image_options is not None else None):
+        return False
+    return info.get("output_budget") == (output_budget.to_spec() if output_budget is not None else None)
+
+
+def _stale_doc_pages(source_paths: List[str], cache: BuildCache, output_budget: Optional[OutputBudget], image_options: Optional[ImageOptions] = None) -> List[str]:
+    return [source_path for source_path in source_paths if not _is_doc_up_to_date(cache, source_path, output_budget, image_options)]
+
+
+def _build_doc_pages(source_paths: List[str], cache: BuildCache, jobs: Optional[int] = None, output_budget: Optional[OutputBudget] = None, image_options: Optional[ImageOptions] = None) -> List:
+    stale = _stale_doc_pages(source_paths, cache, output_budget, image_options)
+    build = functools.partial(_build_doc_page, output_budget=output_budget, force=cache.force, image_options=image_options, root=cache.root)
+    may_have_doc = functools.partial(_may_have_doc, cache=cache)
+    return _record_doc_pages(stale, _run_filtered(build, stale, may_have_doc, (None, None, [], None), jobs), cache, output_budget, image_options)
+
+
+def _record_doc_pages(stale: List[str], results: List, cache: BuildCache, output_budget: Optional[OutputBudget] = None, image_options: Optional[ImageOptions] = None) -> List:
+    os.makedirs(_root_path(cache.root, IMAGES_FOLDER), exist_ok=True)
+    images = ImageStore(root=cache.root)
+    images.count_references(cache)
+    spilled_outputs = ImageStore(OUTPUTS_FOLDER, cache.root)
+    spilled_outputs.count_references(cache)
+    errors = []
+    for source_path, (page, error, output) in zip(stale, results):
+        _log(output, end="")
+        if error is not None:
+            errors.append((source_path, error))
+            continue
+        name, title, outputs, search = page
+        key = "nb2doc:" + source_path
+        old_outputs = cache.get_outputs(key) if key in cache.builds else []
+        images.retain(outputs)
+        spilled_outputs.retain(outputs)
+        info = {"name": name, "title": title}
+        if name is not None:
+            info["search"] = search
+        if output_budget is not None:
+            info["output_budget"] = output_budget.to_spec()
+        if image_options is not None:
+            info["image_options"] = image_options.to_spec()
+        cache.record(key, [source_path], outputs, info)
+        images.release(old_outputs)
+        spilled_outputs.release(old_outputs)
+        if name is not None:
+            _log("Converted to md: {}".format(source_path))
+    return errors
+
+
+def _write_doc_index(source_paths: List[str], cache: BuildCache, readme_template: str, sink: Optional[OutputSink] = None, pages: Optional[Dict] = None) -> List[str]:
+    index = []
+    live_files = []
+    for source_path in source_paths:
+        key = "nb2doc:" + source_path
+        if pages is not None and source_path in pages:
+            name, title, outputs, search = pages[source_path]
+        elif key in cache.builds:
+            info = cache.get_info(key)
+            name, title, outputs, search = info["name"], info["title"], cache.get_outputs(key), info.get("search")
+        else:
+            continue
+        if name is not None:
+            index.append((name, title, search if search is not None else {"symbols": [], "terms": []}))
+            live_files.extend(outputs)
+    
+    index = sorted(index, key=lambda x: (x[1], x[0]))
+    
+    if len(index) > 0:
+        toc = ""
+        examples = ""
+        for i in index:
+            if i[1].startswith("Example: "):
+                examples += "* [{}]({})\n".format(i[1].replace("Example: ", ""), i[0])
+            else:
+                toc += "* [{}]({})\n".format(i[1], i[0])
+
+        if examples == "":
+            examples = "(no examples found)"
+        readme_template = readme_template.replace("`{toc}`", "`#toc%`").format(toc=toc, examples=examples).replace("`#toc%`", "`{toc}`")
+        sink = sink if sink is not None else DirectorySink(cache.root)
+        sink.write(os.path.join("docs", "README.md"), readme_template)
+        live_files.append("docs/README.md")
+        with Timings.measure("search index"):
+            sink.write(SEARCH_INDEX_PATH, _search_index_json(index))
+        live_files.append(SEARCH_INDEX_PATH)
+    return live_files
+
+
+def _get_cached_doc_sources(cache: BuildCache) -> List[str]:
+    source_paths = [key[len("nb2doc:"):] for key in cache.builds if key.startswith("nb2doc:")]
+    return [source_path for source_path in source_paths if os.path.exists(_root_path(cache.root, source_path))]
+
+
+def _check_doc_pages(source_paths: List[str], cache: BuildCache, readme_template: str, jobs: Optional[int] = None, selected: bool = False, output_budget: Optional[OutputBudget] = None, image_options: Optional[ImageOptions] = None) -> None:
+    stale = _stale_doc_pages(source_paths, cache, output_budget, image_options)
+    check = functools.partial(_check_doc_page, output_budget=output_budget, force=cache.force, image_options=image_options, root=cache.root)
+    results = _run_filtered(check, stale, functools.partial(_may_have_doc, cache=cache), (None, None, [], None, []), jobs)
+    _report_stale_files(*_collect_doc_checks(source_paths, stale, results, cache, readme_template, selected))
+
+
+def _collect_doc_checks(source_paths: List[str], stale: List[str], results: List, cache: BuildCache, readme_template: str, selected: bool = False):
+    sink = CheckSink(cache.root)
+    pages = {}
+    errors = []
+    for source_path, (result, error, output) in zip(stale, results):
+        _log(output, end="")
+        if error is not None:
+            errors.append((source_path, error))
+            continue
+        name, title, outputs, search, stale_files = result
+        pages[source_path] = (name, title, outputs, search)
+        sink.stale_files.extend(stale_files)
+    _log(f"Checked {len(stale)} page(s) out of {len(source_paths)} total ({len(source_paths) - len(stale)} up to date in the build cache).")
+    with Timings.measure("doc index"):
+        if not selected:
+            live_files = _write_doc_index(source_paths, cache, readme_template, sink, pages)
+            if len(errors) == 0:
+                sink.stale_files.extend(_find_orphaned_docs(live_files, cache.root))
+        elif any(key.startswith("nb2doc:") for key in cache.builds):
+            # The pages that were not selected are listed in the index as they were built last time.
+            cached_source_paths = _get_cached_doc_sources(cache)
+            _write_doc_index(cached_source_paths + [f for f in pages if f not in cached_source_paths], cache, readme_template, sink, pages)
+    return sink.stale_files, errors
+
+
+def notebook2doc(readme_template=None, rescan: bool = True, force: bool = False, jobs: Optional[int] = None, paths: Optional[List[str]] = None, check: bool = False, output_budget: Optional[OutputBudget] = None, image_options: Optional[ImageOptions] = None, root: str = ".") -> None:
     """Convert all notebooks in the folder.
 
     Also converts notebooks annotated with #example in first cell.
     All notebooks, which have a title starting with "Example: " are listed under examples without the "Example: " shown in the list.
+    Pages whose inputs did not change since the last run are skipped and pages of deleted files are removed (see BuildCache).
     
     :param project_root: The root directory of the project. The default exp path is relative to this folder.
     :type project_root: str, optional
+    :param rescan: Scan the project for files again instead of reusing the files found by a previous command, defaults to True.
+    :type rescan: bool, optional
+    :param force: Ignore the build cache and regenerate all pages, defaults to False.
+    :type force: bool, optional
+    :param jobs: The number of worker processes, defaults to the number of CPUs.
+    :type jobs: int, optional
+    :param paths: Only convert these files and the files in these folders and update their entries in the index, defaults to the whole project.
+    :type paths: List[str], optional
+    :param check: Write nothing and raise an OutOfDateError listing the pages, images and index that are missing, differ from the generated ones or would be removed, defaults to False. With paths the index is only checked if the build cache knows the other pages.
+    :type check: bool, optional
+    :param output_budget: Limits for the outputs of the examples, defaults to no limits.
+    :type output_budget: OutputBudget, optional
+    :param image_options: How to process the images of the examples, defaults to copying them as they are.
+    :type image_options: ImageOptions, optional
+    :param root: The root folder of the project, defaults to the current working directory.
+    :type root: str, optional
     """
     if readme_template is None:
         readme_template = DOC_INDEX_TEMPLATE
-    notebooks = Files.get_notebooks()
-    non_notebooks = Files.get_pure_python_files()
-    index = []
-    shutil.rmtree("docs")
-    os.makedirs(os.path.join("docs", "jlabdev_images"))
-    for nb_path in notebooks:
-        nb = NotebookForDocumentation(nb_path)
-        name, title = nb.to_markdown()
-        if name is not None:
-            print("Converted to md: {}".format(nb_path))
-            index.append((name, title))
-    for py_path in non_notebooks:
-        name, title = PythonDoc.python_to_markdown(py_path)
-        if name is not None:
-            print("Converted to md: {}".format(py_path))
-            index.append((name, title))
-    
-    index = sorted(index, key=lambda x: x[1])
-    
-    if len(index) > 0:
-        with open(os.path.join("docs", "README.md"), "w", encoding="utf8") as f:
-            toc = ""
-            examples = ""
-            for i in index:
-                if i[1].startswith("Example: "):
-                    examples += "* [{}]({})\n".format(i[1].replace("Example: ", ""), i[0])
-                else:
-                    toc += "* [{}]({})\n".format(i[1], i[0])
+    cache = BuildCache(force=force, root=root)
+    if paths is not None and len(paths) > 0 and not check and not any(key.startswith("nb2doc:") for key in cache.builds):
+        # Without any pages in the cache there is no index to update, so build the whole project once.
+        paths = None
+    if paths is not None:
+        index = Files.select(paths, root)
+        source_paths = index.notebooks + index.pure_python_files
+    elif root != ".":
+        index = Files.scan(root)
+        source_paths = index.notebooks + index.pure_python_files
+    else:
+        if rescan:
+            Files.invalidate()
+        source_paths = Files.get_notebooks() + Files.get_pure_python_files()
+    if check:
+        _check_doc_pages(source_paths, cache, readme_template, jobs, selected=paths is not None, output_budget=output_budget, image_options=image_options)
+        return
+    errors = _build_doc_pages(source_paths, cache, jobs, output_budget, image_options)
+    if paths is not None:
+        # The other pages did not change, so their entries are taken from the cache instead of scanning the project.
+        with Timings.measure("doc index"):
+            _write_doc_index(_get_cached_doc_sources(cache), cache, readme_template)
+    else:
+        with Timings.measure("doc index"):
+            live_files = _write_doc_index(source_paths, cache, readme_template)
+        if len(errors) == 0:
+            _remove_orphaned_docs(live_files, root)
+        cache.prune("nb2doc:", ["nb2doc:" + source_path for source_path in source_paths])
+        DocCellCache.prune(source_paths, root)
+    cache.save()
+    _report_errors(errors)
+
+
+#%% Cell: 45
+"""doc
+---
 
-            if examples == "":
-                examples = "(no examples found)"
-            readme_template = readme_template.replace("`{toc}`", "`#toc%`").format(toc=toc, examples=examples).replace("`#toc%`", "`{toc}`")
-            f.write(readme_template)
+## Building Everything at Once
 
+Running nb2py and then nb2doc would scan the project twice, load and save the build cache twice and parse every changed notebook twice: once without outputs for the python file and once with outputs for its page.
+So nb2all runs a `BuildSession`, which scans the files and loads the build cache once and then converts every changed file in a single task.
+The task parses a notebook once, generates its python code once and uses the same code for the python file and for the source links of the page.
+Everything a task parsed is dropped when it returns, only the names, titles and output files of the pages are kept for the index.
+The results are recorded the same way nb2py and nb2doc record them, so both commands skip what nb2all built and vice versa.
+"""
 
-#%% Cell: 16
-def notebook2all() -> None:
+
+#%% Cell: 46
+_SKIPPED_CONVERSION = (False, (None, None, [], None), [])
+
+
+def _convert_source_file(task: Tuple[str, bool, bool], output_budget: Optional[OutputBudget] = None, check: bool = False, force: bool = False, image_options: Optional[ImageOptions] = None):
+    file_path, python, doc = task
+    sink = CheckSink() if check else DirectorySink()
+    if not file_path.endswith(".ipynb"):
+        return False, _build_doc_page(file_path, sink, output_budget), sink.stale_files if check else []
+    with Timings.measure("to python", file_path):
+        notebook = NotebookForDocumentation(file_path, load_outputs=doc)
+        code = notebook.python_code()
+        if python and code is not None:
+            sink.write(file_path.replace(".ipynb", ".py"), code)
+            if not check:
+                notebook.source_map(code).save()
+    page = _SKIPPED_CONVERSION[1]
+    if doc:
+        with Timings.measure("to markdown", file_path):
+            cell_cache = DocCellCache(file_path, force)
+            doc_page = notebook.markdown_page(code, output_budget, cell_cache, image_options)
+            if not check:
+                cell_cache.save()
+            if doc_page is not None:
+                page = (doc_page.name, doc_page.title, doc_page.write(sink), doc_page.search)
+    return code is not None, page, sink.stale_files if check else []
+
+
+def _may_need_conversion(task: Tuple[str, bool, bool], cache: BuildCache) -> bool:
+    file_path, python, doc = task
+    return _may_have_doc(file_path, cache) if doc else _may_export(file_path, cache)
+
+
+class BuildSession(object):
+    def __init__(self, force: bool = False, paths: Optional[List[str]] = None, rescan: bool = True, check: bool = False):
+        self.cache = BuildCache(force=force)
+        self.check = check
+        self.python_selected = paths is not None
+        self.doc_selected = paths is not None
+        if paths is not None:
+            index = Files.select(paths)
+            self.notebooks = index.notebooks
+            self.doc_sources = index.notebooks + index.pure_python_files
+            if len(paths) > 0 and not check and not any(key.startswith("nb2doc:") for key in self.cache.builds):
+                # Like nb2doc: without any pages in the cache there is no index to update, so the docs of the whole project are built once.
+                self.doc_sources = Files.get_notebooks() + Files.get_pure_python_files()
+                self.doc_selected = False
+        else:
+            if rescan:
+                Files.invalidate()
+            self.notebooks = Files.get_notebooks()
+            self.doc_sources = self.notebooks + Files.get_pure_python_files()
+
+    def convert(self, jobs: Optional[int] = None, output_budget: Optional[OutputBudget] = None, image_options: Optional[ImageOptions] = None):
+        python_stale = _stale_python_files(self.notebooks, self.cache)
+        doc_stale = _stale_doc_pages(self.doc_sources, self.cache, output_budget, image_options)
+        tasks = {file_path: [True, False] for file_path in python_stale}
+        for source_path in doc_stale:
+            tasks.setdefault(source_path, [False, False])[1] = True
+        tasks = [(file_path, python, doc) for file_path, (python, doc) in tasks.items()]
+        convert = functools.partial(_convert_source_file, output_budget=output_budget, check=self.check, force=self.cache.force, image_options=image_options)
+        results = dict(zip([task[0] for task in tasks], _run_filtered(convert, tasks, functools.partial(_may_need_conversion, cache=self.cache), _SKIPPED_CONVERSION, jobs)))
+
+        # Split the results into the ones of the python files and the ones of the pages, the output of a task is only printed once.
+        python_results, doc_results = [], []
+        for file_path in python_stale:
+            result, error, output = results[file_path]
+            python_results.append((None if result is None else (result[2] if self.check else result[0]), error, output))
+        for source_path in doc_stale:
+            result, error, output = results[source_path]
+            output = "" if source_path in python_stale else output
+            if result is None:
+                doc_results.append((None, error, output))
+            elif self.check:
+                doc_results.append((result[1] + ([] if source_path in python_stale else result[2],), error, output))
+            else:
+                doc_results.append((result[1], error, output))
+        return python_stale, python_results, doc_stale, doc_results
+
+    def build(self, jobs: Optional[int] = None, output_budget: Optional[OutputBudget] = None, readme_template: str = DOC_INDEX_TEMPLATE, image_options: Optional[ImageOptions] = None) -> None:
+        python_stale, python_results, doc_stale, doc_results = self.convert(jobs, output_budget, image_options)
+        cache = self.cache
+        errors = _record_python_files(self.notebooks, python_stale, python_results, cache)
+        errors += _record_doc_pages(doc_stale, doc_results, cache, output_budget, image_options)
+        errors = list(dict.fromkeys(errors))
+        with Timings.measure("doc index"):
+            if self.doc_selected:
+                _write_doc_index(_get_cached_doc_sources(cache), cache, readme_template)
+            else:
+                live_files = _write_doc_index(self.doc_sources, cache, readme_template)
+        if not self.doc_selected:
+            if len(errors) == 0:
+                _remove_orphaned_docs(live_files)
+            cache.prune("nb2doc:", ["nb2doc:" + source_path for source_path in self.doc_sources])
+            DocCellCache.prune(self.doc_sources)
+        if not self.python_selected:
+            cache.prune("nb2py:", ["nb2py:" + file_path for file_path in self.notebooks])
+            SourceMap.prune([file_path.replace(".ipynb", ".py") for file_path in self.notebooks])
+        cache.save()
+        _report_errors(errors)
+
+    def check_files(self, jobs: Optional[int] = None, output_budget: Optional[OutputBudget] = None, readme_template: str = DOC_INDEX_TEMPLATE, image_options: Optional[ImageOptions] = None) -> None:
+        python_stale, python_results, doc_stale, doc_results = self.convert(jobs, output_budget, image_options)
+        stale_files, errors = _collect_python_checks(self.notebooks, python_stale, python_results)
+        doc_stale_files, doc_errors = _collect_doc_checks(self.doc_sources, doc_stale, doc_results, self.cache, readme_template, self.doc_selected)
+        _report_stale_files(stale_files + doc_stale_files, list(dict.fromkeys(errors + doc_errors)))
+
+
+#%% Cell: 47
+def notebook2all(force: bool = False, jobs: Optional[int] = None, paths: Optional[List[str]] = None, rescan: bool = True, check: bool = False, output_budget: Optional[OutputBudget] = None, image_options: Optional[ImageOptions] = None) -> None:
     """Run the notebook2py and notebook2doc commands.
 
     :param project_root: The path to the project root, defaults to ".".
     :type project_root: str, optional
+    :param force: Ignore the build cache and regenerate all files, defaults to False.
+    :type force: bool, optional
+    :param jobs: The number of worker processes, defaults to the number of CPUs.
+    :type jobs: int, optional
+    :param paths: Only convert these files and the files in these folders, defaults to the whole project.
+    :type paths: List[str], optional
+    :param rescan: Scan the project for files again instead of reusing the files found by a previous command, defaults to True.
+    :type rescan: bool, optional
+    :param check: Write nothing and raise an OutOfDateError listing the generated files that are out of date, defaults to False.
+    :type check: bool, optional
+    :param output_budget: Limits for the outputs of the examples in the docs, defaults to no limits.
+    :type output_budget: OutputBudget, optional
+    :param image_options: How to process the images of the examples in the docs, defaults to copying them as they are.
+    :type image_options: ImageOptions, optional
     """
-    notebook2py()
-    notebook2doc()
+    session = BuildSession(force=force, paths=paths, rescan=rescan, check=check)
+    if check:
+        session.check_files(jobs, output_budget, image_options=image_options)
+    else:
+        session.build(jobs, output_budget, image_options=image_options)
 
 
-#%% Cell: 17
+#%% Cell: 48
+"""doc
+---
+
+## Watching for Changes
+
+Instead of running `nb2all` by hand after every save, the commands can keep running and rebuild whatever changed.
+The scanned files and the build cache stay in memory, so a save only costs converting the saved notebook and updating the index of the docs.
+
+On linux the folders of the project are watched with inotify (via ctypes, so no dependency is needed), everywhere else the known files and folders are polled.
+Jupyter writes a notebook in several steps on save, so events are collected until no new event arrived for a short debounce time before anything is rebuilt.
+"""
+
+
+#%% Cell: 49
+class _InotifyBackend(object):
+    _IN_CLOSE_WRITE = 0x8
+    _IN_MOVED_FROM = 0x40
+    _IN_MOVED_TO = 0x80
+    _IN_CREATE = 0x100
+    _IN_DELETE = 0x200
+    _IN_Q_OVERFLOW = 0x4000
+    _IN_IGNORED = 0x8000
+    _IN_ISDIR = 0x40000000
+    _MASK = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+    def __init__(self, root: str):
+        self.root = root
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify is not available on this platform.")
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Cannot initialize inotify.")
+        self.folders = {}
+
+    def add_folder(self, folder: str) -> None:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(self.root, folder)), self._MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Cannot watch folder: {folder}")
+        self.folders[wd] = folder
+
+    def add_file(self, file_path: str) -> None:
+        pass
+
+    def remove_folder(self, folder: str) -> None:
+        pass
+
+    def read(self, timeout: Optional[float]) -> List:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if len(ready) == 0:
+            return []
+        data = os.read(self.fd, 1 << 16)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = os.fsdecode(data[offset+16:offset+16+length].rstrip(b"\0"))
+            offset += 16 + length
+            if mask & self._IN_Q_OVERFLOW:
+                events.append((None, True))
+            elif mask & self._IN_IGNORED:
+                self.folders.pop(wd, None)
+            elif wd in self.folders and name != "":
+                folder = self.folders[wd]
+                events.append((folder + "/" + name if folder != "" else name, bool(mask & self._IN_ISDIR)))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class _PollingBackend(object):
+    def __init__(self, root: str, interval: float = 0.5):
+        self.root = root
+        self.interval = interval
+        self.folders = {}
+        self.files = {}
+
+    def _stat(self, path: str):
+        try:
+            stat = os.stat(os.path.join(self.root, path))
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _list(self, folder: str) -> Dict[str, bool]:
+        try:
+            with os.scandir(os.path.join(self.root, folder)) as it:
+                return {entry.name: entry.is_dir() for entry in it}
+        except OSError:
+            return {}
+
+    def add_folder(self, folder: str) -> None:
+        self.folders[folder] = (self._stat(folder), self._list(folder))
+
+    def add_file(self, file_path: str) -> None:
+        self.files[file_path] = self._stat(file_path)
+
+    def remove_folder(self, folder: str) -> None:
+        prefix = folder + "/"
+        for path in list(self.folders.keys()):
+            if path == folder or path.startswith(prefix):
+                del self.folders[path]
+        for path in list(self.files.keys()):
+            if path.startswith(prefix):
+                del self.files[path]
+
+    def _poll(self) -> List:
+        events = []
+        for folder, (state, entries) in list(self.folders.items()):
+            new_state = self._stat(folder)
+            if new_state == state:
+                continue
+            new_entries = self._list(folder)
+            self.folders[folder] = (new_state, new_entries)
+            for name in set(entries.keys()) ^ set(new_entries.keys()):
+                is_dir = new_entries[name] if name in new_entries else entries[name]
+                events.append((folder + "/" + name if folder != "" else name, is_dir))
+        for file_path, state in list(self.files.items()):
+            new_state = self._stat(file_path)
+            if new_state != state:
+                self.files[file_path] = new_state
+                events.append((file_path, False))
+        return events
+
+    def read(self, timeout: Optional[float]) -> List:
+        while True:
+            time.sleep(self.interval if timeout is None else timeout)
+            events = self._poll()
+            if len(events) > 0 or timeout is not None:
+                return events
+
+    def close(self) -> None:
+        pass
+
+
+class ProjectWatcher(object):
+    def __init__(self, root: str = ".", debounce: float = 0.1, polling: bool = False, poll_interval: float = 0.5):
+        self.root = root
+        self.debounce = debounce
+        self.index = Files.get_index()
+        self.backend = None
+        if not polling:
+            try:
+                self.backend = _InotifyBackend(root)
+                for folder in sorted(self.index.folders):
+                    self.backend.add_folder(folder)
+            except (OSError, AttributeError, TypeError) as e:
+                print(f"WARNING: Cannot use inotify ({e}), polling for changes instead.")
+                if self.backend is not None:
+                    self.backend.close()
+                self.backend = None
+        if self.backend is None:
+            self.backend = _PollingBackend(root, poll_interval)
+            for folder in self.index.folders:
+                self.backend.add_folder(folder)
+        for file_path in self.index.files:
+            if ProjectWatcher._is_relevant(file_path):
+                self.backend.add_file(file_path)
+
+    @staticmethod
+    def _is_relevant(file_path: str) -> bool:
+        return file_path.endswith(".ipynb") or file_path.endswith(".py") or file_path.split("/")[-1] in IGNORE_FILES
+
+    def _add_folder(self, folder: str, changed: set) -> None:
+        files, folders = Files._walk(self.root, self.index.rules, folder)
+        for sub_folder in folders:
+            self.index.folders.add(sub_folder)
+            self.backend.add_folder(sub_folder)
+        for file_path in files:
+            if ProjectWatcher._is_relevant(file_path):
+                self.index.add(file_path)
+                self.backend.add_file(file_path)
+                changed.add(file_path)
+
+    def _remove_folder(self, folder: str, removed: set) -> None:
+        prefix = folder + "/"
+        for file_path in [f for f in self.index.files if f.startswith(prefix)]:
+            self.index.remove(file_path)
+            removed.add(file_path)
+        self.index.folders = {f for f in self.index.folders if f != folder and not f.startswith(prefix)}
+        self.backend.remove_folder(folder)
+
+    def read_events(self) -> List:
+        events = self.backend.read(None)
+        while True:
+            more_events = self.backend.read(self.debounce)
+            if len(more_events) == 0:
+                break
+            events.extend(more_events)
+        return events
+
+    def apply(self, events: List):
+        changed = set()
+        removed = set()
+        rescan = False
+        for path, is_dir in events:
+            if path is None:
+                rescan = True
+                continue
+            full_path = os.path.join(self.root, path)
+            name = path.split("/")[-1]
+            if os.path.isdir(full_path) and not os.path.islink(full_path):
+                if path in self.index.folders or name.startswith(".") or self.index.rules.is_ignored(path, True):
+                    continue
+                self._add_folder(path, changed)
+            elif os.path.isfile(full_path):
+                if not ProjectWatcher._is_relevant(path) or self.index.rules.is_ignored(path, False):
+                    continue
+                if name in IGNORE_FILES:
+                    rescan = True
+                if path not in self.index:
+                    self.index.add(path)
+                    self.backend.add_file(path)
+                changed.add(path)
+            elif path in self.index.folders:
+                self._remove_folder(path, removed)
+            elif path in self.index:
+                self.index.remove(path)
+                removed.add(path)
+        return sorted(changed), sorted(removed), rescan
+
+    def wait(self):
+        return self.apply(self.read_events())
+
+    def close(self) -> None:
+        self.backend.close()
+
+
+def watch(python: bool = True, doc: bool = True, readme_template=None, force: bool = False, jobs: Optional[int] = None, polling: bool = False, output_budget: Optional[OutputBudget] = None, image_options: Optional[ImageOptions] = None) -> None:
+    """Convert notebooks and rebuild their docs whenever they change until interrupted.
+
+    :param python: Convert changed notebooks to python, defaults to True.
+    :type python: bool, optional
+    :param doc: Rebuild the docs of changed notebooks and python files, defaults to True.
+    :type doc: bool, optional
+    :param force: Ignore the build cache for the initial build, defaults to False.
+    :type force: bool, optional
+    :param jobs: The number of worker processes, defaults to the number of CPUs.
+    :type jobs: int, optional
+    :param polling: Poll for changes instead of using inotify, defaults to False.
+    :type polling: bool, optional
+    :param output_budget: Limits for the outputs of the examples in the docs, defaults to no limits.
+    :type output_budget: OutputBudget, optional
+    :param image_options: How to process the images of the examples in the docs, defaults to copying them as they are.
+    :type image_options: ImageOptions, optional
+    """
+    if readme_template is None:
+        readme_template = DOC_INDEX_TEMPLATE
+    Files.invalidate()
+    try:
+        if python:
+            notebook2py(rescan=False, force=force, jobs=jobs)
+        if doc:
+            notebook2doc(readme_template, rescan=False, force=force, jobs=jobs, output_budget=output_budget, image_options=image_options)
+    except ConversionError:
+        pass
+    cache = BuildCache()
+    watcher = ProjectWatcher(polling=polling)
+    print("Watching for changes, press Ctrl+C to stop.")
+    try:
+        while True:
+            changed, removed, rescan = watcher.wait()
+            if rescan:
+                watcher.close()
+                Files.invalidate()
+                watcher = ProjectWatcher(polling=polling)
+                changed = list(watcher.index.files)
+            index = watcher.index
+            notebooks = [f for f in changed if f.endswith(".ipynb") and f in index]
+            errors = []
+            if python and len(notebooks) > 0:
+                errors.extend(_build_python_files(notebooks, cache, jobs))
+            if doc:
+                source_paths = set(notebooks)
+                for f in changed:
+                    if f in index.pure_python_files:
+                        source_paths.add(f)
+                all_source_paths = index.notebooks + index.pure_python_files
+                errors.extend(_build_doc_pages([f for f in all_source_paths if f in source_paths], cache, jobs, output_budget, image_options))
+                live_files = _write_doc_index(all_source_paths, cache, readme_template)
+                if len(removed) > 0 or rescan:
+                    _remove_orphaned_docs(live_files)
+                    cache.prune("nb2doc:", ["nb2doc:" + f for f in all_source_paths])
+            if len(removed) > 0 or rescan:
+                cache.prune("nb2py:", ["nb2py:" + f for f in index.notebooks])
+            cache.save()
+            for file_path, error in errors:
+                _log("ERROR: Failed to convert {}:\n{}".format(file_path, error))
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    finally:
+        watcher.close()
+
+
+#%% Cell: 50
 """doc
 ---
 
 ## Update notebook from python
+
+Only the sources of the cells are read from the notebooks and compared to the cells in the python file, notebooks without changes are not touched.
+If cells changed, only their `source` arrays are replaced in the original file, everything else (e.g. the outputs) is copied over byte by byte.
 """
 
 
-#%% Cell: 18
+#%% Cell: 51
 def _get_py_cells(py_file):
+    Timings.read(py_file)
     with open(py_file, "r", encoding="utf8") as f:
         data = f.read()
     if not data.startswith("# AUTOGENERATED FROM: "):
@@ -643,54 +3664,306 @@ def _get_py_cells(py_file):
     return file_path, cells
 
 
-#%% Cell: 19
+#%% Cell: 52
 def _overwrite_exported_cells(data, cells):
-    i = 0
-    for cell in data["cells"]:
-        if Cell.is_code_export(cell):
-            cell["source"] = ["#export\n"] + cells[i]
-            i += 1
-        if Cell.is_md_export(cell):
-            cells[i][-2] = cells[i][-2][:-1]
-            cell["source"] = cells[i][1:-1]
-            i += 1
-
-
-#%% Cell: 20
-def _save_notebook(file_path: str, notebook: Dict) -> None:
-    with open(file_path, "w", encoding="utf8") as f:
-        return f.write(json.dumps(notebook, indent=1) + "\n")
-
-
-#%% Cell: 21
-def python2nb() -> None:
+    for record in classify_cells(data["cells"]):
+        if record.tag is CellTag.EXPORT:
+            record.cell["source"] = ["#export\n"] + cells[record.export_index]
+        elif record.tag is CellTag.DOC:
+            lines = cells[record.export_index]
+            lines[-2] = lines[-2][:-1]
+            record.cell["source"] = lines[1:-1]
+
+
+#%% Cell: 53
+def _read_cell_sources(file_path: str):
+    cells, source_spans = [], []
+    Timings.read(file_path)
+    with _open_json_stream(file_path) as stream:
+        for key in stream.keys():
+            if key == "cells":
+                cells = list(_read_cells(stream, source_spans))
+            else:
+                stream.skip_value()
+    return cells, source_spans
+
+
+def _format_source(f, span, source: List[str]) -> bytes:
+    # Format like the json of jupyter (indent=1) if the original source was, otherwise compact.
+    start, end = span
+    window_start = max(0, start - 4096)
+    f.seek(window_start)
+    before, original = f.read(start - window_start), f.read(end - start)
+    line = before[before.rfind(b"\n") + 1:]
+    if b"\n" not in original or not line.lstrip(b" ").startswith(b'"source"'):
+        return json.dumps(source, ensure_ascii=False).encode("utf8")
+    indent = len(line) - len(line.lstrip(b" "))
+    return json.dumps(source, indent=1, ensure_ascii=False).replace("\n", "\n" + " " * indent).encode("utf8")
+
+
+def _splice_file(file_path: str, replacements: List) -> None:
+    folder = os.path.dirname(file_path)
+    fd, tmp_path = tempfile.mkstemp(dir=folder if folder != "" else ".", prefix=".jlabdev-", suffix=".tmp")
+    try:
+        with open(file_path, "rb") as src, os.fdopen(fd, "wb") as dst:
+            pos = 0
+            for start, end, data in replacements:
+                dst.write(src.read(start - pos))
+                dst.write(data)
+                src.seek(end)
+                pos = end
+            shutil.copyfileobj(src, dst)
+        shutil.copymode(file_path, tmp_path)
+        os.replace(tmp_path, file_path)
+        Timings.written(file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+#%% Cell: 54
+def _python_to_notebook(py_path: str) -> Optional[str]:
+    with Timings.measure("to notebook", py_path):
+        source_map = SourceMap.load(py_path)
+        if source_map is not None and source_map.is_current():
+            return None
+        file_path, exported_cells = _get_py_cells(py_path)
+        if file_path is None:
+            return None
+        cells, source_spans = _read_cell_sources(file_path)
+        old_sources = ["".join(cell["source"]) for cell in cells]
+        _overwrite_exported_cells({"cells": cells}, exported_cells)
+        changed = [idx for idx, cell in enumerate(cells) if "".join(cell["source"]) != old_sources[idx]]
+        if len(changed) == 0:
+            return None
+        with open(file_path, "rb") as f:
+            replacements = [source_spans[idx] + (_format_source(f, source_spans[idx], cells[idx]["source"]),) for idx in changed]
+        _splice_file(file_path, replacements)
+        return file_path
+
+
+def python2nb(rescan: bool = True, jobs: Optional[int] = None, paths: Optional[List[str]] = None) -> None:
     """
     Convert all notebooks in the folder.
+
+    Notebooks whose exported cells did not change are not touched, otherwise only the changed cell sources are replaced.
     
     :param project_root: The root directory of the project. The default exp path is relative to this folder.
     :type project_root: str, optional
+    :param jobs: The number of worker processes, defaults to the number of CPUs.
+    :type jobs: int, optional
+    :param paths: Only update the notebooks of these python files and of the python files in these folders, defaults to the whole project.
+    :type paths: List[str], optional
     """
-    readme_template = DOC_INDEX_TEMPLATE
-    pyfiles = Files.get_generated_python_files()
-    index = []
-    for py_path in pyfiles:
-        print("Converting to notebook: {}".format(py_path))
-        
-        file_path, exported_cells = _get_py_cells(py_path)
-        if file_path is not None:
-            notebook = Notebook(file_path)
-            _overwrite_exported_cells(notebook, exported_cells)
-            _save_notebook(file_path, notebook)
-            print("Updated notebook: {}".format(file_path))
+    if paths is not None:
+        pyfiles = Files.select(paths).generated_python_files
+    else:
+        if rescan:
+            Files.invalidate()
+        pyfiles = Files.get_generated_python_files()
+    errors = []
+    updated = 0
+    for py_path, (file_path, error, output) in zip(pyfiles, _run_parallel(_python_to_notebook, pyfiles, jobs)):
+        _log(output, end="")
+        if error is not None:
+            errors.append((py_path, error))
+        elif file_path is not None:
+            _log("Updated notebook: {}".format(file_path))
+            updated += 1
+    _log(f"Updated {updated} notebook(s) out of {len(pyfiles)} total ({len(pyfiles) - updated - len(errors)} unchanged).")
+    _report_errors(errors)
+
+
+#%% Cell: 55
+"""doc
+---
 
+## Converting on Save in Jupyter
 
-#%% Cell: 22
+Instead of running a command after saving, jupyter can convert the saved notebook in its own process.
+Add this to your `jupyter_server_config.py` (or `jupyter_notebook_config.py` for the classic notebook):
+
+```python
+from jlabdev.main import post_save_hook
+c.FileContentsManager.post_save_hook = post_save_hook
+```
+
+Use `functools.partial(post_save_hook, doc=True)` to update the documentation of the notebook as well.
+Jupyter has to be started in the root folder of the project, since that is where the paths of the generated files are relative to.
+The hook passes that folder to the conversions instead of changing the working directory, which is shared by everything else jupyter runs in its process.
+
+The saved notebook is converted like `nb2py pkg/model.ipynb` would convert it, so the build is recorded in the build cache and the next `nb2py` skips it.
+Its page is updated like `nb2doc pkg/model.ipynb` would do it, except when the build cache has no pages yet (e.g. in a fresh clone): then only the page of the saved notebook is written and the docs index is left to the next `nb2doc`, so saving never waits for the docs of the whole project.
+"""
+
+
+#%% Cell: 56
+def post_save_hook(model: Dict, os_path: str, contents_manager, doc: bool = False, output_budget: Optional[OutputBudget] = None, image_options: Optional[ImageOptions] = None, **kwargs) -> None:
+    """Convert a notebook to python (and optionally markdown) after jupyter saved it.
+
+    Errors are logged by jupyter and do not fail the save.
+
+    :param model: The model of the saved file as given by jupyter.
+    :type model: Dict
+    :param os_path: The path of the saved file.
+    :type os_path: str
+    :param contents_manager: The contents manager of jupyter, its root_dir is the root of the project.
+    :param doc: Also update the doc page of the notebook and its entry in the index, defaults to False.
+    :type doc: bool, optional
+    :param output_budget: Limits for the outputs of the examples in the docs, use the same as for the commands. Defaults to no limits.
+    :type output_budget: OutputBudget, optional
+    :param image_options: How to process the images of the examples in the docs, use the same as for the commands. Defaults to copying them as they are.
+    :type image_options: ImageOptions, optional
+    """
+    if model.get("type") != "notebook":
+        return
+    root = os.path.abspath(contents_manager.root_dir)
+    file_path = os.path.relpath(os.path.abspath(os_path), root).replace("\\", "/")
+    if file_path.startswith("../"):
+        return
+    try:
+        notebook2py(jobs=1, paths=[os.path.join(root, file_path)], root=root)
+        if doc:
+            if any(key.startswith("nb2doc:") for key in BuildCache(root=root).builds):
+                notebook2doc(jobs=1, paths=[os.path.join(root, file_path)], output_budget=output_budget, image_options=image_options, root=root)
+            else:
+                # The page is not recorded in the build cache, so the next nb2doc builds it again together with the index.
+                _build_doc_page(file_path, output_budget=output_budget, image_options=image_options, root=root)
+                contents_manager.log.info(f"jlabdev updated the docs of {file_path}, run nb2doc to add them to the docs index.")
+    except Exception:
+        contents_manager.log.exception(f"jlabdev failed to convert {file_path}")
+
+
+#%% Cell: 57
+"""doc
+---
+
+## Command Line Interface
+
+The console scripts `nb2all`, `nb2py`, `nb2doc` and `py2nb` share their options, so they are parsed in one place before the actual command is run.
+The `jlabdev` console script bundles them as subcommands (e.g. `jlabdev nb2py`), which are sent to the daemon if one is running (see [jlabdev.client](client.md)).
+"""
+
+
+#%% Cell: 58
+def _parse_args(command: str, argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog=command)
+    parser.add_argument("--git", action="store_true", help="Find files with `git ls-files` instead of walking the directory tree.")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes (default: number of CPUs).")
+    if command != "py2nb":
+        parser.add_argument("--force", action="store_true", help="Ignore the build cache and regenerate all files.")
+        parser.add_argument("--check", action="store_true", help="Write nothing, list the generated files that are out of date and fail if there are any.")
+        parser.add_argument("--watch", action="store_true", help="Keep running and rebuild files whenever they change.")
+        parser.add_argument("--poll", action="store_true", help="Watch for changes by polling instead of using inotify.")
+    if command in ("nb2all", "nb2doc"):
+        parser.add_argument("--output-budget", default=None, metavar="LIMITS", help="Limit the outputs of examples in the docs, e.g. cell_lines=100,page_bytes=1M,image_bytes=500k,spill (see OutputBudget).")
+        parser.add_argument("--images", default=None, metavar="OPTIONS", help="Process the images of examples in the docs, e.g. optimize,max_size=1600,thumbnail=400 (see ImageOptions).")
+    changes = parser.add_mutually_exclusive_group()
+    changes.add_argument("--staged", action="store_true", help="Only convert the files staged in git (and the notebooks of staged python files).")
+    changes.add_argument("--since", default=None, metavar="REV", help="Only convert the files changed since the git revision REV (and the notebooks of changed python files).")
+    parser.add_argument("--timings", nargs="?", const="", default=None, metavar="FILE", help="Print the time spent per phase and file, or save it as json to FILE.")
+    parser.add_argument("--profile", nargs="?", const=f"{command}.prof", default=None, metavar="FILE", help=f"Profile the run with cProfile and save the stats to FILE (default: {command}.prof).")
+    parser.add_argument("paths", nargs="*", metavar="PATH", help="Only convert these files and the files in these folders (default: the whole project).")
+    args = parser.parse_args(argv)
+    if getattr(args, "watch", False) and (args.timings is not None or args.profile is not None):
+        parser.error("--timings and --profile cannot be combined with --watch.")
+    if getattr(args, "watch", False) and len(args.paths) > 0:
+        parser.error("Paths cannot be combined with --watch.")
+    if getattr(args, "watch", False) and (args.check or args.staged or args.since is not None):
+        parser.error("--check, --staged and --since cannot be combined with --watch.")
+    if (args.staged or args.since is not None) and len(args.paths) > 0:
+        parser.error("Paths cannot be combined with --staged or --since.")
+    for path in args.paths:
+        if not os.path.exists(path):
+            parser.error(f"No such file or folder: {path}")
+        if (os.path.relpath(path).replace("\\", "/") + "/").startswith("../"):
+            parser.error(f"{path} is not inside the project folder.")
+    args.paths = args.paths if len(args.paths) > 0 else None
+    if getattr(args, "output_budget", None) is not None:
+        try:
+            args.output_budget = OutputBudget.parse(args.output_budget)
+        except ValueError as e:
+            parser.error(str(e))
+    if getattr(args, "images", None) is not None:
+        try:
+            args.images = ImageOptions.parse(args.images)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.staged or args.since is not None:
+        try:
+            args.paths = Files.changed(args.since)
+        except ValueError as e:
+            parser.error(str(e))
+    # Worker processes are not profiled, so profile a serial run unless asked otherwise.
+    if args.profile is not None and args.jobs is None:
+        args.jobs = 1
+    Files.use_git = args.git
+    return args
+
+
+def _report_timings(file_path: str) -> None:
+    if file_path == "":
+        print(Timings.format_table())
+    else:
+        with open(file_path, "w", encoding="utf8") as f:
+            f.write(json.dumps(Timings.to_dict(), indent=1) + "\n")
+        print(f"Saved timings to {file_path}.")
+
+
+def _run_command(command, args: argparse.Namespace, **kwargs) -> None:
+    Timings.reset(args.timings is not None)
+    profiler = cProfile.Profile() if args.profile is not None else None
+    try:
+        if profiler is not None:
+            profiler.enable()
+        try:
+            with Timings.measure("total"):
+                command(**kwargs)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(args.profile)
+                print(f"Saved profile to {args.profile}.")
+            if args.timings is not None:
+                _report_timings(args.timings)
+    except ConversionError as e:
+        print("ERROR: {}".format(e))
+        sys.exit(1)
+
+
+def nb2all(argv: Optional[List[str]] = None) -> None:
+    args = _parse_args("nb2all", argv)
+    if args.watch:
+        watch(force=args.force, jobs=args.jobs, polling=args.poll, output_budget=args.output_budget, image_options=args.images)
+    else:
+        _run_command(notebook2all, args, force=args.force, jobs=args.jobs, paths=args.paths, check=args.check, output_budget=args.output_budget, image_options=args.images)
+
+
+def nb2py(argv: Optional[List[str]] = None) -> None:
+    args = _parse_args("nb2py", argv)
+    if args.watch:
+        watch(doc=False, force=args.force, jobs=args.jobs, polling=args.poll)
+    else:
+        _run_command(notebook2py, args, force=args.force, jobs=args.jobs, paths=args.paths, check=args.check)
+
+
+def nb2doc(argv: Optional[List[str]] = None) -> None:
+    args = _parse_args("nb2doc", argv)
+    if args.watch:
+        watch(python=False, force=args.force, jobs=args.jobs, polling=args.poll, output_budget=args.output_budget, image_options=args.images)
+    else:
+        _run_command(notebook2doc, args, force=args.force, jobs=args.jobs, paths=args.paths, check=args.check, output_budget=args.output_budget, image_options=args.images)
+
+
+def py2nb(argv: Optional[List[str]] = None) -> None:
+    args = _parse_args("py2nb", argv)
+    _run_command(python2nb, args, jobs=args.jobs, paths=args.paths)
+
+
+#%% Cell: 59
 if __name__ == "__main__":
-    if "--nb2all" in sys.argv:
-        notebook2all()
-    if "--nb2py" in sys.argv:
-        notebook2py()
-    if "--nb2doc" in sys.argv:
-        notebook2doc()
-    if "--py2nb" in sys.argv:
-        python2nb()
+    commands = {"--nb2all": nb2all, "--nb2py": nb2py, "--nb2doc": nb2doc, "--py2nb": py2nb}
+    argv = [arg for arg in sys.argv[1:] if arg not in commands]
+    for flag, command in commands.items():
+        if flag in sys.argv:
+            command(argv)
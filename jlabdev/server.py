@@ -0,0 +1,285 @@
+# AUTOGENERATED FROM: jlabdev/server.ipynb
+
+
+#%% Cell: 0
+"""doc
+> **The MIT License (MIT)**
+> 
+> Copyright (c) 2020 Michael Fuerst
+> 
+> Permission is hereby granted, free of charge, to any person obtaining a copy
+> of this software and associated documentation files (the "Software"), to deal
+> in the Software without restriction, including without limitation the rights
+> to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+> copies of the Software, and to permit persons to whom the Software is
+> furnished to do so, subject to the following conditions:
+> 
+> The above copyright notice and this permission notice shall be included in all
+> copies or substantial portions of the Software.
+> 
+> THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+> IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+> FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+> AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+> LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+> OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+> SOFTWARE.
+"""
+
+
+#%% Cell: 1
+"""doc
+# jlabdev.server - Convert without starting a process
+
+> A long running daemon that converts notebooks on request.
+
+Editors, git hooks and jupyter integrations call the commands of jlabdev many times a day, mostly for a single notebook.
+Each call pays for starting python, importing jlabdev and scanning the project and parallel calls race to write the same files.
+
+`jlabdev serve` starts a daemon in the root of the project, which listens on the unix socket `.jlabdev/server.sock`.
+It keeps the scanned files up to date by watching the project and runs the conversions one after the other, so no two builds write the same files at the same time.
+Requests for the same command that arrive while a build is running are merged into a single build.
+
+The daemon does not keep parsed notebooks around: unchanged notebooks are skipped by the build cache anyway and a changed notebook has to be parsed again.
+The build cache itself is loaded for every build (this takes milliseconds), so builds of the daemon and of commands run outside of it do not overwrite each other.
+
+The requests are sent by the `jlabdev` command (see [jlabdev.client](client.md)).
+"""
+
+
+#%% Cell: 2
+from typing import List, Dict, Optional
+import argparse
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+from jlabdev.client import SOCKET_PATH, request
+from jlabdev.main import ConversionError, Files, ProjectWatcher, capture_output, notebook2all, notebook2doc, notebook2py, python2nb
+
+
+#%% Cell: 3
+"""doc
+---
+
+## Merging Requests
+
+Every request becomes a job, which waits in a queue until the builder thread takes it.
+The builder takes all waiting jobs at once and merges the jobs of the same command into one build of all their paths (or of the whole project, if one job asks for it).
+When the build is done, all of its jobs get the same output, which the builder captures for its own thread only (see `capture_output`), so nothing the watcher or the connections print ends up in a response.
+The file index is only changed by the watcher while no build runs.
+If watching fails (e.g. inotify dropped events or a folder was removed while it was scanned), the project is scanned again with a fresh watcher and if that fails as well, the daemon stops instead of building from an index that is out of date.
+"""
+
+
+#%% Cell: 4
+COMMANDS = {"nb2all": notebook2all, "nb2py": notebook2py, "nb2doc": notebook2doc, "py2nb": python2nb}
+
+
+class _Job(object):
+    def __init__(self, command: str, paths: Optional[List[str]], force: bool):
+        self.command = command
+        self.paths = paths
+        self.force = force
+        self.output = ""
+        self.error = None
+        self.done = threading.Event()
+
+
+class BuildQueue(object):
+    def __init__(self, jobs: Optional[int] = None):
+        self.jobs = jobs
+        self.pending = []
+        self.stopped = False
+        self.build_lock = threading.Lock()
+        self.wakeup = threading.Condition()
+
+    def submit(self, command: str, paths: Optional[List[str]] = None, force: bool = False) -> _Job:
+        job = _Job(command, paths, force)
+        with self.wakeup:
+            if self.stopped:
+                job.error = "The server is shutting down."
+                job.done.set()
+            else:
+                self.pending.append(job)
+                self.wakeup.notify()
+        return job
+
+    def stop(self) -> None:
+        with self.wakeup:
+            self.stopped = True
+            for job in self.pending:
+                job.error = "The server is shutting down."
+                job.done.set()
+            self.pending = []
+            self.wakeup.notify()
+
+    def _take(self) -> List[_Job]:
+        with self.wakeup:
+            while len(self.pending) == 0 and not self.stopped:
+                self.wakeup.wait()
+            jobs, self.pending = self.pending, []
+            return jobs
+
+    @staticmethod
+    def _merge(jobs: List[_Job]) -> List:
+        batches = {}
+        for job in jobs:
+            batches.setdefault((job.command, job.force), []).append(job)
+        merged = []
+        for (command, force), batch in batches.items():
+            if any(job.paths is None for job in batch):
+                paths = None
+            else:
+                paths = list(dict.fromkeys(path for job in batch for path in job.paths))
+            merged.append((command, force, paths, batch))
+        return merged
+
+    def _build(self, command: str, force: bool, paths: Optional[List[str]]):
+        kwargs = {"rescan": False, "jobs": self.jobs, "paths": paths}
+        if command != "py2nb":
+            kwargs["force"] = force
+        output = io.StringIO()
+        error = None
+        with self.build_lock, capture_output(output):
+            try:
+                COMMANDS[command](**kwargs)
+            except ConversionError as e:
+                error = str(e)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+        return output.getvalue(), error
+
+    def run(self) -> None:
+        while not self.stopped:
+            for command, force, paths, batch in BuildQueue._merge(self._take()):
+                print(f"{command} {' '.join(paths) if paths is not None else '(all files)'} for {len(batch)} request(s)", file=sys.stderr)
+                output, error = self._build(command, force, paths)
+                for job in batch:
+                    job.output = output
+                    job.error = error
+                    job.done.set()
+
+    def watch(self, watcher: ProjectWatcher, polling: bool = False) -> None:
+        while not self.stopped:
+            try:
+                events = watcher.read_events()
+                with self.build_lock:
+                    _, _, rescan = watcher.apply(events)
+                    if rescan:
+                        watcher.close()
+                        Files.invalidate()
+                        watcher = ProjectWatcher(polling=polling)
+            except Exception:
+                print(f"ERROR: Watching the project failed, scanning it again:\n{traceback.format_exc()}", file=sys.stderr)
+                with self.build_lock:
+                    try:
+                        watcher.close()
+                    except OSError:
+                        pass
+                    Files.invalidate()
+                    try:
+                        watcher = ProjectWatcher(polling=polling)
+                    except Exception:
+                        print(f"ERROR: Cannot watch the project, stopping:\n{traceback.format_exc()}", file=sys.stderr)
+                        self.stop()
+
+
+#%% Cell: 5
+"""doc
+---
+
+## Serving Requests
+
+Every connection is handled in its own thread, which waits for its job to be built and then responds (see [jlabdev.client](client.md) for the protocol).
+`SIGTERM`, `Ctrl+C` and `jlabdev stop` stop the daemon and remove its socket.
+"""
+
+
+#%% Cell: 6
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def _respond(self, response: Dict) -> None:
+        self.wfile.write(json.dumps(response).encode("utf8") + b"\n")
+
+    def handle(self) -> None:
+        try:
+            request = json.loads(self.rfile.readline())
+            command = request["command"]
+            if command == "ping":
+                self._respond({"output": "", "error": None})
+                return
+            if command == "stop":
+                self._respond({"output": "Stopped the server.\n", "error": None})
+                threading.Thread(target=self.server.shutdown).start()
+                return
+            if command not in COMMANDS:
+                self._respond({"output": "", "error": f"Unknown command: {command}"})
+                return
+            job = self.server.queue.submit(command, request.get("paths"), request.get("force", False))
+            job.done.wait()
+            self._respond({"output": job.output, "error": job.error})
+        except (ValueError, KeyError, TypeError) as e:
+            self._respond({"output": "", "error": f"Invalid request: {e}"})
+        except OSError:
+            pass  # The client went away.
+
+
+def serve(jobs: Optional[int] = None, polling: bool = False) -> None:
+    """Run the daemon in the current working directory until it is stopped.
+
+    :param jobs: The number of worker processes of a build, defaults to the number of CPUs.
+    :type jobs: int, optional
+    :param polling: Watch the project for changes by polling instead of using inotify, defaults to False.
+    :type polling: bool, optional
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        raise OSError("Unix sockets are not available on this platform.")
+    if request("ping") is not None:
+        print(f"A server is already running on {SOCKET_PATH}.")
+        return
+    if os.path.exists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)
+    os.makedirs(os.path.dirname(SOCKET_PATH), exist_ok=True)
+
+    queue = BuildQueue(jobs)
+    Files.invalidate()
+    watcher = ProjectWatcher(polling=polling)
+    server = socketserver.ThreadingUnixStreamServer(SOCKET_PATH, _RequestHandler)
+    server.daemon_threads = True
+    server.queue = queue
+
+    def watch() -> None:
+        queue.watch(watcher, polling)
+        # The queue only stops watching when the server stops or the project cannot be watched any more.
+        server.shutdown()
+
+    threading.Thread(target=watch, daemon=True).start()
+    threading.Thread(target=queue.run, daemon=True).start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Serving on {SOCKET_PATH}, stop with Ctrl+C or `jlabdev stop`.", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.stop()
+        server.server_close()
+        if os.path.exists(SOCKET_PATH):
+            os.remove(SOCKET_PATH)
+        print("Stopped serving.", file=sys.stderr)
+
+
+def serve_command(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="jlabdev serve")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes of a build (default: number of CPUs).")
+    parser.add_argument("--poll", action="store_true", help="Watch for changes by polling instead of using inotify.")
+    parser.add_argument("--git", action="store_true", help="Find files with `git ls-files` instead of walking the directory tree.")
+    args = parser.parse_args(argv)
+    Files.use_git = args.git
+    serve(jobs=args.jobs, polling=args.poll)
@@ -36,14 +36,19 @@ setup(
     include_package_data=True,
     author='Michael Fuerst',
     install_requires=install_requires,
+    extras_require={
+        'fast': ['orjson'],
+        'images': ['Pillow'],
+    },
     dependency_links=dependency_links,
     author_email='mail@michaelfuerst.de',
     entry_points={
         'console_scripts': [
-            'nb2all = jlabdev.main:notebook2all',
-            'nb2py = jlabdev.main:notebook2py',
-            'nb2doc = jlabdev.main:notebook2doc',
-            'py2nb = jlabdev.main:python2nb',
+            'nb2all = jlabdev.main:nb2all',
+            'nb2py = jlabdev.main:nb2py',
+            'nb2doc = jlabdev.main:nb2doc',
+            'py2nb = jlabdev.main:py2nb',
+            'jlabdev = jlabdev.client:jlabdev',
         ]
     }
 )